@@ -0,0 +1,314 @@
+import threading
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+import accessibility_stats
+import metrics
+
+
+class CatchmentSet():
+    """All catchments of a city for one time of day.
+
+    membership is a CSR matrix (catchments x city cells), ratios hold the 2SFCA step 1 ratio of every catchment
+    for each demographic category and poi_counts the number of POIs of each category at the catchment origin.
+    """
+
+    def __init__(self, ids, origins, membership, ratios, has_stats, poi_counts):
+        self.ids = ids
+        self.origins = origins
+        self.membership = membership
+        self.ratios = ratios
+        self.has_stats = has_stats
+        self.poi_counts = poi_counts
+        self.origin_rows = {}
+        for row, origin in enumerate(origins.tolist()):
+            self.origin_rows.setdefault(origin, []).append(row)
+
+
+class CityAccessibility():
+    """In-memory 2SFCA data of one city - cell populations and the catchment sets for every time of day"""
+
+    def __init__(self, city_id, cells, populations, catchments):
+        self.city_id = city_id
+        self.cells = cells
+        self.cell_index = {h: i for i, h in enumerate(np.asarray(cells).tolist())}
+        #categorytype -> (group names, cells x groups population matrix, mask of cells that have demographics)
+        self.populations = populations
+        self.catchments = catchments
+        self._base = {}
+        #version of the memory-mapped dataset the city was loaded from (None if loaded from the database)
+        self.dataset_version = None
+
+    def catchment_weights(self, timeofday, categorytype, signs):
+        catchments = self.catchments[timeofday]
+        ratios = catchments.ratios.get(categorytype)
+        if ratios is None:
+            return np.zeros(len(catchments.ids))
+        return ratios * signs
+
+    def base_accessibility(self, timeofday, categorytype, poi_category):
+        """Returns (accessibility, mask) vectors over city cells - mask marks cells that have a row in accessibility_stats"""
+        key = (timeofday, categorytype, poi_category)
+        if key not in self._base:
+            catchments = self.catchments.get(timeofday)
+            n = len(self.cells)
+            if catchments is None or categorytype not in self.populations:
+                self._base[key] = (np.zeros(n), np.zeros(n, dtype=bool))
+            else:
+                counts = catchments.poi_counts.get(poi_category, np.zeros(len(catchments.ids)))
+                #every POI at the origin contributes the ratio of its catchment to all cells in the catchment
+                accessibility = catchments.membership.T @ self.catchment_weights(timeofday, categorytype, counts)
+                contributing = ((counts > 0) & catchments.has_stats.get(categorytype, False)).astype(np.float64)
+                mask = (catchments.membership.T @ contributing > 0) & self.populations[categorytype][2]
+                self._base[key] = (accessibility, mask)
+        return self._base[key]
+
+    def adjustment(self, timeofday, categorytype, poi_category, remove_h3ids=(), add_h3ids=()):
+        """Same as api_add_remove_catchments: removing a hexagon removes all POIs of the category in it (once),
+        adding a hexagon adds one POI per occurrence in the list.
+        """
+        total = np.zeros(len(self.cells))
+        cells, values = self.adjustment_delta(
+            timeofday, categorytype, poi_category, {h: 1 for h in set(remove_h3ids or ())}, Counter(add_h3ids or ())
+        )
+        total[cells] = values
+        return total
+
+    def adjustment_delta(self, timeofday, categorytype, poi_category, removed, added):
+        """Sparse change in accessibility for a change in removed/added origins - only the affected catchments are touched.
+        `removed` maps h3id -> 1 (newly removed) or -1 (restored), `added` maps h3id -> change in the number of occurences.
+        Returns (cell indices, values).
+        """
+        catchments = self.catchments.get(timeofday)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0))
+        if catchments is None or categorytype not in catchments.ratios:
+            return empty
+
+        counts = catchments.poi_counts.get(poi_category, np.zeros(len(catchments.ids)))
+        signs = {}
+        for h3id, change in removed.items():
+            for row in catchments.origin_rows.get(h3id, []):
+                signs[row] = signs.get(row, 0) - change * counts[row]
+        for h3id, change in added.items():
+            for row in catchments.origin_rows.get(h3id, []):
+                signs[row] = signs.get(row, 0) + change
+
+        rows = [row for row, sign in signs.items() if sign]
+        if not rows:
+            return empty
+        weights = catchments.ratios[categorytype][rows] * np.array([signs[row] for row in rows])
+        delta = sparse.csr_matrix(weights) @ catchments.membership[rows]
+        delta.sum_duplicates()
+        return delta.indices, delta.data
+
+    def accessibility(self, timeofday, categorytype, poi_category, remove_h3ids=(), add_h3ids=()):
+        base, mask = self.base_accessibility(timeofday, categorytype, poi_category)
+        total = base + self.adjustment(timeofday, categorytype, poi_category, remove_h3ids, add_h3ids)
+        #like api_get_city_stats, adjustments only apply to cells that have base statistics
+        return np.where(mask, total, 0)
+
+    def group_stats(self, accessibility, categorytype):
+        """Population-weighted accessibility per group - returns (groupname, metric, population) rows sorted by metric"""
+        return self.weighted_group_stats(accessibility @ self.populations[categorytype][1], categorytype)
+
+    def weighted_group_stats(self, weighted, categorytype):
+        """Same as group_stats, from the per-group sums of accessibility * population"""
+        groups, populations, _ = self.populations[categorytype]
+        totals = populations.sum(axis=0)
+        metrics = np.divide(weighted, totals, out=np.zeros_like(weighted), where=totals != 0)
+        rows = [(g, float(m), float(p)) for g, m, p in zip(groups, metrics, totals)]
+        return sorted(rows, key=lambda r: r[1], reverse=True)
+
+    def city_stats(self, timeofday, categorytype, poi_category, remove_h3ids=(), add_h3ids=()):
+        accessibility = self.accessibility(timeofday, categorytype, poi_category, remove_h3ids, add_h3ids)
+        return self.group_stats(accessibility, categorytype)
+
+    def missing_origins(self, timeofday, h3ids):
+        catchments = self.catchments.get(timeofday)
+        known = catchments.origin_rows if catchments is not None else {}
+        return [h for h in set(h3ids or ()) if h not in known]
+
+
+class AccessibilityEngine():
+    """In-process 2SFCA engine that replaces the api_get_city_stats / api_add_remove_catchments SQL functions.
+
+    Everything is loaded once with load() - accessibility is then a sparse matrix-vector product,
+    so adding or removing POIs only touches the affected catchments.
+    `cursor` is a callable returning a context manager that yields a psycopg2 cursor (e.g. DatabasePool.cursor).
+    With a `dataset_dir`, cities exported by city_dataset.py are memory-mapped from there instead of read from the database.
+    """
+
+    def __init__(self, cursor, city_ids=None, dataset_dir=None):
+        self.cursor = cursor
+        self.city_ids = city_ids
+        self.dataset_dir = dataset_dir
+        self.cities = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        import city_dataset
+        with self.cursor() as cur:
+            if self.city_ids is None:
+                cur.execute("SELECT cityid FROM cities")
+                city_ids = [r[0] for r in cur.fetchall()]
+            else:
+                city_ids = self.city_ids
+            for city_id in city_ids:
+                if self.dataset_dir and city_dataset.current_version(self.dataset_dir, city_id) is not None:
+                    self.cities[int(city_id)] = city_dataset.load_city(self.dataset_dir, city_id)
+                else:
+                    self.cities[int(city_id)] = self.load_city(cur, int(city_id))
+
+    def refresh(self):
+        """Swaps in the cities whose dataset now points to another version"""
+        if not self.dataset_dir:
+            return
+        import city_dataset
+        for city_id, city in list(self.cities.items()):
+            version = city_dataset.current_version(self.dataset_dir, city_id)
+            if version is not None and version != city.dataset_version:
+                loaded = city_dataset.load_city(self.dataset_dir, city_id, version)
+                with self._lock:
+                    self.cities[city_id] = loaded
+
+    def dataset_versions(self):
+        """Sorted (city_id, dataset version) of the cities loaded from a dataset"""
+        return sorted((city_id, city.dataset_version) for city_id, city in self.cities.items() if city.dataset_version is not None)
+
+    def has_city(self, city_id):
+        return int(city_id) in self.cities
+
+    def get_city(self, city_id):
+        return self.cities[int(city_id)]
+
+    def load_city(self, cur, city_id):
+        cur.execute(
+            "SELECT categorytype, groupname, h3id, population FROM h3demographics WHERE cityid = %s", (city_id, )
+        )
+        rows = cur.fetchall()
+        #H3 ids are bigint in the database - cells is a sorted uint64 array
+        cells = np.array(sorted({r[2] for r in rows}), dtype=np.uint64)
+        cell_index = {h: i for i, h in enumerate(cells.tolist())}
+        populations = {}
+        for categorytype in sorted({r[0] for r in rows}):
+            ct_rows = [r for r in rows if r[0] == categorytype]
+            groups = sorted({r[1] for r in ct_rows})
+            group_index = {g: i for i, g in enumerate(groups)}
+            matrix = np.zeros((len(cells), len(groups)))
+            present = np.zeros(len(cells), dtype=bool)
+            for _, groupname, h3id, population in ct_rows:
+                matrix[cell_index[h3id], group_index[groupname]] += population or 0
+                present[cell_index[h3id]] = True
+            populations[categorytype] = (groups, matrix, present)
+
+        cur.execute("""
+            SELECT c3m.catchmentid FROM catchmenth3map c3m
+            JOIN (SELECT DISTINCT h3id FROM h3demographics WHERE cityid = %s) AS cells ON cells.h3id = c3m.h3id
+            JOIN catchments ON catchments.catchmentid = c3m.catchmentid
+            WHERE {}
+            GROUP BY c3m.catchmentid
+        """.format(accessibility_stats.STATS_CATCHMENTS), (city_id, ))
+        catchment_ids = [r[0] for r in cur.fetchall()]
+        city = CityAccessibility(city_id, cells, populations, {})
+        city.catchments = self.load_catchments(cur, city, catchment_ids)
+        return city
+
+    def load_catchments(self, cur, city, catchment_ids, existing=None):
+        """Loads the given catchments and merges them into the existing catchment sets (by time of day)"""
+        existing = dict(existing or {})
+        if not catchment_ids:
+            return existing
+
+        cur.execute(
+            "SELECT catchmentid, originh3id, timeofday FROM catchments WHERE catchmentid = ANY(%s) ORDER BY catchmentid",
+            (list(catchment_ids), )
+        )
+        meta = cur.fetchall()
+        cur.execute(
+            "SELECT catchmentid, h3id FROM catchmenth3map WHERE catchmentid = ANY(%s)", (list(catchment_ids), )
+        )
+        members = {}
+        for catchment_id, h3id in cur.fetchall():
+            if h3id in city.cell_index:
+                members.setdefault(catchment_id, []).append(city.cell_index[h3id])
+        cur.execute("""
+            SELECT catchmentid, categorytype, SUM(population) FROM catchment_stats
+            WHERE catchmentid = ANY(%s) GROUP BY catchmentid, categorytype
+        """, (list(catchment_ids), ))
+        stats = {(r[0], r[1]): r[2] for r in cur.fetchall()}
+        cur.execute(
+            "SELECT h3id, category, COUNT(*) FROM pois WHERE h3id = ANY(%s) GROUP BY h3id, category",
+            (list({r[1] for r in meta}), )
+        )
+        poi_counts = {}
+        for h3id, category, count in cur.fetchall():
+            poi_counts.setdefault(category, {})[h3id] = count
+        categorytypes = {ct for _, ct in stats}
+
+        for timeofday in sorted({r[2] for r in meta}):
+            tod_meta = [r for r in meta if r[2] == timeofday]
+            ids = np.array([r[0] for r in tod_meta], dtype=np.int64)
+            origins = np.array([r[1] for r in tod_meta], dtype=np.uint64)
+            indptr = np.cumsum([0] + [len(members.get(i, [])) for i in ids])
+            indices = np.array([c for i in ids for c in members.get(i, [])], dtype=np.int64)
+            membership = sparse.csr_matrix(
+                (np.ones(len(indices)), indices, indptr), shape=(len(ids), len(city.cells))
+            )
+            ratios, has_stats = {}, {}
+            for categorytype in categorytypes:
+                totals = np.array([stats.get((i, categorytype), np.nan) for i in ids], dtype=np.float64)
+                has_stats[categorytype] = ~np.isnan(totals)
+                #same as step 1: ratio is zero for catchments without population
+                ratios[categorytype] = np.divide(10000, totals, out=np.zeros_like(totals), where=has_stats[categorytype] & (totals != 0))
+            counts = {
+                category: np.array([by_origin.get(o, 0) for o in origins.tolist()], dtype=np.float64)
+                for category, by_origin in poi_counts.items()
+            }
+
+            if timeofday in existing:
+                old = existing[timeofday]
+                n_old, n_new = len(old.ids), len(ids)
+                all_types = set(old.ratios) | set(ratios)
+                all_categories = set(old.poi_counts) | set(counts)
+                existing[timeofday] = CatchmentSet(
+                    np.concatenate([old.ids, ids]),
+                    np.concatenate([old.origins, origins]),
+                    sparse.vstack([old.membership, membership], format='csr'),
+                    {ct: np.concatenate([old.ratios.get(ct, np.zeros(n_old)), ratios.get(ct, np.zeros(n_new))]) for ct in all_types},
+                    {ct: np.concatenate([old.has_stats.get(ct, np.zeros(n_old, dtype=bool)), has_stats.get(ct, np.zeros(n_new, dtype=bool))]) for ct in all_types},
+                    {pc: np.concatenate([old.poi_counts.get(pc, np.zeros(n_old)), counts.get(pc, np.zeros(n_new))]) for pc in all_categories},
+                )
+            else:
+                existing[timeofday] = CatchmentSet(ids, origins, membership, ratios, has_stats, counts)
+        return existing
+
+    def ensure_origins(self, city_id, timeofday, h3ids):
+        """Loads catchments for origins that are not known to the engine yet (e.g. ones created on the fly)"""
+        city = self.get_city(city_id)
+        missing = city.missing_origins(timeofday, h3ids)
+        if not missing:
+            return
+
+        with self._lock, self.cursor() as cur:
+            cur.execute(
+                "SELECT catchmentid FROM catchments WHERE originh3id = ANY(%s) AND timeofday = %s AND "
+                + accessibility_stats.STATS_CATCHMENTS, (missing, timeofday)
+            )
+            catchment_ids = [r[0] for r in cur.fetchall()]
+            known = city.catchments.get(timeofday)
+            if known is not None:
+                catchment_ids = list(set(catchment_ids) - set(known.ids.tolist()))
+            if catchment_ids:
+                #build the merged catchment sets first and swap them in, so readers never see a partial update
+                catchments = self.load_catchments(cur, city, catchment_ids, city.catchments)
+                city.catchments = catchments
+                city._base = {}
+
+    def city_stats(self, city_id, poi_category, timeofday, categorytype, remove_h3ids=(), add_h3ids=()):
+        """Returns the same (groupn, metric, population) rows as api_get_city_stats"""
+        with metrics.engine('city_stats'):
+            self.ensure_origins(city_id, timeofday, add_h3ids)
+            city = self.get_city(city_id)
+            return city.city_stats(timeofday, categorytype, poi_category, remove_h3ids, add_h3ids)
@@ -0,0 +1,234 @@
+"""Maintenance of the accessibility_stats table (2SFCA step 2).
+
+accessibility_stats holds, for every H3 cell of a city, the sum of the step 1 ratios of all catchments covering the cell,
+counted once per POI of the given category at the catchment origin. As the sum is additive, new catchments can be
+applied incrementally: only the cells they cover change, by the sum of their ratios.
+
+Run as a script to rebuild the whole table (e.g. after new census data). Every city is computed in one set-based pass
+on its own connection, into a staging table that is swapped in atomically once complete:
+
+    python accessibility_stats.py --workers 4
+"""
+import argparse
+import configparser
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
+
+import data_version
+import demographics_lod as lod
+
+#only catchments of this cutoff make up the statistics - the other cutoffs (isochrones_runner.py --minutes) are served
+#by /catchment/ but kept out of step1_stats, or every origin would count once per cutoff.
+#Catchments written before timedistance was recorded are 30 minute ones.
+STATS_MINUTES = 30
+STATS_CATCHMENTS = "(catchments.timedistance = {0} OR catchments.timedistance IS NULL)".format(STATS_MINUTES)
+
+#step 2 for a set of catchments - the change in accessibility of every (cell, category, POI category, time of day) they cover
+DELTAS_SQL = """
+    SELECT
+        s.h3id,
+        h.cityid,
+        s.categorytype,
+        pois.category AS poi_category,
+        s.timeofday,
+        SUM(s.ratio) AS delta
+    FROM step1_stats s
+    JOIN catchments ON catchments.catchmentid = s.catchmentid
+    JOIN pois ON pois.h3id = catchments.originh3id -- every POI at the origin counts
+    JOIN (
+        SELECT DISTINCT h3demographics.h3id, h3demographics.cityid, h3demographics.categorytype
+        FROM h3demographics
+        JOIN catchmenth3map c3m ON c3m.h3id = h3demographics.h3id
+        WHERE c3m.catchmentid = ANY(%(catchment_ids)s)
+    ) AS h ON h.h3id = s.h3id AND h.categorytype = s.categorytype
+    WHERE s.catchmentid = ANY(%(catchment_ids)s) AND {stats_catchments}
+    GROUP BY s.h3id, h.cityid, s.categorytype, pois.category, s.timeofday
+""".format(stats_catchments=STATS_CATCHMENTS)
+
+APPLY_DELTAS_SQL = """
+    WITH deltas AS ({deltas}),
+    updated AS (
+        UPDATE accessibility_stats a
+        SET accessibility = a.accessibility + %(sign)s * d.delta
+        FROM deltas d
+        WHERE
+            a.h3id = d.h3id AND a.cityid = d.cityid AND a.categorytype = d.categorytype
+            AND a.poi_category = d.poi_category AND a.timeofday = d.timeofday
+        RETURNING a.h3id, a.cityid, a.categorytype, a.poi_category, a.timeofday
+    )
+    INSERT INTO accessibility_stats (h3id, cityid, categorytype, poi_category, timeofday, accessibility)
+        SELECT d.h3id, d.cityid, d.categorytype, d.poi_category, d.timeofday, %(sign)s * d.delta
+        FROM deltas d
+        WHERE NOT EXISTS (
+            SELECT 1 FROM updated u WHERE
+                u.h3id = d.h3id AND u.cityid = d.cityid AND u.categorytype = d.categorytype
+                AND u.poi_category = d.poi_category AND u.timeofday = d.timeofday
+        )
+""".format(deltas=DELTAS_SQL)
+
+#full step 2 for one city, all demographic categories, POI categories and times of day at once
+CITY_STATS_SQL = """
+    SELECT
+        s.h3id,
+        h.cityid,
+        s.categorytype,
+        pois.category AS poi_category,
+        s.timeofday,
+        SUM(s.ratio) AS accessibility
+    FROM step1_stats s
+    JOIN catchments ON catchments.catchmentid = s.catchmentid
+    JOIN pois ON pois.h3id = catchments.originh3id
+    JOIN (
+        SELECT DISTINCT h3id, cityid, categorytype FROM h3demographics WHERE cityid = %(cityid)s
+    ) AS h ON h.h3id = s.h3id AND h.categorytype = s.categorytype
+    WHERE {stats_catchments}
+    GROUP BY s.h3id, h.cityid, s.categorytype, pois.category, s.timeofday
+""".format(stats_catchments=STATS_CATCHMENTS)
+
+
+def apply_catchments(cur, catchment_ids, sign=1):
+    """Adds the step 2 contribution of the given catchments to accessibility_stats (or subtracts it with sign=-1,
+    e.g. before deleting catchments). step1_stats must already contain their rows.
+    Everything happens in the caller's transaction; returns the number of rows that did not exist before.
+    """
+    if not catchment_ids:
+        return 0
+    #serialize with other writers so that two workers never insert the same missing row twice
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('accessibility_stats'))")
+    cur.execute(APPLY_DELTAS_SQL, {'catchment_ids': list(catchment_ids), 'sign': sign})
+    rows = cur.rowcount
+    cur.execute("""
+        SELECT DISTINCT h3demographics.cityid FROM h3demographics
+        JOIN catchmenth3map c3m ON c3m.h3id = h3demographics.h3id
+        WHERE c3m.catchmentid = ANY(%s)""", (list(catchment_ids), ))
+    lod.mark_stale(cur, [r[0] for r in cur.fetchall()])
+    return rows
+
+
+STAGING_TABLE = 'accessibility_stats_staging'
+
+#same columns as accessibility_stats, indexes are only built once the data is in
+CREATE_STAGING_SQL = """
+DROP TABLE IF EXISTS accessibility_stats_staging;
+
+CREATE TABLE public.accessibility_stats_staging
+(
+    id bigserial,
+    cityid bigint,
+    categorytype text,
+    poi_category varchar(50),
+    timeofday varchar(50),
+    h3id bigint,
+    accessibility float
+);
+"""
+
+INDEX_STAGING_SQL = """
+ALTER TABLE accessibility_stats_staging ADD CONSTRAINT acc_stats_staging_id PRIMARY KEY (id);
+CREATE INDEX acc_stats_staging_agg_index ON public.accessibility_stats_staging (cityid, categorytype, poi_category, timeofday);
+CREATE INDEX acc_stats_staging_h3index ON public.accessibility_stats_staging (h3id);
+ANALYZE accessibility_stats_staging;
+"""
+
+#the live table is renamed away and dropped in the same transaction, so readers see either the old or the new table
+SWAP_SQL = """
+LOCK TABLE accessibility_stats IN ACCESS EXCLUSIVE MODE;
+DROP TABLE accessibility_stats;
+ALTER TABLE accessibility_stats_staging RENAME TO accessibility_stats;
+ALTER TABLE accessibility_stats RENAME CONSTRAINT acc_stats_staging_id TO acc_stats_id;
+ALTER INDEX acc_stats_staging_agg_index RENAME TO acc_stats_agg_index;
+ALTER INDEX acc_stats_staging_h3index RENAME TO acc_stats_h3index;
+ALTER SEQUENCE accessibility_stats_staging_id_seq RENAME TO accessibility_stats_id_seq;
+"""
+
+
+def rebuild_city(db_params, city_id):
+    """Computes accessibility_stats rows of one city into the staging table on a separate connection"""
+    started = time.perf_counter()
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO accessibility_stats_staging (h3id, cityid, categorytype, poi_category, timeofday, accessibility) "
+                + CITY_STATS_SQL,
+                {'cityid': city_id}
+            )
+            rows = cur.rowcount
+    conn.close()
+    return city_id, rows, time.perf_counter() - started
+
+
+def rebuild(db_params, city_ids=None, workers=4):
+    """Rebuilds accessibility_stats for the given cities (all cities if None), keeping the rows of the other cities.
+
+    Incremental updates (apply_catchments) wait for the rebuild to finish, as it holds their advisory lock throughout.
+    Returns {phase: seconds}.
+    """
+    timings = {}
+    started = time.perf_counter()
+
+    def phase(name, since):
+        timings[name] = time.perf_counter() - since
+        print("{:<10} {:8.1f}s".format(name, timings[name]))
+        return time.perf_counter()
+
+    conn = psycopg2.connect(**db_params)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(hashtext('accessibility_stats'))")
+            if city_ids is None:
+                cur.execute("SELECT cityid FROM cities ORDER BY cityid")
+                city_ids = [r[0] for r in cur.fetchall()]
+            t = time.perf_counter()
+            cur.execute(CREATE_STAGING_SQL)
+            cur.execute(
+                """INSERT INTO accessibility_stats_staging (h3id, cityid, categorytype, poi_category, timeofday, accessibility)
+                SELECT h3id, cityid, categorytype, poi_category, timeofday, accessibility FROM accessibility_stats
+                WHERE NOT (cityid = ANY(%s))""",
+                (list(city_ids), )
+            )
+            t = phase('staging', t)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(rebuild_city, db_params, city_id) for city_id in city_ids]
+                for future in as_completed(futures):
+                    city_id, rows, seconds = future.result()
+                    print("  city {:<5} {:10} rows {:8.1f}s".format(city_id, rows, seconds))
+            t = phase('cities', t)
+
+            cur.execute(INDEX_STAGING_SQL)
+            t = phase('indexes', t)
+
+            cur.execute("BEGIN")
+            try:
+                cur.execute(SWAP_SQL)
+                lod.mark_stale(cur, city_ids)
+                data_version.bump(cur)
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+            t = phase('swap', t)
+            cur.execute("SELECT pg_advisory_unlock(hashtext('accessibility_stats'))")
+    finally:
+        conn.close()
+
+    phase('total', started)
+    return timings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rebuild accessibility_stats (2SFCA step 2)")
+    parser.add_argument('--config', default="../config/config.ini", help="path to config.ini")
+    parser.add_argument('--cities', nargs='+', type=int, default=None, help="city ids to rebuild (all cities by default)")
+    parser.add_argument('--workers', type=int, default=4, help="cities computed in parallel")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    rebuild(dict(config['DB']), args.cities, args.workers)
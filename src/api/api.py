@@ -1,7 +1,8 @@
 
-import psycopg2 as pg
-from psycopg2.extras import DictCursor
 import asyncio
+import hashlib
+import logging
+import time
 
 from enum import Enum
 from typing import Dict, List, Optional, Tuple, Any
@@ -10,16 +11,41 @@ sys.path.append("../")
 
 
 import isochrones as isc
-from sqlalchemy import create_engine
-from shapely.geometry import mapping
+import accessibility_stats
+import data_version
+import metadata
+import demographics_lod as lod
+import h3ids
+from viewport import Viewport, join_sql as viewport_join
+import metrics
+from database import DatabasePool
+from cache import GeometryCache, ResponseCache
+from singleflight import SingleFlight
+from scenarios import Scenario, ScenarioStore
+import columnar
+import serialize
+from shapely.ops import unary_union
 
 
 #please see @ https://github.com/tiangolo/fastapi/issues/1359#issuecomment-927789546 on what we are using to speed up FastAPI
-from fastapi import FastAPI, Body, status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Body, HTTPException, Query, Request, Response, status
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel as PydanticBaseModel
 import orjson
-from bson import ObjectId
+from psycopg2.errors import UndefinedTable
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+logger = logging.getLogger(__name__)
+
+#run on every new pooled connection with [DB_POOL] warmup - plpgsql plans its queries on the first call in a session,
+#so the hot api_* functions are called once with arguments that match nothing
+WARMUP_SQL = [
+    "SELECT * FROM api_get_pois_for_city(-1, '')",
+    "SELECT * FROM api_get_demographics_for_city(-1, '')",
+    "SELECT * FROM api_get_demographics_for_catchment('', -1)",
+    "SELECT * FROM api_get_city_stats(-1, '', '', '')",
+    "SELECT version FROM data_version WHERE id = 1",
+]
 
 def orjson_dumps(v, *, default):
     # orjson.dumps returns bytes, to match standard json.dumps we need to decode
@@ -30,7 +56,6 @@ class BaseModel(PydanticBaseModel):
     class Config:
         json_load = orjson.loads
         json_dumps = orjson_dumps
-        json_encoders = {ObjectId: lambda x: str(x)}
 
 class PydanticJSONResponse(JSONResponse):
     def render(self, content: Any) -> bytes:
@@ -43,7 +68,7 @@ class PydanticJSONResponse(JSONResponse):
         return content.encode(self.charset)
 
 class backendApi:
-    def __init__(self, db_params, otp_params) -> None:
+    def __init__(self, db_params, otp_params, pool_params = None, engine_params = None, cache_params = None, scenario_params = None, metrics_params = None, isochrone_params = None) -> None:
         assert 'dbname' in db_params, "Database parameters do not include 'dbname'"
         assert 'user' in db_params, "Database parameters do not include 'user'"
         assert 'password' in db_params, "Database parameters do not include 'password'"
@@ -53,17 +78,236 @@ class backendApi:
         self.otp_port = otp_params['port']
         self.otp_host = otp_params['host']
         self.otp_ref_date = otp_params['ref_date']
-
-    
-    def get_db_connection(self):
-        return pg.connect(**self.db_params)
-
-    def get_alchemy_engine(self):
-        conn_string = 'postgresql://{user}:{password}@{host}:{port}/{dbname}'.format(**self.db_params)
-        return create_engine(conn_string, echo=False, future=True)
+        self.otp_client = isc.OTPClient(
+            max_concurrency=otp_params.get('max_concurrency', 8),
+            timeout=otp_params.get('timeout', 60),
+            retries=otp_params.get('retries', 3),
+        )
+        #None unless [ISOCHRONES] selects an in-process backend; shared by all requests so it is loaded once
+        self.isochrone_backend = isc.make_isochrone_backend(isochrone_params, self.otp_ref_date)
+        pool_params = pool_params or {}
+        #prepare connections and /configuration before the worker reports ready
+        self.warmup = str(pool_params.get('warmup', 'false')).lower() in ('1', 'true', 'yes')
+        self.db = DatabasePool(
+            db_params, 
+            min_size=pool_params.get('min_size', 2), 
+            max_size=pool_params.get('max_size', 10),
+            timeout=pool_params.get('timeout', 30),
+            stream_chunk_size=pool_params.get('stream_chunk_size', 5000),
+            warmup_sql=WARMUP_SQL if self.warmup else None,
+        )
+
+        #optional in-memory 2SFCA engine used instead of api_get_city_stats
+        engine_params = engine_params or {}
+        self.engine = None
+        if str(engine_params.get('enabled', 'false')).lower() in ('1', 'true', 'yes'):
+            #imported here, as scipy is only needed by the engine
+            import accessibility as acc
+            city_ids = engine_params.get('cities')
+            city_ids = [int(c) for c in city_ids.split(',')] if city_ids else None
+            self.engine = acc.AccessibilityEngine(self.db.cursor, city_ids, engine_params.get('dataset_dir') or None)
+
+        #cache of serialized responses, invalidated whenever the data version changes
+        cache_params = cache_params or {}
+        self.cache = ResponseCache(max_bytes=float(cache_params.get('max_mb', 256)) * 1024 * 1024)
+        self.version_check_interval = float(cache_params.get('version_check_interval', 1))
+        #GeoJSON of catchments served so far, at every detail level
+        self.geometries = GeometryCache(max_bytes=float(cache_params.get('geometry_max_mb', 64)) * 1024 * 1024)
+        self._data_version = None
+        #snapshot written by the ingestion/precompute jobs (see metadata.py), reloaded when its version changes
+        self.metadata = None
+        self._metadata_version = None
+        #concurrent requests for the same catchment share a single computation
+        self.catchment_flights = SingleFlight()
+        self._data_version_checked = 0
+
+        #what-if sessions of /city_data/ (only used for cities loaded into the engine)
+        scenario_params = scenario_params or {}
+        self.scenarios = ScenarioStore(
+            ttl=float(scenario_params.get('ttl', 1800)),
+            max_bytes=float(scenario_params.get('max_mb', 64)) * 1024 * 1024,
+        )
+
+        #requests slower than this are logged with their timing breakdown (disabled if 0)
+        metrics_params = metrics_params or {}
+        self.slow_request_ms = float(metrics_params.get('slow_request_ms') or 0)
+
+    def _read_versions(self):
+        with self.db.cursor() as cur:
+            return data_version.get(cur), metadata.get_version(cur)
+
+    def _load_metadata(self):
+        with self.db.cursor() as cur:
+            self._metadata_version, self.metadata = metadata.get(cur)
+
+    async def get_data_version(self):
+        """Returns the current data version, checking the database at most once per version_check_interval.
+        When the engine serves cities from datasets, their versions are part of it, so swapping in a re-exported
+        dataset invalidates cached responses and ETags like a database change does.
+        """
+        now = time.monotonic()
+        if self._data_version is None or now - self._data_version_checked > self.version_check_interval:
+            with metrics.sql('data_version'):
+                version, metadata_version = await self.db.run(self._read_versions)
+            if metadata_version != self._metadata_version:
+                with metrics.sql('metadata'):
+                    await self.db.run(self._load_metadata)
+            if self.engine is not None:
+                #picks up city datasets re-exported since the last check (see city_dataset.py)
+                await self.db.run(self.engine.refresh)
+                datasets = self.engine.dataset_versions()
+                if datasets:
+                    version = '{}-{}'.format(version, hashlib.sha1(repr(datasets).encode()).hexdigest()[:8])
+            self._data_version = version
+            self._data_version_checked = now
+        return self._data_version
+
+    async def get_metadata(self):
+        """Returns the metadata snapshot (None if no job has written one yet)"""
+        await self.get_data_version()
+        return self.metadata
+
+    async def city_center(self, city_id):
+        """Returns (lat, long) of the center of the city's bounding box"""
+        snapshot = await self.get_metadata()
+        for city in (snapshot or {}).get('cities', []):
+            if city['id'] == city_id and 'lat' in city:
+                return city['lat'], city['long']
+        sql = 'SELECT boundingbox FROM cities WHERE cityid = %s'
+        city_bbox = (await self.db.fetchone(sql, (city_id, ), name="city_bbox"))[0]
+        return (city_bbox[1] + city_bbox[3]) / 2, (city_bbox[0] + city_bbox[2]) / 2
+
+    async def cached_response(self, request, key, build, media_type = 'application/json'):
+        """Serves a response from the cache (or builds it with `build`, a coroutine function returning bytes).
+        Responses carry an ETag derived from the data version, so conditional requests are answered with 304.
+        """
+        version = await self.get_data_version()
+        etag = self.cache.etag(key, version)
+        if_none_match = request.headers.get('if-none-match', '')
+        if etag in [t.strip() for t in if_none_match.split(',')]:
+            metrics.CACHE_REQUESTS.labels('not_modified').inc()
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        body = self.cache.get(key, version)
+        metrics.CACHE_REQUESTS.labels('miss' if body is None else 'hit').inc()
+        if body is None:
+            body = await build()
+            self.cache.put(key, version, body)
+        return Response(content=body, media_type=media_type, headers={'ETag': etag})
+
+    def update_scenario(self, scenario_id, city_id, time_of_day, demographics_category, poi_category, removed, added, changes=None):
+        """Applies the removed/added POIs to a scenario (a new one if the id is unknown or the configuration changed).
+        `changes` holds the H3 ids (added, unadded, removed, restored) since the previous call - when the scenario is
+        still there only those are applied, otherwise it is built from the cumulative lists.
+        Returns (scenario, city stats rows).
+        """
+        city = self.engine.get_city(city_id)
+        scenario = self.scenarios.get(scenario_id) if scenario_id else None
+        if changes is not None and scenario is not None:
+            self.engine.ensure_origins(city_id, time_of_day, changes[0])
+            if scenario.matches(city, time_of_day, demographics_category, poi_category):
+                with scenario.lock, metrics.engine('scenario_edit'):
+                    data = scenario.edit(*changes)
+                self.scenarios.put(scenario)
+                return scenario, data
+
+        self.engine.ensure_origins(city_id, time_of_day, added)
+        if scenario is None or not scenario.matches(city, time_of_day, demographics_category, poi_category):
+            scenario = Scenario(city, time_of_day, demographics_category, poi_category)
+        with scenario.lock, metrics.engine('scenario_update'):
+            data = scenario.update(removed, added)
+        self.scenarios.put(scenario)
+        return scenario, data
+
+    async def ensure_catchments(self, city_id, h3_ids, time_of_day, minutes = 30):
+        """Makes sure catchments exist for all the given origins, creating the missing ones in one round
+        (concurrent OTP requests, a single write transaction). Returns (isochrone, h3_id, catchment_id) for every origin.
+        """
+        if not h3_ids:
+            return []
+
+        async def compute(keys):
+            conn = await self.db.run(self.db.connect)
+            try:
+                service = self.get_isochrone_service(conn)
+                results = await service.get_isochrones_async(city_id, [key[1] for key in keys], time_of_day, minutes)
+            finally:
+                await self.db.run(conn.close)
+            return dict(zip(keys, results))
+
+        #same keys as /catchment/, so an origin requested by both is only computed once
+        keys = [(int(city_id), h3_id, time_of_day, minutes) for h3_id in dict.fromkeys(h3_ids)]
+        found = await self.catchment_flights.do_many(keys, compute)
+        results = [found[key] for key in keys]
+
+        if self.engine is not None and self.engine.has_city(city_id):
+            await self.db.run(self.engine.ensure_origins, city_id, time_of_day, h3_ids)
+        return results
+
+    def catchment_geometry(self, catchment_id, isochrone, level, origin=None):
+        """GeoJSON bytes of the catchment at a detail level - all levels are encoded and cached on the first call"""
+        geometry = self.geometries.get(catchment_id, level)
+        if geometry is None:
+            variants = serialize.geometry_variants(isochrone)
+            self.geometries.put(catchment_id, variants, origin)
+            geometry = variants[level]
+        return geometry
+
+    def get_isochrone_service(self, conn):
+        return isc.IsochroneService(
+            otp_port=self.otp_port, pg_conn=conn, otp_host=self.otp_host, reference_date=self.otp_ref_date, otp_client=self.otp_client,
+            isochrone_backend=self.isochrone_backend
+        )
 
     def get_app(self):
         app = FastAPI()
+
+        async def parse_viewport(bbox, tiles):
+            #polyfilling a bbox is CPU work - kept off the event loop
+            try:
+                return await self.db.run(Viewport.parse, bbox, tiles)
+            except ValueError as e:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+        def with_tiles(response, viewport):
+            #lets the client keep track of the tiles it already has when the map is panned
+            if viewport is not None and isinstance(response, Response):
+                response.headers['X-H3-Tiles'] = ','.join(viewport.tiles)
+            return response
+
+        def streaming_response(items, ndjson):
+            """Chunked response of encoded items (see serialize.py) - one per line, or the usual JSON document sent in pieces"""
+            if ndjson:
+                return StreamingResponse(serialize.ndjson(items), media_type=serialize.NDJSON_MEDIA_TYPE)
+            return StreamingResponse(serialize.json_array(items), media_type='application/json')
+
+        async def in_chunks(rows):
+            for i in range(0, len(rows), self.db.stream_chunk_size):
+                yield rows[i:i + self.db.stream_chunk_size]
+
+        app.add_middleware(metrics.RequestMetrics, slow_request_ms=self.slow_request_ms)
+
+        @app.get("/metrics", include_in_schema=False)
+        async def get_metrics():
+            return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+        @app.on_event("startup")
+        async def open_pool():
+            await self.db.run(self.db.open)
+            await self.otp_client.open()
+            if self.engine is not None:
+                await self.db.run(self.engine.load)
+            if self.warmup:
+                started = time.perf_counter()
+                #/configuration is the first call of every front-end session
+                version = await self.get_data_version()
+                self.cache.put(('configuration', self._metadata_version), version, await build_configuration())
+                logger.info("Warm-up done in %.2fs", time.perf_counter() - started)
+
+        @app.on_event("shutdown")
+        async def close_pool():
+            await self.otp_client.close()
+            await self.db.run(self.db.close)
         
         class City(BaseModel):
             name: str
@@ -74,11 +318,10 @@ class backendApi:
         async def cities():
             """Returns a list cities available in the database.
             """
-            with self.get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT cityID, cityname FROM cities")
-                    data = cur.fetchall()
-                    print(data)
+            snapshot = await self.get_metadata()
+            if snapshot is not None:
+                return [{"id": c['id'], "name": c['name']} for c in snapshot['cities']]
+            data = await self.db.fetchall("SELECT cityID, cityname FROM cities", name="cities")
             citiesList = [{
                 "id": d[0], 
                 "name": d[1],                 
@@ -90,10 +333,10 @@ class backendApi:
         async def poi_categories():
             """Returns a list POI categories available in the database.
             """
-            with self.get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT DISTINCT category FROM pois")
-                    data = cur.fetchall()
+            snapshot = await self.get_metadata()
+            if snapshot is not None:
+                return snapshot['poi_categories']
+            data = await self.db.fetchall("SELECT DISTINCT category FROM pois", name="poi_categories")
             categories = [d[0] for d in data]
             return categories
 
@@ -101,20 +344,20 @@ class backendApi:
         async def times_of_day():
             """Returns a list of time of day selections (for catchment area calculations) available in the database.
             """
-            with self.get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT DISTINCT TImeOfDay FROM catchments")
-                    data = cur.fetchall()              
+            snapshot = await self.get_metadata()
+            if snapshot is not None:
+                return snapshot['times_of_day']
+            data = await self.db.fetchall("SELECT DISTINCT TImeOfDay FROM catchments", name="times_of_day")
             return [d[0] for d in data]
 
         @app.get("/demographics_categories", response_model=List[str])
         async def demographic_categories():
             """Returns a list of demographic segments available in the database.
             """
-            with self.get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("SELECT DISTINCT categorytype FROM h3demographics")
-                    data = cur.fetchall()              
+            snapshot = await self.get_metadata()
+            if snapshot is not None:
+                return snapshot['demographic_categories']
+            data = await self.db.fetchall("SELECT DISTINCT categorytype FROM h3demographics", name="demographics_categories")
             return [d[0] for d in data]
 
         class Configuration(BaseModel):
@@ -124,9 +367,14 @@ class backendApi:
             demographic_categories: List[str]
 
         @app.get("/configuration", response_model=Configuration)
-        async def configuration():
+        async def configuration(request: Request):
             """Returns the global configuration object that contains possible values the user can choose from in the front-end.
             """
+            #keyed by the snapshot version as well - a job may add a city without changing the data version
+            await self.get_metadata()
+            return await self.cached_response(request, ('configuration', self._metadata_version), build_configuration)
+
+        async def build_configuration():
             res = await asyncio.gather(
                 cities(),
                 times_of_day(),
@@ -137,7 +385,7 @@ class backendApi:
             labels = ['cities', 'times_of_day', 'poi_categories', 'demographic_categories']
             # res = [[{'id': 1, 'name': 'Atlanta'}], ['morning'], ['Schools and Kindergartners', 'Grocery stores and supermarkets', 'Cinemas and Theaters', 'Clinics and Hospitals', 'Restaurants', 'Vaccination centre'], ['Race', 'Age and Sex', 'Income', 'Origin', 'Vehicle Availability']]
             config_values = dict(zip(labels, res))
-            return config_values
+            return orjson.dumps(config_values)
 
         class coordinates(BaseModel):
             lat: float
@@ -155,31 +403,67 @@ class backendApi:
             data: List[POI]
 
         @app.get("/pois/{city_id}/{poi_category}", response_model = POIList)
-        async def get_pois_in_city(city_id: int, poi_category: str, native: bool = False, pois_to_exclude = []):
+        async def get_pois_in_city(
+            request: Request, city_id: int, poi_category: str, native: bool = False, pois_to_exclude = [], format: Optional[str] = None,
+            bbox: Optional[str] = None, tiles: Optional[str] = None, int_ids: bool = False, stream: bool = False
+        ):
             """Get all POIs of a given category in a city.
+            Use format=columnar (or Accept: application/vnd.h3columnar) to get the binary columnar layout described in columnar.py.
+            Use bbox=min_lon,min_lat,max_lon,max_lat or tiles=<comma-separated H3 cells> to get only the POIs in view (see viewport.py).
+            Use int_ids=true to get H3 ids as 64-bit integers instead of hex strings.
+            Use stream=true to get the same JSON sent in chunks as rows are read, or format=ndjson (or Accept: application/x-ndjson)
+            to get one POI per line.
             """
-            with self.get_db_connection() as conn:
-                with conn.cursor(cursor_factory=DictCursor) as cur:
-                    if pois_to_exclude:
-                        sql = 'SELECT id, h3id, name, lat, long, category FROM api_get_pois_for_city(%s, %s) WHERE h3id NOT IN %s'                    
-                        cur.execute(sql, (city_id, poi_category, tuple(pois_to_exclude)))
-                    else:
-                        sql = 'SELECT id, h3id, name, lat, long, category FROM api_get_pois_for_city(%s, %s)'                    
-                        cur.execute(sql, (city_id, poi_category))
-                    response = POIList.construct(data = [])
-                    data = cur.fetchall()                  
-                    for row in data:                        
-                        obj = dict(row)             
-                        #remap lat/long into coordinates
-                        obj['coords'] = coordinates(lat = row['lat'], long=row['long'])
-                        response.data.append(POI.construct(**obj))  
-            
+            viewport = await parse_viewport(bbox, tiles)
+            pois_to_exclude = h3ids.to_ints(pois_to_exclude)
+            if viewport is not None:
+                sql = """
+                SELECT pois.poiid AS id, pois.h3id, pois.name, pois.lat, pois.long, pois.category FROM pois
+                {}
+                JOIN cityh3map ON cityh3map.h3id = pois.h3id
+                WHERE cityh3map.cityid = %s AND pois.category = %s
+                """.format(viewport_join('pois.h3id'))
+                params = (*viewport.ranges(), city_id, poi_category)
+                if pois_to_exclude:
+                    sql += ' AND pois.h3id NOT IN %s'
+                    params += (tuple(pois_to_exclude), )
+                name = "pois_viewport"
+            else:
+                if pois_to_exclude:
+                    sql = 'SELECT id, h3id, name, lat, long, category FROM api_get_pois_for_city(%s, %s) WHERE h3id NOT IN %s'                    
+                    params = (city_id, poi_category, tuple(pois_to_exclude))
+                else:
+                    sql = 'SELECT id, h3id, name, lat, long, category FROM api_get_pois_for_city(%s, %s)'                    
+                    params = (city_id, poi_category)
+                name = "api_get_pois_for_city"
+
+            ndjson = serialize.wants_ndjson(request, format)
+            if not native and (ndjson or (stream and not columnar.wants_columnar(request, format))):
+                #rows are read from a server-side cursor and sent as they come, so memory does not grow with the city
+                return with_tiles(streaming_response(serialize.pois_items(self.db.stream(sql, params, name), int_ids), ndjson), viewport)
+            data = await self.db.fetchall(sql, params, name=name)
+
+            if not native and columnar.wants_columnar(request, format):
+                return with_tiles(Response(content=columnar.pois(data, int_ids), media_type=columnar.MEDIA_TYPE), viewport)
+
             if native:
-                return response
-            else:                       
-                return PydanticJSONResponse(content=response)
+                return build_poi_list(data)
+            else:
+                #same JSON as build_poi_list(data), without building a model per POI
+                return with_tiles(Response(content=serialize.pois_json(data, int_ids), media_type='application/json'), viewport)
 
         
+        def build_poi_list(data):
+            """Builds a POIList from (id, h3id, name, lat, long, category) rows"""
+            response = POIList.construct(data = [])
+            for row in data:
+                #remap lat/long into coordinates - lat/long stay as extra fields, as clients read them too
+                response.data.append(POI.construct(
+                    id = row[0], h3id = h3ids.to_hex(row[1]), name = row[2], category = row[5], coords = coordinates(lat = row[3], long = row[4]),
+                    lat = row[3], long = row[4]
+                ))
+            return response
+
         class H3Grid(BaseModel):
             h3id: str
             data: Optional[dict]
@@ -190,52 +474,170 @@ class backendApi:
             data: List[H3Grid]        
 
         @app.get("/demographics/{city_id}/{demographics_category}/{poi_category}/{time_of_day}", response_model=H3List)
-        async def get_city_demographics(city_id: int, demographics_category: str, poi_category: Optional[str], time_of_day: Optional[str], detailed: int = 0, native: bool = False):
+        async def get_city_demographics(
+            request: Request, city_id: int, demographics_category: str, poi_category: Optional[str], time_of_day: Optional[str], detailed: int = 0,
+            native: bool = False, format: Optional[str] = None,
+            resolution: Optional[int] = Query(None, ge=min(lod.RESOLUTIONS), le=lod.H3_RESOLUTION), zoom: Optional[int] = Query(None, ge=0, le=24),
+            bbox: Optional[str] = None, tiles: Optional[str] = None, int_ids: bool = False, stream: bool = False
+        ):
             """ Returns requested demographic data for all H3 cells in the city. 
             Use detailed=False to retrieve totals per h3cell for initial drawing and detailed=True to get details by category for tooltips.
+            Use format=columnar (or Accept: application/vnd.h3columnar) to get the binary columnar layout described in columnar.py.
+            Use resolution (or the map zoom level) to get data aggregated to coarser parent H3 cells when zoomed out -
+            populations are summed and accessibility is weighted by population. Only the precomputed resolutions
+            (demographics_lod.RESOLUTIONS, 5-8) and 9 (full detail) are accepted; cities without an up-to-date pyramid
+            are aggregated on the fly, which reads every resolution 9 cell.
+            Use bbox=min_lon,min_lat,max_lon,max_lat or tiles=<comma-separated H3 cells> to get only the cells in view (see viewport.py).
+            Use int_ids=true to get H3 ids as 64-bit integers instead of hex strings.
+            Use stream=true to get the same JSON sent in chunks as rows are read, or format=ndjson (or Accept: application/x-ndjson)
+            to get one cell per line. Streamed cells are ordered by h3id and are not cached.
             """
             detailed = (detailed != 0)            
-            with self.get_db_connection() as conn:                
-                with conn.cursor(cursor_factory=DictCursor) as cur:
-                    if detailed:
-                        # sql = 'SELECT h3id, groupname, population from api_get_demographics_for_city(%s, %s)'
-                        sql = """
-                        SELECT d.h3id AS h3id, d.groupname AS groupname, d.population AS population, a.accessibility AS accessibility
-                        FROM api_get_demographics_for_city(%s, %s) as d
-                        LEFT JOIN accessibility_stats a ON d.h3id = a.h3id
-                        AND a.cityid = %s AND a.categorytype = %s AND a.timeofday = %s and a.poi_category = %s;
-                        """
-                        cur.execute(sql, (city_id, demographics_category, city_id, demographics_category, time_of_day, poi_category))
-                    else:
-                        sql = "SELECT h3id, 'total' as groupname, SUM(population) as population from api_get_demographics_for_city(%s, %s) GROUP BY h3id"
-                        cur.execute(sql, (city_id, demographics_category))
-                    response = {}
-                    data = cur.fetchall()
-
-                    for row in data:                        
-                        #check if H3cell does not exist yet - create then
-                        id = row['h3id']
-                        if id not in response:
-                            total = 0 if detailed else row['population']
-                            data = {} if detailed else None
-                            h3_obj = H3Grid.construct(h3id = id, data = data, total=total)                            
-                            response[id] = h3_obj
-                        
-                        #add population data
-                        if detailed:
-                            groupname = row['groupname']
-                            population = row['population']
-                            accessibility = row["accessibility"]
-                            response[id].data[groupname] = population
-                            response[id].total += population
-                            response[id].accessibility = accessibility
-                    
-                    response = H3List.construct(data = list(response.values()))
-                        
+            if resolution is None and zoom is not None:
+                resolution = lod.resolution_for_zoom(zoom)
+            if resolution == lod.H3_RESOLUTION:
+                resolution = None
+            viewport = await parse_viewport(bbox, tiles)
             if native:
-                return response
-            else:                       
-                return PydanticJSONResponse(content=response)
+                return await build_city_demographics(city_id, demographics_category, poi_category, time_of_day, detailed, resolution, viewport)
+
+            ndjson = serialize.wants_ndjson(request, format)
+            if ndjson or (stream and not columnar.wants_columnar(request, format)):
+                if resolution is None:
+                    #rows are read from a server-side cursor and sent as they come, so memory does not grow with the city
+                    sql, params, name = demographics_query(city_id, demographics_category, poi_category, time_of_day, detailed, viewport, ordered=True)
+                    chunks = self.db.stream(sql, params, name)
+                else:
+                    #aggregated cells are a small fraction of the city - they are read at once and sent in chunks
+                    data = await fetch_city_demographics(city_id, demographics_category, poi_category, time_of_day, detailed, resolution, viewport)
+                    chunks = in_chunks(sorted(data, key=lambda r: r[0]))
+                return with_tiles(streaming_response(serialize.demographics_items(chunks, detailed, int_ids), ndjson), viewport)
+
+            if columnar.wants_columnar(request, format):
+                async def build():
+                    data = await fetch_city_demographics(city_id, demographics_category, poi_category, time_of_day, detailed, resolution, viewport)
+                    return columnar.demographics(data, detailed, int_ids)
+                media_type = columnar.MEDIA_TYPE
+            else:
+                async def build():
+                    #same JSON as build_city_demographics(), without building a model per cell
+                    data = await fetch_city_demographics(city_id, demographics_category, poi_category, time_of_day, detailed, resolution, viewport)
+                    return serialize.demographics_json(data, detailed, int_ids)
+                media_type = 'application/json'
+
+            key = (
+                'demographics', city_id, demographics_category, poi_category, time_of_day, detailed, media_type, resolution,
+                viewport.key() if viewport is not None else None, int_ids
+            )
+            return with_tiles(await self.cached_response(request, key, build, media_type), viewport)
+
+        async def fetch_city_demographics(city_id, demographics_category, poi_category, time_of_day, detailed, resolution=None, viewport=None):
+            """Returns (h3id, groupname, population, accessibility) rows - of parent cells if a resolution is given"""
+            if resolution is not None:
+                try:
+                    data = await fetch_lod_demographics(city_id, demographics_category, poi_category, time_of_day, detailed, resolution, viewport)
+                except UndefinedTable:
+                    data = None
+                if data:
+                    return data
+                #no pyramid for this city (yet) or its accessibility is stale - aggregate the full resolution rows, of whole parent cells
+                if viewport is not None:
+                    viewport = viewport.coarsen(resolution)
+                data = await fetch_city_demographics(city_id, demographics_category, poi_category, time_of_day, detailed, viewport=viewport)
+                return await self.db.run(lod.aggregate_rows, data, resolution, detailed)
+
+            sql, params, name = demographics_query(city_id, demographics_category, poi_category, time_of_day, detailed, viewport)
+            return await self.db.fetchall(sql, params, name=name)
+
+        def demographics_query(city_id, demographics_category, poi_category, time_of_day, detailed, viewport=None, ordered=False):
+            """(sql, params, name) of the full resolution rows - with ordered, detailed rows of a cell come one after the other"""
+            if viewport is not None:
+                if detailed:
+                    sql = """
+                    SELECT d.h3id, d.groupname, d.population, a.accessibility
+                    FROM h3demographics d
+                    {}
+                    LEFT JOIN accessibility_stats a ON d.h3id = a.h3id
+                    AND a.cityid = %s AND a.categorytype = %s AND a.timeofday = %s and a.poi_category = %s
+                    WHERE d.cityid = %s AND d.categorytype = %s
+                    """.format(viewport_join('d.h3id'))
+                    params = (*viewport.ranges(), city_id, demographics_category, time_of_day, poi_category, city_id, demographics_category)
+                else:
+                    sql = """
+                    SELECT d.h3id, 'total' as groupname, SUM(d.population) as population, NULL as accessibility
+                    FROM h3demographics d
+                    {}
+                    WHERE d.cityid = %s AND d.categorytype = %s GROUP BY d.h3id
+                    """.format(viewport_join('d.h3id'))
+                    params = (*viewport.ranges(), city_id, demographics_category)
+                name = "demographics_viewport"
+            elif detailed:
+                # sql = 'SELECT h3id, groupname, population from api_get_demographics_for_city(%s, %s)'
+                sql = """
+                SELECT d.h3id AS h3id, d.groupname AS groupname, d.population AS population, a.accessibility AS accessibility
+                FROM api_get_demographics_for_city(%s, %s) as d
+                LEFT JOIN accessibility_stats a ON d.h3id = a.h3id
+                AND a.cityid = %s AND a.categorytype = %s AND a.timeofday = %s and a.poi_category = %s
+                """
+                params = (city_id, demographics_category, city_id, demographics_category, time_of_day, poi_category)
+                name = "api_get_demographics_for_city"
+            else:
+                sql = "SELECT h3id, 'total' as groupname, SUM(population) as population, NULL as accessibility from api_get_demographics_for_city(%s, %s) GROUP BY h3id"
+                params = (city_id, demographics_category)
+                name = "api_get_demographics_for_city"
+
+            if detailed and ordered:
+                sql += " ORDER BY d.h3id"
+            return sql, params, name
+
+        async def fetch_lod_demographics(city_id, demographics_category, poi_category, time_of_day, detailed, resolution, viewport=None):
+            """Same as fetch_city_demographics(), from the precomputed pyramid (see demographics_lod.py).
+            Detailed rows are only read while the pyramid's accessibility is up to date - no rows otherwise.
+            """
+            join = viewport_join('d.h3id') if viewport is not None else ''
+            ranges = tuple(viewport.ranges(resolution)) if viewport is not None else ()
+            if detailed:
+                sql = """
+                SELECT d.h3id, d.groupname, d.population, a.accessibility
+                FROM demographics_lod d
+                {}
+                LEFT JOIN accessibility_lod a ON a.cityid = d.cityid AND a.resolution = d.resolution AND a.h3id = d.h3id
+                AND a.categorytype = d.categorytype AND a.timeofday = %s AND a.poi_category = %s
+                WHERE d.cityid = %s AND d.resolution = %s AND d.categorytype = %s
+                AND NOT EXISTS (SELECT 1 FROM lod_builds b WHERE b.cityid = d.cityid AND b.accessibility_stale)
+                """.format(join)
+                return await self.db.fetchall(sql, (*ranges, time_of_day, poi_category, city_id, resolution, demographics_category), name="demographics_lod")
+            else:
+                sql = """
+                SELECT d.h3id, 'total' as groupname, SUM(d.population) as population, NULL as accessibility FROM demographics_lod d
+                {}
+                WHERE d.cityid = %s AND d.resolution = %s AND d.categorytype = %s GROUP BY d.h3id
+                """.format(join)
+                return await self.db.fetchall(sql, (*ranges, city_id, resolution, demographics_category), name="demographics_lod")
+
+        async def build_city_demographics(city_id, demographics_category, poi_category, time_of_day, detailed, resolution=None, viewport=None):
+            data = await fetch_city_demographics(city_id, demographics_category, poi_category, time_of_day, detailed, resolution, viewport)
+            response = {}
+
+            for row in data:                        
+                #check if H3cell does not exist yet - create then
+                id = row[0]
+                if id not in response:
+                    total = 0 if detailed else row[2]
+                    h3_data = {} if detailed else None
+                    h3_obj = H3Grid.construct(h3id = h3ids.to_hex(id), data = h3_data, total=total)                            
+                    response[id] = h3_obj
+                
+                #add population data
+                if detailed:
+                    groupname = row[1]
+                    population = row[2]
+                    accessibility = row[3]
+                    response[id].data[groupname] = population
+                    response[id].total += population
+                    response[id].accessibility = accessibility
+            
+            return H3List.construct(data = list(response.values()))
 
         
         class MultiPolygon(BaseModel):
@@ -243,6 +645,12 @@ class backendApi:
             coordinates: List[List[List[Tuple[float, float]]]]
 
         
+        class GeometryDetail(str, Enum):
+            full = 'full'
+            high = 'high'
+            medium = 'medium'
+            low = 'low'
+
         class CatchmentArea(BaseModel):
             origin_h3id: str            
             population_total: float            
@@ -251,26 +659,90 @@ class backendApi:
             
 
         @app.get("/catchment/{city_id}/{h3_id}", response_model = CatchmentArea)
-        async def get_catchment_details(city_id, h3_id, time_of_day, demographics_category):
-            """ Returns catchment area geometry and associated population details"""
-            with self.get_alchemy_engine().connect() as conn:
-                service = isc.IsochroneService(otp_port=self.otp_port, pg_conn=self.get_alchemy_engine().connect(), otp_host=self.otp_host, reference_date=self.otp_ref_date)    
-                isochrone, origin_h3id, catchment_id = service.get_isochrone(city_id = city_id, h3_id = h3_id, time=time_of_day)
-                
-                with conn.connection.cursor(cursor_factory=DictCursor) as cur:
-                    sql = 'SELECT groupname, population FROM api_get_demographics_for_catchment(%s, %s)'            
-                    cur.execute(sql, (demographics_category, catchment_id))
-                    data = cur.fetchall()                    
+        async def get_catchment_details(city_id, h3_id, time_of_day, demographics_category, detail: GeometryDetail = GeometryDetail.full):
+            """ Returns catchment area geometry and associated population details.
+            detail rounds the coordinates and simplifies the geometry for display (full: as stored).
+            """
+            async def compute():
+                conn = await self.db.run(self.db.connect)
+                try:
+                    service = self.get_isochrone_service(conn)
+                    return await service.get_isochrone_async(city_id = city_id, h3_id = h3_id, time=time_of_day)
+                finally:
+                    await self.db.run(conn.close)
+
+            h3_id = h3ids.to_int(h3_id)
+            key = (int(city_id), h3_id, time_of_day, 30)
+            #a catchment already in the geometry cache is not read from the database again
+            catchment_id = self.geometries.catchment_id(key)
+            geometry = self.geometries.get(catchment_id, detail.value) if catchment_id is not None else None
+            if geometry is None:
+                isochrone, _, catchment_id = await self.catchment_flights.do(key, compute)
+                geometry = self.catchment_geometry(catchment_id, isochrone, detail.value, key)
+
+            sql = 'SELECT groupname, population FROM api_get_demographics_for_catchment(%s, %s)'            
+            data = await self.db.fetchall(sql, (demographics_category, catchment_id), dict_cursor=True, name="api_get_demographics_for_catchment")
                                 
             population_details = {row['groupname']: row['population'] for row in data}
-            population_total = sum(population_details.values())
-            area = CatchmentArea.construct(
-                geometry = mapping(isochrone),                
-                origin_h3id = origin_h3id,
-                population_total = population_total,
-                population_detail = population_details,
-            )
-            return PydanticJSONResponse(content=area)
+            return PydanticJSONResponse(content=serialize.catchment_json(h3_id, population_details, geometry))
+
+        class CatchmentsRequest(BaseModel):
+            city_id: int
+            h3_ids: List[str]
+            time_of_day: str
+            demographics_category: str
+            union: bool = False
+            detail: GeometryDetail = GeometryDetail.full
+
+        class CatchmentUnion(BaseModel):
+            population_total: float
+            population_detail: dict
+            geometry: MultiPolygon
+
+        class CatchmentList(BaseModel):
+            data: List[CatchmentArea]
+            union: Optional[CatchmentUnion]
+
+        @app.post("/catchments", response_model = CatchmentList)
+        async def get_catchments(catchments_request: CatchmentsRequest = Body(..., embed=False)):
+            """Batch version of /catchment - returns geometry and population details for many origins at once
+            (missing catchments are created in one round). With union=true, also returns the union of all catchments
+            and the population living in it (every cell counted once).
+            """
+            city_id = catchments_request.city_id
+            category = catchments_request.demographics_category
+            level = catchments_request.detail.value
+            results = await self.ensure_catchments(city_id, h3ids.to_ints(catchments_request.h3_ids), catchments_request.time_of_day)
+            catchment_ids = [r[2] for r in results]
+
+            sql = """
+            SELECT c.catchmentid, d.groupname, d.population
+            FROM unnest(%s::bigint[]) AS c(catchmentid), LATERAL api_get_demographics_for_catchment(%s, c.catchmentid) AS d
+            """
+            data = await self.db.fetchall(sql, (catchment_ids, category), name="api_get_demographics_for_catchment")
+            details = {}
+            for catchment_id, groupname, population in data:
+                details.setdefault(catchment_id, {})[groupname] = population
+
+            catchments = [
+                serialize.catchment_json(
+                    origin_h3id, details.get(catchment_id, {}),
+                    self.catchment_geometry(catchment_id, isochrone, level, (city_id, origin_h3id, catchments_request.time_of_day, 30))
+                )
+                for isochrone, origin_h3id, catchment_id in results
+            ]
+
+            if catchments_request.union and results:
+                sql = """
+                SELECT groupname, SUM(population) FROM h3demographics
+                WHERE cityid = %s AND categorytype = %s AND h3id IN (SELECT h3id FROM catchmenth3map WHERE catchmentid = ANY(%s))
+                GROUP BY groupname
+                """
+                data = await self.db.fetchall(sql, (city_id, category, catchment_ids), name="catchment_union_demographics")
+                union = unary_union([r[0] for r in results])
+                population_details = {r[0]: r[1] for r in data}
+                return PydanticJSONResponse(content=serialize.catchment_list_json(catchments, population_details, serialize.geometry_json(union, level)))
+            return PydanticJSONResponse(content=serialize.catchment_list_json(catchments))
 
         class CityStats(BaseModel):
             index_total: float
@@ -279,6 +751,7 @@ class backendApi:
 
         @app.get("/city_stats/{city_id}", response_model = CityStats)
         async def get_city_accessibility_statistics(
+            request: Request,
             city_id, 
             demographics_category, 
             time_of_day, 
@@ -287,16 +760,32 @@ class backendApi:
             pois_removed = []
         ):  
             """Returns overall city accessibility statistics and a breakdown by demographics category"""          
-            with self.get_db_connection() as conn:                
-                with conn.cursor(cursor_factory=DictCursor) as cur:                    
-                    sql = 'SELECT groupn, metric, population FROM api_get_city_stats(%s, %s, %s, %s, %s, %s)'                    
-                    cur.execute(sql, 
-                    (city_id, poi_category, time_of_day, demographics_category, pois_removed, pois_added))                    
-                    data = cur.fetchall()
-                    details = {d['groupn'] : d['metric'] for d in data}
-                    total = sum(d['metric'] * d['population'] for d in data) / sum([d['population'] for d in data])
+            if request is None:
+                return await build_city_accessibility_statistics(city_id, demographics_category, time_of_day, poi_category, pois_added, pois_removed)
 
-            
+            async def build():
+                stats = await build_city_accessibility_statistics(city_id, demographics_category, time_of_day, poi_category, pois_added, pois_removed)
+                return stats.json().encode()
+
+            key = ('city_stats', city_id, demographics_category, time_of_day, poi_category, tuple(pois_added or ()), tuple(pois_removed or ()))
+            return await self.cached_response(request, key, build)
+
+        async def build_city_accessibility_statistics(city_id, demographics_category, time_of_day, poi_category, pois_added, pois_removed):
+            pois_added, pois_removed = h3ids.to_ints(pois_added), h3ids.to_ints(pois_removed)
+            if self.engine is not None and self.engine.has_city(city_id):
+                data = await self.db.run(
+                    self.engine.city_stats, city_id, poi_category, time_of_day, demographics_category, pois_removed, pois_added
+                )
+            else:
+                sql = 'SELECT groupn, metric, population FROM api_get_city_stats(%s, %s, %s, %s, %s, %s)'                    
+                data = await self.db.fetchall(sql, 
+                    (city_id, poi_category, time_of_day, demographics_category, pois_removed, pois_added), name="api_get_city_stats")
+            return build_city_stats(data)
+
+        def build_city_stats(data):
+            #rows are (groupn, metric, population)
+            details = {d[0] : d[1] for d in data}
+            total = sum(d[1] * d[2] for d in data) / sum([d[2] for d in data])
             return CityStats(index_total = total, index_detail = details)
 
         class ConfigSet(BaseModel):
@@ -317,10 +806,22 @@ class backendApi:
             added: Optional[List[str]]
             deleted: Optional[List[str]]
         
+        class PoiListChanges(BaseModel):
+            #entries appended to poi_list.added/deleted since the previous call
+            appended: Optional[UpdatedPois]
+            #entries taken off poi_list.added/deleted since the previous call
+            dropped: Optional[UpdatedPois]
+
         class UpdatePack(BaseModel):
             changed: List[DataFields]
             config: ConfigSet
             poi_list: UpdatedPois
+            #scenario returned by the previous call - with poi_changes, only those are applied to its state
+            scenario_id: Optional[str]
+            poi_changes: Optional[PoiListChanges]
+            #limits demographics and POIs to the map view - [min_lon, min_lat, max_lon, max_lat] or H3 cells (see viewport.py)
+            bbox: Optional[List[float]]
+            tiles: Optional[List[str]]
 
         class CityData(BaseModel):
             demographics: Optional[H3List]
@@ -328,76 +829,117 @@ class backendApi:
             stats: Optional[CityStats]
             lat: float
             long: float
+            scenario_id: Optional[str]
 
 
         @app.post("/city_data/", response_model=CityData)
         async def get_city_data(update_pack: UpdatePack = Body(..., embed=False)):
+            """Returns the data the front-end needs after a change of configuration or of the added/removed POIs.
+            For cities loaded into the engine, the response carries a scenario_id - sending it back with the next call,
+            along with poi_changes, makes the server apply only the POIs that changed since then instead of the whole
+            added/deleted lists (which are still sent, in case the scenario has expired).
+            """
             queries = {}
             city_id = update_pack.config.city_id
+            bbox = ','.join(str(v) for v in update_pack.bbox) if update_pack.bbox else None
+            tiles = ','.join(update_pack.tiles) if update_pack.tiles else None
+            viewport = await parse_viewport(bbox, tiles)
+            use_scenario = self.engine is not None and self.engine.has_city(city_id)
+            #H3 ids are integers from here on
+            added, deleted = h3ids.to_ints(update_pack.poi_list.added), h3ids.to_ints(update_pack.poi_list.deleted)
+            changes = None
+            if use_scenario and update_pack.scenario_id and update_pack.poi_changes is not None:
+                appended = update_pack.poi_changes.appended or UpdatedPois()
+                dropped = update_pack.poi_changes.dropped or UpdatedPois()
+                #(added, unadded, removed, restored) - see Scenario.edit
+                changes = (
+                    h3ids.to_ints(appended.added), h3ids.to_ints(dropped.added),
+                    h3ids.to_ints(appended.deleted), h3ids.to_ints(dropped.deleted)
+                )
 
             if DataFields.demographics in update_pack.changed:
                 queries['demographics'] = get_city_demographics(
+                    request=None,
                     city_id=city_id, 
                     demographics_category=update_pack.config.demographic_category, 
                     poi_category=update_pack.config.poi_category,
                     time_of_day=update_pack.config.time_of_day,
                     detailed=True,
-                    native=True
+                    native=True,
+                    resolution=None,
+                    zoom=None,
+                    bbox=bbox,
+                    tiles=tiles
                 )
             
-            if DataFields.pois in update_pack.changed or DataFields.poi_remove in update_pack.changed:
+            wants_pois = DataFields.pois in update_pack.changed or DataFields.poi_remove in update_pack.changed
+            if wants_pois and not use_scenario:
                 queries['pois'] = get_pois_in_city(
+                    request = None,
                     city_id = city_id, 
                     poi_category= update_pack.config.poi_category,
                     native=True,
-                    pois_to_exclude=update_pack.poi_list.deleted
+                    pois_to_exclude=deleted,
+                    bbox=bbox,
+                    tiles=tiles
                 )
                         
-            if update_pack.changed or update_pack.poi_list.added or update_pack.poi_list.deleted:
+            wants_stats = update_pack.changed or added or deleted
+            if wants_stats and not use_scenario:
                 queries['stats'] = get_city_accessibility_statistics(
+                    request=None,
                     city_id=city_id, 
                     demographics_category=update_pack.config.demographic_category, 
                     time_of_day = update_pack.config.time_of_day, 
                     poi_category = update_pack.config.poi_category,
-                    pois_added=update_pack.poi_list.added,
-                    pois_removed=update_pack.poi_list.deleted
+                    pois_added=added,
+                    pois_removed=deleted
                 )
 
             #check if we have isochrones for all POIs that were added
             #issue requests to create them on the fly as needed
-            if update_pack.poi_list.added:
+            #earlier entries of the added list had their catchments created by earlier calls of the scenario
+            new_origins = changes[0] if changes is not None else added
+            if new_origins:
                 sql = """
-                SELECT h3id FROM (SELECT unnest(%s) as h3id) as a 
-                LEFT JOIN catchments ON h3id = originh3id  AND timeofday = %s
-                WHERE catchmentid IS NULL"""
-                with self.get_db_connection() as conn:                
-                    with conn.cursor(cursor_factory=DictCursor) as cur:
-                        cur.execute(sql, (update_pack.poi_list.added, update_pack.config.time_of_day))
-                        new_pois = cur.fetchall()
-                        new_catchs = []
-                        
-                        for p in new_pois:
-                            new_catchs.append(
-                                get_catchment_details(
-                                    city_id = update_pack.config.city_id,
-                                    h3_id= p[0],
-                                    time_of_day= update_pack.config.time_of_day,
-                                    demographics_category=update_pack.config.demographic_category
-                                )
-                            )
-                        
-                await asyncio.gather(*new_catchs)
+                SELECT h3id FROM (SELECT unnest(%s::bigint[]) as h3id) as a 
+                LEFT JOIN catchments ON h3id = originh3id  AND timeofday = %s AND {}
+                WHERE catchmentid IS NULL""".format(accessibility_stats.STATS_CATCHMENTS)
+                new_pois = await self.db.fetchall(sql, (new_origins, update_pack.config.time_of_day), name="missing_catchments")
+                await self.ensure_catchments(city_id, [p[0] for p in new_pois], update_pack.config.time_of_day)
                             
             results = await asyncio.gather(*queries.values())            
             dict_results = dict(zip(queries.keys(), results))
 
-            with self.get_db_connection() as conn:                
-                with conn.cursor(cursor_factory=DictCursor) as cur:                    
-                    sql = 'SELECT boundingbox FROM cities WHERE cityid = %s'
-                    cur.execute(sql, (city_id, ))
-                    bbox = cur.fetchone()[0]
-                    dict_results['long'] = (bbox[0] + bbox[2]) / 2
-                    dict_results['lat'] = (bbox[1] + bbox[3]) / 2
+            if use_scenario:
+                scenario, data = await self.db.run(
+                    self.update_scenario,
+                    update_pack.scenario_id,
+                    city_id,
+                    update_pack.config.time_of_day,
+                    update_pack.config.demographic_category,
+                    update_pack.config.poi_category,
+                    deleted,
+                    added,
+                    changes,
+                )
+                dict_results['scenario_id'] = scenario.id
+                if wants_stats:
+                    dict_results['stats'] = build_city_stats(data)
+                if wants_pois:
+                    #the city's POIs are fetched once per scenario and filtered in memory afterwards
+                    if scenario.pois is None:
+                        scenario.pois = await self.db.fetchall(
+                            'SELECT id, h3id, name, lat, long, category FROM api_get_pois_for_city(%s, %s)',
+                            (city_id, update_pack.config.poi_category),
+                            name="api_get_pois_for_city"
+                        )
+                    removed = scenario.removed
+                    dict_results['pois'] = build_poi_list([
+                        p for p in scenario.pois if p[1] not in removed and (viewport is None or viewport.contains(p[1]))
+                    ])
+
+            dict_results['lat'], dict_results['long'] = await self.city_center(city_id)
 
             return PydanticJSONResponse(content=CityData.construct(** dict_results))
             
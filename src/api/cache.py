@@ -0,0 +1,108 @@
+import hashlib
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """LRU cache of serialized responses with a memory budget.
+
+    Entries are stored together with the data version they were computed for - an entry from an older
+    version is treated as a miss and dropped.
+    """
+
+    def __init__(self, max_bytes) -> None:
+        self.max_bytes = int(max_bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def etag(key, version):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        return '"{}-{}"'.format(version, digest)
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, version, body):
+        if len(body) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (version, body)
+        self.size += len(body)
+        #evict least recently used entries until we are within budget
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        _, body = self._entries.pop(key)
+        self.size -= len(body)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+
+class GeometryCache:
+    """LRU cache of encoded catchment geometries with a memory budget.
+
+    Entries are keyed by catchment id and hold the GeoJSON bytes of every detail level (see serialize.GEOMETRY_LEVELS).
+    A catchment's geometry does not change once written, so entries do not depend on the data version.
+    Origins (city id, h3 id, time of day, minutes) are mapped to their catchment id as well, so a cached catchment
+    is served without reading it from the database.
+    """
+
+    def __init__(self, max_bytes, max_origins=100000) -> None:
+        self.max_bytes = int(max_bytes)
+        self.max_origins = int(max_origins)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._origins = OrderedDict()
+
+    def catchment_id(self, origin):
+        return self._origins.get(origin)
+
+    def get(self, catchment_id, level):
+        variants = self._entries.get(catchment_id)
+        if variants is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(catchment_id)
+        self.hits += 1
+        return variants[level]
+
+    def put(self, catchment_id, variants, origin=None):
+        if origin is not None:
+            self._origins[origin] = catchment_id
+            self._origins.move_to_end(origin)
+            if len(self._origins) > self.max_origins:
+                self._origins.popitem(last=False)
+        size = sum(len(body) for body in variants.values())
+        if size > self.max_bytes:
+            return
+        if catchment_id in self._entries:
+            self._remove(catchment_id)
+        self._entries[catchment_id] = variants
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, catchment_id):
+        variants = self._entries.pop(catchment_id)
+        self.size -= sum(len(body) for body in variants.values())
+
+    def clear(self):
+        self._entries.clear()
+        self._origins.clear()
+        self.size = 0
@@ -0,0 +1,142 @@
+"""Columnar binary encoding of list responses (H3 grids, POI lists).
+
+Layout (all integers little-endian):
+
+    bytes 0-7     magic b'H3COL' + version byte + 2 padding bytes
+    bytes 8-11    uint32 - length of the JSON header in bytes
+    bytes 12-     JSON header, padded with spaces to a multiple of 8 bytes
+    ...           column buffers, each starting at a multiple of 8 bytes (offsets are relative to the start of the buffers)
+
+The header is {"rows": n, "columns": [{"name": ..., "dtype": ..., "buffers": [[offset, length], ...]}, ...]}.
+dtype is a numpy type string ('<f8', '<i4', 'S15', '<u8' for H3 ids requested as integers, ...) for fixed-width columns with a single buffer.
+dtype 'utf8' marks variable-length strings stored Arrow-style in two buffers: int32 offsets (n + 1 of them) and the UTF-8 data.
+Float columns use NaN for missing values.
+
+In the browser every fixed-width column maps directly onto a typed array, e.g. new Float64Array(buffer, start + offset, rows).
+"""
+import struct
+
+import numpy as np
+import orjson
+
+import h3ids
+
+MEDIA_TYPE = 'application/vnd.h3columnar'
+MAGIC = b'H3COL\x01\x00\x00'
+
+
+def wants_columnar(request, format=None):
+    if format is not None:
+        return format == 'columnar'
+    return request is not None and MEDIA_TYPE in request.headers.get('accept', '')
+
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+def encode(columns, rows):
+    """Encodes a list of (name, numpy array or list of str) columns into the binary layout above"""
+    header_columns = []
+    buffers = []
+    offset = 0
+
+    def add_buffer(data):
+        nonlocal offset
+        start = offset
+        buffers.append(data)
+        buffers.append(b'\x00' * _pad(len(data)))
+        offset += len(data) + _pad(len(data))
+        return [start, len(data)]
+
+    for name, values in columns:
+        if isinstance(values, np.ndarray):
+            values = np.ascontiguousarray(values)
+            if values.dtype.kind in 'fiu':
+                values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+            header_columns.append({'name': name, 'dtype': values.dtype.str, 'buffers': [add_buffer(values.tobytes())]})
+        else:
+            encoded = [(v or '').encode('utf8') for v in values]
+            offsets = np.zeros(len(encoded) + 1, dtype='<i4')
+            np.cumsum([len(v) for v in encoded], out=offsets[1:])
+            header_columns.append({
+                'name': name,
+                'dtype': 'utf8',
+                'buffers': [add_buffer(offsets.tobytes()), add_buffer(b''.join(encoded))]
+            })
+
+    header = orjson.dumps({'rows': rows, 'columns': header_columns})
+    header += b' ' * _pad(len(MAGIC) + 4 + len(header))
+    return b''.join([MAGIC, struct.pack('<I', len(header)), header] + buffers)
+
+
+def h3id_column(h3_ids, int_ids=False):
+    """H3 ids as 15 byte hex strings, or as uint64 if int_ids"""
+    if int_ids:
+        return np.array(h3ids.to_ints(h3_ids), dtype='<u8')
+    return np.array(h3ids.to_hexes(h3_ids), dtype='S15')
+
+
+def demographics(rows, detailed, int_ids=False):
+    """Encodes demographics rows (h3id, groupname, population, accessibility) straight from the cursor.
+    Detailed rows come in long format and are pivoted into one population column per group.
+    """
+    if not detailed:
+        totals = np.array([r[2] for r in rows], dtype='<f8')
+        return encode([('h3id', h3id_column([r[0] for r in rows], int_ids)), ('total', totals)], len(rows))
+
+    cell_index = {}
+    group_index = {}
+    for r in rows:
+        cell_index.setdefault(r[0], len(cell_index))
+        group_index.setdefault(r[1], len(group_index))
+
+    cells = np.fromiter((cell_index[r[0]] for r in rows), dtype=np.int64, count=len(rows))
+    groups = np.fromiter((group_index[r[1]] for r in rows), dtype=np.int64, count=len(rows))
+    populations = np.array([r[2] for r in rows], dtype='<f8')
+    accessibility = np.array([r[3] for r in rows], dtype='<f8')
+
+    matrix = np.zeros((len(cell_index), len(group_index)), dtype='<f8')
+    np.add.at(matrix, (cells, groups), populations)
+    cell_accessibility = np.full(len(cell_index), np.nan, dtype='<f8')
+    cell_accessibility[cells] = accessibility
+
+    columns = [
+        ('h3id', h3id_column(list(cell_index), int_ids)),
+        ('total', matrix.sum(axis=1)),
+        ('accessibility', cell_accessibility),
+    ]
+    columns += [('group:{}'.format(name), matrix[:, i]) for name, i in group_index.items()]
+    return encode(columns, len(cell_index))
+
+
+def pois(rows, int_ids=False):
+    """Encodes POI rows (id, h3id, name, lat, long, category) straight from the cursor"""
+    columns = [
+        ('id', np.array([r[0] for r in rows], dtype='<i8')),
+        ('h3id', h3id_column([r[1] for r in rows], int_ids)),
+        ('name', [r[2] for r in rows]),
+        ('lat', np.array([r[3] for r in rows], dtype='<f8')),
+        ('long', np.array([r[4] for r in rows], dtype='<f8')),
+        ('category', [r[5] for r in rows]),
+    ]
+    return encode(columns, len(rows))
+
+
+def decode(body):
+    """Decodes the binary layout back into a dict of columns (numpy arrays or lists of str)"""
+    assert body[:len(MAGIC)] == MAGIC, "Not a columnar response"
+    (header_length, ) = struct.unpack('<I', body[8:12])
+    header = orjson.loads(body[12:12 + header_length])
+    start = 12 + header_length
+    columns = {}
+    for column in header['columns']:
+        if column['dtype'] == 'utf8':
+            (o_start, o_len), (d_start, d_len) = column['buffers']
+            offsets = np.frombuffer(body, dtype='<i4', count=o_len // 4, offset=start + o_start)
+            data = body[start + d_start:start + d_start + d_len]
+            columns[column['name']] = [data[offsets[i]:offsets[i + 1]].decode('utf8') for i in range(len(offsets) - 1)]
+        else:
+            b_start, b_len = column['buffers'][0]
+            columns[column['name']] = np.frombuffer(body[start + b_start:start + b_start + b_len], dtype=column['dtype'])
+    return columns
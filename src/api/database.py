@@ -0,0 +1,132 @@
+import itertools
+import logging
+from contextlib import contextmanager
+
+from psycopg2.extras import DictCursor
+from sqlalchemy import create_engine, event
+from starlette.concurrency import run_in_threadpool
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DatabasePool:
+    """A pool of Postgres connections shared by all API endpoints.
+
+    A single SQLAlchemy engine owns the pool, so both raw psycopg2 cursors (used by the endpoints)
+    and SQLAlchemy connections (used by IsochroneService) are checked out of the same set of connections.
+    psycopg2 calls are blocking, so the async helpers run them in the threadpool to keep the event loop free.
+    """
+
+    def __init__(self, db_params, min_size=2, max_size=10, timeout=30, stream_chunk_size=5000, warmup_sql=None) -> None:
+        assert int(min_size) <= int(max_size), "Pool min_size must not be larger than max_size"
+        self.db_params = db_params
+        self.min_size = int(min_size)
+        self.max_size = int(max_size)
+        self.timeout = float(timeout)
+        self.stream_chunk_size = int(stream_chunk_size)
+        #statements run on every new connection before it is handed out
+        self.warmup_sql = warmup_sql or []
+        self._cursor_ids = itertools.count()
+        self.engine = None
+
+    def open(self):
+        conn_string = 'postgresql://{user}:{password}@{host}:{port}/{dbname}'.format(**self.db_params)
+        self.engine = create_engine(
+            conn_string,
+            echo=False,
+            future=True,
+            pool_size=self.min_size,
+            max_overflow=self.max_size - self.min_size,
+            pool_timeout=self.timeout,
+            pool_pre_ping=True,
+        )
+        if self.warmup_sql:
+            event.listen(self.engine, 'connect', self._warm_up)
+        #open min_size connections upfront so that the first requests do not pay for the handshake
+        conns = [self.engine.raw_connection() for _ in range(self.min_size)]
+        for conn in conns:
+            conn.close()
+
+    def _warm_up(self, dbapi_connection, connection_record):
+        cur = dbapi_connection.cursor()
+        try:
+            for sql in self.warmup_sql:
+                try:
+                    cur.execute(sql)
+                    dbapi_connection.commit()
+                except Exception as e:
+                    dbapi_connection.rollback()
+                    logger.warning("Connection warm-up statement failed (%s): %s", sql, e)
+        finally:
+            cur.close()
+
+    def close(self):
+        if self.engine is not None:
+            self.engine.dispose()
+            self.engine = None
+
+    def connect(self):
+        """Returns a pooled SQLAlchemy connection (returned to the pool on close)"""
+        assert self.engine is not None, "Database pool is not open"
+        return self.engine.connect()
+
+    @contextmanager
+    def cursor(self, dict_cursor=False):
+        """Checks out a pooled psycopg2 connection and yields a cursor on it.
+        The transaction is committed on success and rolled back on error.
+        """
+        assert self.engine is not None, "Database pool is not open"
+        conn = self.engine.raw_connection()
+        try:
+            cursor_factory = DictCursor if dict_cursor else None
+            with conn.cursor(cursor_factory=cursor_factory) as cur:
+                yield cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _fetchall(self, sql, params=None, dict_cursor=False, name='other'):
+        with metrics.sql(name), self.cursor(dict_cursor) as cur:
+            cur.execute(sql, params)
+            return cur.fetchall()
+
+    def _fetchone(self, sql, params=None, dict_cursor=False, name='other'):
+        with metrics.sql(name), self.cursor(dict_cursor) as cur:
+            cur.execute(sql, params)
+            return cur.fetchone()
+
+    async def fetchall(self, sql, params=None, dict_cursor=False, name='other'):
+        """Runs the query in the threadpool and returns all rows - `name` labels its timing in the sql_seconds metric"""
+        return await run_in_threadpool(self._fetchall, sql, params, dict_cursor, name)
+
+    async def fetchone(self, sql, params=None, dict_cursor=False, name='other'):
+        return await run_in_threadpool(self._fetchone, sql, params, dict_cursor, name)
+
+    async def stream(self, sql, params=None, name='other', chunk_size=None):
+        """Runs the query on a named (server-side) cursor and yields its rows in lists of at most chunk_size,
+        so only one chunk is held in memory at a time. The connection is kept until the generator is exhausted or closed.
+        """
+        assert self.engine is not None, "Database pool is not open"
+        chunk_size = chunk_size or self.stream_chunk_size
+        conn = await run_in_threadpool(self.engine.raw_connection)
+        try:
+            cur = conn.cursor(name='stream_{}'.format(next(self._cursor_ids)))
+            with metrics.sql(name):
+                await run_in_threadpool(cur.execute, sql, params)
+                rows = await run_in_threadpool(cur.fetchmany, chunk_size)
+            while rows:
+                yield rows
+                rows = await run_in_threadpool(cur.fetchmany, chunk_size)
+        finally:
+            #the pool rolls back on return, which also closes the cursor (e.g. when the client went away mid-stream) -
+            #round-trips to the server, so off the event loop like every other call
+            await run_in_threadpool(conn.close)
+
+    async def run(self, func, *args, **kwargs):
+        """Runs a blocking function (e.g. one that uses connect() or cursor()) in the threadpool"""
+        return await run_in_threadpool(func, *args, **kwargs)
@@ -0,0 +1,151 @@
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+
+class Scenario():
+    """What-if state of one /city_data/ session: POIs removed from/added to a city for one configuration.
+
+    Holds the (unmasked) accessibility vector over the city cells and the per-group sums of accessibility * population,
+    so an edit only applies the catchments of the POIs that changed since the previous request.
+    """
+
+    def __init__(self, city, timeofday, categorytype, poi_category):
+        self.id = uuid.uuid4().hex
+        self.city = city
+        self.config = (timeofday, categorytype, poi_category)
+        #the catchment set the state was computed from - it is replaced when the engine loads new catchments
+        self.catchments = city.catchments.get(timeofday)
+        base, self.mask = city.base_accessibility(timeofday, categorytype, poi_category)
+        self.accessibility = base.copy()
+        self.weighted = np.where(self.mask, base, 0) @ city.populations[categorytype][1]
+        self.removed = set()
+        self.added = Counter()
+        #POI rows (id, h3id, name, lat, long, category) of the city, fetched once per scenario
+        self.pois = None
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def matches(self, city, timeofday, categorytype, poi_category):
+        return (
+            self.city is city and self.config == (timeofday, categorytype, poi_category)
+            and self.follow(city.catchments.get(timeofday))
+        )
+
+    def follow(self, catchments):
+        """True if the state is valid for the catchment set - a set that only appends catchments (ensure_origins)
+        is adopted if the new catchments change neither the base accessibility nor the origins already added.
+        """
+        old = self.catchments
+        if catchments is old:
+            return True
+        if old is None or catchments is None or len(catchments.ids) < len(old.ids):
+            return False
+        n = len(old.ids)
+        if not np.array_equal(catchments.ids[:n], old.ids):
+            return False
+        timeofday, categorytype, poi_category = self.config
+        counts = catchments.poi_counts.get(poi_category)
+        if counts is not None and counts[n:].any():
+            return False
+        if any(origin in self.added for origin in catchments.origins[n:].tolist()):
+            return False
+        self.catchments = catchments
+        return True
+
+    @property
+    def nbytes(self):
+        pois = len(self.pois) * 200 if self.pois is not None else 0
+        return self.accessibility.nbytes + self.mask.nbytes + self.weighted.nbytes + 100 * (len(self.removed) + len(self.added)) + pois
+
+    def update(self, removed, added):
+        """Moves the scenario to the given cumulative lists of removed/added H3 ids and returns the city stats rows.
+        The lists are compared with the current state, so this costs as much as the lists are long - see edit().
+        """
+        removed = set(removed or ())
+        added = Counter(added or ())
+        removed_changes = {h: 1 for h in removed - self.removed}
+        removed_changes.update({h: -1 for h in self.removed - removed})
+        added_changes = {h: added[h] - self.added[h] for h in set(added) | set(self.added) if added[h] != self.added[h]}
+        return self.apply(removed_changes, added_changes)
+
+    def edit(self, added=(), unadded=(), removed=(), restored=()):
+        """Applies only what changed since the previous call - H3 ids appended to (added, removed) or taken off
+        (unadded, restored) the cumulative lists - and returns the city stats rows.
+        """
+        added_changes = Counter(added or ())
+        added_changes.subtract(unadded or ())
+        #an origin cannot be taken off the added list more often than it is on it
+        added_changes = {h: max(c, -self.added[h]) for h, c in added_changes.items()}
+        removed_changes = {h: 1 for h in removed or () if h not in self.removed}
+        removed_changes.update({h: -1 for h in restored or () if h in self.removed})
+        return self.apply(removed_changes, added_changes)
+
+    def apply(self, removed_changes, added_changes):
+        """Applies the catchments of the changed origins to the state - `removed_changes` maps h3id -> 1 (newly removed)
+        or -1 (restored), `added_changes` maps h3id -> change in the number of occurences. Returns the city stats rows.
+        """
+        timeofday, categorytype, poi_category = self.config
+        removed_changes = {h: c for h, c in removed_changes.items() if c}
+        added_changes = {h: c for h, c in added_changes.items() if c}
+        if removed_changes or added_changes:
+            cells, values = self.city.adjustment_delta(timeofday, categorytype, poi_category, removed_changes, added_changes)
+            if len(cells):
+                self.accessibility[cells] += values
+                #like api_get_city_stats, adjustments only count for cells that have base statistics
+                self.weighted += (values * self.mask[cells]) @ self.city.populations[categorytype][1][cells]
+        for h, change in removed_changes.items():
+            if change > 0:
+                self.removed.add(h)
+            else:
+                self.removed.discard(h)
+        for h, change in added_changes.items():
+            self.added[h] += change
+            if self.added[h] <= 0:
+                del self.added[h]
+        return self.city.weighted_group_stats(self.weighted, categorytype)
+
+
+class ScenarioStore():
+    """Scenarios by id, dropped after `ttl` seconds without use or (least recently used first) above the memory budget"""
+
+    def __init__(self, ttl=1800, max_bytes=64 * 1024 * 1024) -> None:
+        self.ttl = float(ttl)
+        self.max_bytes = int(max_bytes)
+        self._scenarios = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._scenarios)
+
+    def get(self, scenario_id):
+        with self._lock:
+            self._expire()
+            scenario = self._scenarios.get(scenario_id)
+            if scenario is not None:
+                scenario.last_used = time.monotonic()
+                self._scenarios.move_to_end(scenario_id)
+            return scenario
+
+    def put(self, scenario):
+        with self._lock:
+            scenario.last_used = time.monotonic()
+            self._scenarios[scenario.id] = scenario
+            self._scenarios.move_to_end(scenario.id)
+            self._expire()
+            #sizes change as scenarios are edited, so they are summed up on every put
+            size = sum(s.nbytes for s in self._scenarios.values())
+            while size > self.max_bytes and len(self._scenarios) > 1:
+                _, evicted = self._scenarios.popitem(last=False)
+                size -= evicted.nbytes
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._scenarios:
+            scenario_id, scenario = next(iter(self._scenarios.items()))
+            if now - scenario.last_used <= self.ttl:
+                break
+            del self._scenarios[scenario_id]
@@ -0,0 +1,197 @@
+"""JSON encoding of list responses (POI lists, H3 grids) straight from the cursor rows.
+
+Produces the same bytes as building POIList/H3List models and calling .json() on them, without creating a model
+(or a dict) per row: every row is written with a bytes template and orjson encodes the individual values.
+Strings repeated across rows (categories, group names) are encoded once.
+The models are still the response_model of the routes, so they keep describing the format in the OpenAPI schema.
+
+H3 ids are written as hex strings, or as JSON integers with int_ids.
+
+Catchment geometries are encoded once per detail level (see GEOMETRY_LEVELS and cache.GeometryCache) and embedded
+as bytes in the catchment responses.
+
+The *_items() functions encode rows chunk by chunk for streamed responses (see DatabasePool.stream()), either
+as the same {"data": [...]} document sent in pieces (json_array) or as one item per line (ndjson).
+"""
+import orjson
+from shapely.geometry import MultiPolygon, mapping
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+#lat/long are repeated after coords - the routes used to build POI models with the cursor row as extra fields
+_POI = b'{"id":%b,"name":%b,"h3id":%b,"category":%b,"coords":{"lat":%b,"long":%b},"lat":%b,"long":%b}'
+_CELL = b'{"h3id":%b,"data":null,"total":%b}'
+_DETAILED_CELL = b'{"h3id":%b,"data":%b,"total":%b,"accessibility":%b}'
+_CATCHMENT = b'{"origin_h3id":%b,"population_total":%b,"population_detail":%b,"geometry":%b}'
+_CATCHMENT_UNION = b'{"population_total":%b,"population_detail":%b,"geometry":%b}'
+
+#detail level -> (decimals kept in coordinates, simplification tolerance in degrees) - 5 decimals are ~1 m;
+#full is the geometry as stored
+GEOMETRY_LEVELS = {
+    'full': (None, 0),
+    'high': (6, 0.00001),
+    'medium': (5, 0.0001),
+    'low': (4, 0.0005),
+}
+
+
+def wants_ndjson(request, format=None):
+    if format is not None:
+        return format == 'ndjson'
+    return request is not None and NDJSON_MEDIA_TYPE in request.headers.get('accept', '')
+
+
+def _strings():
+    """orjson.dumps memoized for values that repeat across rows"""
+    cache = {}
+
+    def dumps(value):
+        encoded = cache.get(value)
+        if encoded is None:
+            encoded = cache[value] = orjson.dumps(value)
+        return encoded
+    return dumps
+
+
+def h3id(value, int_ids=False):
+    if int_ids:
+        return b'%d' % int(value, 16) if isinstance(value, str) else b'%d' % value
+    return orjson.dumps(value.lower()) if isinstance(value, str) else b'"%x"' % value
+
+
+def _list(items):
+    return b'{"data":[' + b','.join(items) + b']}'
+
+
+def _pois(rows, int_ids, category):
+    dumps = orjson.dumps
+    pois = []
+    for r in rows:
+        lat, long = dumps(r[3]), dumps(r[4])
+        pois.append(_POI % (dumps(r[0]), dumps(r[2]), h3id(r[1], int_ids), category(r[5]), lat, long, lat, long))
+    return pois
+
+
+def _detailed_cell(h3_id, cell, int_ids):
+    data, total, accessibility = cell
+    return _DETAILED_CELL % (h3id(h3_id, int_ids), orjson.dumps(data), orjson.dumps(total), orjson.dumps(accessibility))
+
+
+def _add_row(cell, groupname, population, accessibility):
+    #same as build_city_demographics(): groups are overwritten, populations add up and the last accessibility wins
+    cell[0][groupname] = population
+    cell[1] += population
+    cell[2] = accessibility
+
+
+def pois_json(rows, int_ids=False):
+    """Same as POIList(...).json() for (id, h3id, name, lat, long, category) rows"""
+    return _list(_pois(rows, int_ids, _strings()))
+
+
+def demographics_json(rows, detailed, int_ids=False):
+    """Same as H3List(...).json() for (h3id, groupname, population, accessibility) rows.
+    Cells are listed in the order they first appear, as build_city_demographics() does.
+    """
+    dumps = orjson.dumps
+    if not detailed:
+        cells = {}
+        for r in rows:
+            if r[0] not in cells:
+                cells[r[0]] = _CELL % (h3id(r[0], int_ids), dumps(r[2]))
+        return _list(cells.values())
+
+    #h3id -> [{groupname: population}, total, accessibility of the last row]
+    cells = {}
+    for h3_id, groupname, population, accessibility in rows:
+        cell = cells.get(h3_id)
+        if cell is None:
+            cell = cells[h3_id] = [{}, 0, None]
+        _add_row(cell, groupname, population, accessibility)
+    return _list([_detailed_cell(h3_id, cell, int_ids) for h3_id, cell in cells.items()])
+
+
+async def pois_items(chunks, int_ids=False):
+    """Encoded POIs of each chunk of rows (an async iterator of row lists)"""
+    category = _strings()
+    async for rows in chunks:
+        yield _pois(rows, int_ids, category)
+
+
+async def demographics_items(chunks, detailed, int_ids=False):
+    """Encoded cells of each chunk of rows (an async iterator of row lists).
+    Detailed rows must be ordered by h3id - a cell is written once its last row has been read.
+    Non-detailed rows must have one row per cell.
+    """
+    dumps = orjson.dumps
+    if not detailed:
+        async for rows in chunks:
+            yield [_CELL % (h3id(r[0], int_ids), dumps(r[2])) for r in rows]
+        return
+
+    current, cell = None, None
+    async for rows in chunks:
+        items = []
+        for h3_id, groupname, population, accessibility in rows:
+            if h3_id != current:
+                if cell is not None:
+                    items.append(_detailed_cell(current, cell, int_ids))
+                current, cell = h3_id, [{}, 0, None]
+            _add_row(cell, groupname, population, accessibility)
+        yield items
+    if cell is not None:
+        yield [_detailed_cell(current, cell, int_ids)]
+
+
+async def json_array(items):
+    """{"data": [...]} sent one chunk of items at a time"""
+    yield b'{"data":['
+    first = True
+    async for chunk in items:
+        if chunk:
+            yield (b'' if first else b',') + b','.join(chunk)
+            first = False
+    yield b']}'
+
+
+async def ndjson(items):
+    """One item per line"""
+    async for chunk in items:
+        if chunk:
+            yield b'\n'.join(chunk) + b'\n'
+
+
+def geometry_json(geometry, level='full'):
+    """GeoJSON bytes of a (multi)polygon at a detail level - always a MultiPolygon, as the MultiPolygon model"""
+    decimals, tolerance = GEOMETRY_LEVELS[level]
+    if tolerance:
+        geometry = geometry.simplify(tolerance, preserve_topology=True)
+    if geometry.geom_type == 'Polygon':
+        geometry = MultiPolygon([geometry])
+    geojson = mapping(geometry)
+    if decimals is not None:
+        geojson['coordinates'] = [
+            [[(round(c[0], decimals), round(c[1], decimals)) for c in ring] for ring in polygon]
+            for polygon in geojson['coordinates']
+        ]
+    return orjson.dumps(geojson)
+
+
+def geometry_variants(geometry):
+    """{level: GeoJSON bytes} of every level of GEOMETRY_LEVELS"""
+    return {level: geometry_json(geometry, level) for level in GEOMETRY_LEVELS}
+
+
+def catchment_json(origin_h3id, population_details, geometry):
+    """Same as CatchmentArea(...).json() with the geometry already encoded"""
+    return _CATCHMENT % (
+        h3id(origin_h3id), orjson.dumps(sum(population_details.values())), orjson.dumps(population_details), geometry
+    )
+
+
+def catchment_list_json(catchments, union_details=None, union_geometry=None):
+    """Same as CatchmentList(...).json() for encoded catchments (and the union of them if union_geometry is given)"""
+    union = b'null'
+    if union_geometry is not None:
+        union = _CATCHMENT_UNION % (orjson.dumps(sum(union_details.values())), orjson.dumps(union_details), union_geometry)
+    return b'{"data":[' + b','.join(catchments) + b'],"union":' + union + b'}'
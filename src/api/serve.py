@@ -1,6 +1,15 @@
 import configparser
+import logging
 import api
 
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
 config = configparser.ConfigParser()
 config.read("../../config/config.ini")    
-app = api.backendApi(dict(config['DB']), dict(config['OTP'])).get_app()
+pool_params = dict(config['DB_POOL']) if config.has_section('DB_POOL') else None
+engine_params = dict(config['ENGINE']) if config.has_section('ENGINE') else None
+cache_params = dict(config['CACHE']) if config.has_section('CACHE') else None
+scenario_params = dict(config['SCENARIOS']) if config.has_section('SCENARIOS') else None
+metrics_params = dict(config['METRICS']) if config.has_section('METRICS') else None
+isochrone_params = dict(config['ISOCHRONES']) if config.has_section('ISOCHRONES') else None
+app = api.backendApi(dict(config['DB']), dict(config['OTP']), pool_params, engine_params, cache_params, scenario_params, metrics_params, isochrone_params).get_app()
@@ -0,0 +1,300 @@
+"""Benchmarks all backendApi routes and IsochroneService.get_isochrone on synthetic cities of several sizes.
+
+Runs on a single machine: the stub OTP server is started in-process, the synthetic cities are (re)generated in the
+database from the config file and requests go straight to the ASGI app. Reports p50/p95/p99 latency and throughput
+of every target, and the cold start time of a worker (import, startup, first request - with and without warm-up),
+and writes them to a JSON file, so runs can be compared.
+
+Use a separate database - the generator adds (and replaces) cities named bench_<size>.
+
+Example:
+    python run.py --config ../../config/benchmark.ini --sizes small medium --requests 200 --concurrency 8
+"""
+import argparse
+import asyncio
+import configparser
+import datetime
+import os
+import platform
+import random
+import subprocess
+import time
+
+import httpx
+import numpy as np
+import orjson
+import psycopg2
+from sqlalchemy import create_engine
+
+import sys
+sys.path.append("../")
+sys.path.append("../api")
+
+import api
+import h3ids
+import isochrones as isc
+import stub_otp
+import synthetic_city
+
+
+def summarize(latencies, errors, seconds):
+    latencies = np.array(latencies) * 1000
+    if len(latencies) == 0:
+        return {'requests': 0, 'errors': errors}
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3),
+        'p99_ms': round(float(p99), 3),
+        'mean_ms': round(float(latencies.mean()), 3),
+        'throughput_rps': round(len(latencies) / seconds, 2) if seconds else None,
+    }
+
+
+async def measure(send, requests, concurrency, warmup):
+    """Calls `send(i)` (a coroutine function returning a response) `requests` times, at most `concurrency` at once"""
+    for i in range(warmup):
+        await send(i)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await send(i)
+                failed = response.status_code >= 400
+            except Exception:
+                failed = True
+            if failed:
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def measure_sync(call, items):
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        try:
+            call(item)
+            latencies.append(time.perf_counter() - t)
+        except Exception:
+            errors += 1
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def sample_city(db_params, city_id):
+    """Returns (POI categories, catchment origins, cells without catchments) of the city"""
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT DISTINCT pois.category FROM pois JOIN cityh3map ON cityh3map.h3id = pois.h3id
+                WHERE cityh3map.cityid = %s ORDER BY 1""", (city_id, ))
+            categories = [r[0] for r in cur.fetchall()]
+            cur.execute("""
+                SELECT DISTINCT catchments.originh3id FROM catchments JOIN cityh3map ON cityh3map.h3id = catchments.originh3id
+                WHERE cityh3map.cityid = %s AND catchments.timeofday = 'morning'""", (city_id, ))
+            origins = sorted(h3ids.to_hex(r[0]) for r in cur.fetchall())
+            cur.execute("""
+                SELECT cityh3map.h3id FROM cityh3map
+                LEFT JOIN catchments ON catchments.originh3id = cityh3map.h3id AND catchments.timeofday = 'morning'
+                WHERE cityh3map.cityid = %s AND catchments.catchmentid IS NULL""", (city_id, ))
+            empty = sorted(h3ids.to_hex(r[0]) for r in cur.fetchall())
+    return categories, origins, empty
+
+
+def api_targets(city_id, category, origins):
+    """(name, method, url, body) of every route - url and body are functions of the request number"""
+    city_data = lambda i: {
+        'changed': ['poi_category', 'demographic_category', 'time_of_day', 'poi_add'],
+        'config': {'city_id': city_id, 'poi_category': category, 'demographic_category': 'Race', 'time_of_day': 'morning'},
+        'poi_list': {'added': [origins[i % len(origins)]], 'deleted': []},
+    }
+    demographics = '/demographics/{}/Race/{}/morning'.format(city_id, category)
+    return [
+        ('cities', 'GET', lambda i: '/cities', None),
+        ('poi_categories', 'GET', lambda i: '/poi_categories', None),
+        ('times_of_day', 'GET', lambda i: '/times_of_day', None),
+        ('demographics_categories', 'GET', lambda i: '/demographics_categories', None),
+        ('configuration', 'GET', lambda i: '/configuration', None),
+        ('pois', 'GET', lambda i: '/pois/{}/{}'.format(city_id, category), None),
+        ('pois_int_ids', 'GET', lambda i: '/pois/{}/{}?int_ids=true'.format(city_id, category), None),
+        ('pois_columnar', 'GET', lambda i: '/pois/{}/{}?format=columnar'.format(city_id, category), None),
+        ('demographics', 'GET', lambda i: demographics + '?detailed=0', None),
+        ('demographics_detailed', 'GET', lambda i: demographics + '?detailed=1', None),
+        ('demographics_stream', 'GET', lambda i: demographics + '?detailed=1&stream=true', None),
+        ('demographics_ndjson', 'GET', lambda i: demographics + '?detailed=1&format=ndjson', None),
+        ('demographics_columnar', 'GET', lambda i: demographics + '?detailed=1&format=columnar', None),
+        ('demographics_res7', 'GET', lambda i: demographics + '?detailed=1&resolution=7', None),
+        ('catchment', 'GET', lambda i: '/catchment/{}/{}?time_of_day=morning&demographics_category=Race'.format(city_id, origins[i % len(origins)]), None),
+        ('catchment_low', 'GET', lambda i: '/catchment/{}/{}?time_of_day=morning&demographics_category=Race&detail=low'.format(city_id, origins[i % len(origins)]), None),
+        ('catchments_batch', 'POST', lambda i: '/catchments', lambda i: {
+            'city_id': city_id, 'time_of_day': 'morning', 'demographics_category': 'Race', 'union': True,
+            'h3_ids': [origins[(i * 10 + j) % len(origins)] for j in range(10)],
+        }),
+        ('city_stats', 'GET', lambda i: '/city_stats/{}?demographics_category=Race&time_of_day=morning&poi_category={}'.format(city_id, category), None),
+        ('city_data', 'POST', lambda i: '/city_data/', city_data),
+        ('metrics', 'GET', lambda i: '/metrics', None),
+    ]
+
+
+async def benchmark_api(db_params, otp_params, city_id, category, origins, args):
+    backend = api.backendApi(db_params, otp_params)
+    app = backend.get_app()
+    await app.router.startup()
+    results = []
+    try:
+        async with httpx.AsyncClient(app=app, base_url='http://benchmark', timeout=None) as client:
+            for name, method, url, body in api_targets(city_id, category, origins):
+                async def send(i):
+                    return await client.request(method, url(i), json=body(i) if body else None)
+                result = await measure(send, args.requests, args.concurrency, args.warmup)
+                result.update({'target': name, 'concurrency': args.concurrency})
+                results.append(result)
+                print("  {:<28} p50 {:>9}ms  p99 {:>9}ms  {:>9} req/s  errors {}".format(
+                    name, result.get('p50_ms'), result.get('p99_ms'), result.get('throughput_rps'), result['errors']
+                ))
+    finally:
+        await app.router.shutdown()
+    return results
+
+
+def import_seconds():
+    """Time to import the API module in a fresh interpreter - what every worker (re)start pays before serving"""
+    code = "import time; started = time.perf_counter(); import api; print(time.perf_counter() - started)"
+    api_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api')
+    return float(subprocess.check_output([sys.executable, '-c', code], cwd=api_dir).decode().strip().splitlines()[-1])
+
+
+async def benchmark_startup(db_params, otp_params, args):
+    """Cold start of a worker: module import, startup events (pool, warm-up) and the first /configuration request"""
+    results = []
+    imports = [import_seconds() for _ in range(args.startup_runs)]
+    for warmup in (False, True):
+        startups, first_requests = [], []
+        for _ in range(args.startup_runs):
+            backend = api.backendApi(db_params, otp_params, {'warmup': str(warmup)})
+            app = backend.get_app()
+            started = time.perf_counter()
+            await app.router.startup()
+            startups.append(time.perf_counter() - started)
+            try:
+                async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+                    started = time.perf_counter()
+                    await client.get('/configuration')
+                    first_requests.append(time.perf_counter() - started)
+            finally:
+                await app.router.shutdown()
+        result = {
+            'target': 'startup_warmup' if warmup else 'startup',
+            'import_ms': round(float(np.median(imports)) * 1000, 3),
+            'startup_ms': round(float(np.median(startups)) * 1000, 3),
+            'first_request_ms': round(float(np.median(first_requests)) * 1000, 3),
+        }
+        results.append(result)
+        print("  {:<28} import {:>9}ms  startup {:>9}ms  first request {:>9}ms".format(
+            result['target'], result['import_ms'], result['startup_ms'], result['first_request_ms']
+        ))
+    return results
+
+
+def benchmark_isochrones(db_params, otp_params, city_id, origins, empty, args):
+    """get_isochrone for catchments that exist (a database read) and ones that do not (stub OTP + write)"""
+    engine = create_engine('postgresql://{user}:{password}@{host}:{port}/{dbname}'.format(**db_params), future=True)
+    results = []
+    with engine.connect() as conn:
+        service = isc.IsochroneService(otp_port=otp_params['port'], otp_host=otp_params['host'], pg_conn=conn, reference_date=otp_params['ref_date'])
+        for name, h3_ids in [('get_isochrone_existing', origins), ('get_isochrone_new', empty)]:
+            h3_ids = random.sample(h3_ids, min(args.isochrones, len(h3_ids)))
+            result = measure_sync(lambda h3_id: service.get_isochrone(city_id, h3_id, 'morning', 30), h3_ids)
+            result.update({'target': name, 'concurrency': 1})
+            results.append(result)
+            print("  {:<28} p50 {:>9}ms  p99 {:>9}ms  {:>9} req/s  errors {}".format(
+                name, result.get('p50_ms'), result.get('p99_ms'), result.get('throughput_rps'), result['errors']
+            ))
+    engine.dispose()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def main(args):
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    db_params = dict(config['DB'])
+    random.seed(args.seed)
+
+    server = stub_otp.start_in_background(
+        port=args.otp_port, latency_ms=args.otp_latency_ms, radius_km=args.otp_radius_km, vertices=args.otp_vertices
+    )
+    otp_params = {'host': 'localhost', 'port': str(args.otp_port), 'ref_date': '04-14-2022'}
+
+    results = []
+    try:
+        for size in args.sizes:
+            name = 'bench_{}'.format(size)
+            print("{}: generating".format(name))
+            city_id = synthetic_city.generate(db_params, name, seed=args.seed, **synthetic_city.SIZES[size])
+            categories, origins, empty = sample_city(db_params, city_id)
+
+            print("{}: startup".format(name))
+            size_results = asyncio.run(benchmark_startup(db_params, otp_params, args))
+            print("{}: API".format(name))
+            size_results += asyncio.run(benchmark_api(db_params, otp_params, city_id, categories[0], origins, args))
+            print("{}: IsochroneService".format(name))
+            size_results += benchmark_isochrones(db_params, otp_params, city_id, origins, empty, args)
+            for result in size_results:
+                result.update({'size': size, **synthetic_city.SIZES[size]})
+            results += size_results
+    finally:
+        server.shutdown()
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'options': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2).decode())
+    print("Results written to {}".format(args.output))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the backend on synthetic cities")
+    parser.add_argument('--config', default="../../config/config.ini", help="path to config.ini (use a separate benchmark database!)")
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium'], choices=list(synthetic_city.SIZES))
+    parser.add_argument('--requests', type=int, default=200, help="requests per route")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=5, help="requests per route before measuring")
+    parser.add_argument('--isochrones', type=int, default=50, help="get_isochrone calls per case")
+    parser.add_argument('--startup-runs', type=int, default=3, help="cold starts measured (median is reported)")
+    parser.add_argument('--otp-port', type=int, default=8099)
+    parser.add_argument('--otp-latency-ms', type=float, default=100)
+    parser.add_argument('--otp-radius-km', type=float, default=3)
+    parser.add_argument('--otp-vertices', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_args())
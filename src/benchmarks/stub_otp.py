@@ -0,0 +1,125 @@
+"""A stand-in for OTP's isochrone endpoint (/otp/routers/{city}/isochrone) for benchmarks.
+
+Answers every request after a configurable latency with a feature collection holding one circular MultiPolygon
+around fromPlace - its radius and number of vertices control the size of the polygons the backend has to parse,
+store and polyfill. A fraction of requests can be answered with OTP's "vertices not found" error to exercise the
+k-ring fallback.
+
+Example:
+    python stub_otp.py --port 8062 --latency-ms 150 --radius-km 4 --vertices 400
+"""
+import argparse
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import orjson
+
+import sys
+sys.path.append("../")
+
+from isochrones import NO_ROUTE
+
+PATH = re.compile(r'^/otp/routers/[^/]+/isochrone$')
+
+
+def circle(lat, lon, radius_km, vertices):
+    """GeoJSON MultiPolygon approximating a circle around the point"""
+    d_lat = radius_km / 111.32
+    d_lon = radius_km / (111.32 * math.cos(math.radians(lat)))
+    ring = [
+        [lon + d_lon * math.cos(2 * math.pi * i / vertices), lat + d_lat * math.sin(2 * math.pi * i / vertices)]
+        for i in range(vertices)
+    ]
+    ring.append(ring[0])
+    return {'type': 'MultiPolygon', 'coordinates': [[ring]]}
+
+
+class StubOTPHandler(BaseHTTPRequestHandler):
+    #set on the subclass created by make_server
+    options = None
+
+    def do_GET(self):
+        options = self.options
+        url = urlparse(self.path)
+        if not PATH.match(url.path):
+            self.reply(404, b'Not found')
+            return
+        params = parse_qs(url.query)
+        try:
+            lat, lon = [float(v) for v in params['fromPlace'][0].split(',')]
+        except (KeyError, ValueError):
+            self.reply(400, b'Invalid fromPlace')
+            return
+
+        latency = options['latency_ms'] + random.uniform(-1, 1) * options['jitter_ms']
+        time.sleep(max(latency, 0) / 1000)
+
+        if random.random() < options['no_route_rate']:
+            self.reply(500, NO_ROUTE.encode())
+            return
+
+        features = []
+        for cutoff in params.get('cutoffSec', ['1800']):
+            #scale the area with the cutoff, like a real isochrone would grow
+            radius = options['radius_km'] * int(cutoff) / 1800
+            features.append({
+                'type': 'Feature',
+                'geometry': circle(lat, lon, radius, options['vertices']),
+                'properties': {'time': int(cutoff)},
+            })
+        self.reply(200, orjson.dumps({'type': 'FeatureCollection', 'features': features}), 'application/json')
+
+    def reply(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host='localhost', port=8062, latency_ms=100, jitter_ms=0, radius_km=3, vertices=200, no_route_rate=0):
+    options = {
+        'latency_ms': float(latency_ms),
+        'jitter_ms': float(jitter_ms),
+        'radius_km': float(radius_km),
+        'vertices': int(vertices),
+        'no_route_rate': float(no_route_rate),
+    }
+    handler = type('ConfiguredStubOTPHandler', (StubOTPHandler, ), {'options': options})
+    server = ThreadingHTTPServer((host, int(port)), handler)
+    server.daemon_threads = True
+    return server
+
+
+def start_in_background(**kwargs):
+    """Starts the stub server in a daemon thread and returns it (call shutdown() to stop it)"""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Stub OTP isochrone server")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8062)
+    parser.add_argument('--latency-ms', type=float, default=100)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--radius-km', type=float, default=3, help="radius of the isochrone for a 30 minute cutoff")
+    parser.add_argument('--vertices', type=int, default=200, help="vertices per isochrone polygon")
+    parser.add_argument('--no-route-rate', type=float, default=0, help="fraction of requests answered with VertexNotFoundException")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    server = make_server(args.host, args.port, args.latency_ms, args.jitter_ms, args.radius_km, args.vertices, args.no_route_rate)
+    print("Stub OTP listening on {}:{}".format(args.host, args.port))
+    server.serve_forever()
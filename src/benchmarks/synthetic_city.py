@@ -0,0 +1,152 @@
+"""Generates a synthetic city in a local Postgres database for benchmarks.
+
+The city is a disk of H3 resolution 9 cells with random demographics and POIs. Every POI origin gets a catchment
+(a k-ring of cells around it) for every time of day, written with the same CatchmentWriter the application uses,
+so catchment_stats, step1_stats and accessibility_stats are filled in as well.
+Re-running with the same name replaces the city. Tables and api_* functions are created from sql/schema.sql if missing.
+
+Example:
+    python synthetic_city.py --config ../../config/benchmark.ini --name bench_small --cells 2000 --pois 200
+"""
+import argparse
+import configparser
+import os
+import random
+
+import h3
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+from shapely.geometry import MultiPolygon, Polygon
+from sqlalchemy import create_engine
+
+import sys
+sys.path.append("../")
+
+import catchment_writer as cw
+import h3ids
+import metadata
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sql', 'schema.sql')
+TIMES = ['morning', 'afternoon', 'evening']
+POI_CATEGORIES = ['Restaurants', 'Grocery stores and supermarkets', 'Clinics and Hospitals', 'Schools and Kindergartners']
+CATEGORY_TYPES = ['Race', 'Income']
+
+#named sizes used by the benchmark runner
+SIZES = {
+    'small': {'cells': 2000, 'pois': 200, 'groups': 5},
+    'medium': {'cells': 10000, 'pois': 1000, 'groups': 8},
+    'large': {'cells': 50000, 'pois': 5000, 'groups': 10},
+}
+
+
+def create_schema(cur):
+    with open(SCHEMA_PATH) as f:
+        cur.execute(f.read())
+
+
+def drop_city(cur, name):
+    """Removes a city and everything derived from it"""
+    cur.execute("SELECT cityid FROM cities WHERE cityname = %s", (name, ))
+    row = cur.fetchone()
+    if row is None:
+        return
+    city_id = row[0]
+    cur.execute("""
+        CREATE TEMP TABLE drop_catchments ON COMMIT DROP AS
+        SELECT catchments.catchmentid FROM catchments JOIN cityh3map ON cityh3map.h3id = catchments.originh3id
+        WHERE cityh3map.cityid = %s
+    """, (city_id, ))
+    for table in ['step1_stats', 'catchment_stats', 'catchmenth3map', 'catchments']:
+        cur.execute("DELETE FROM {} WHERE catchmentid IN (SELECT catchmentid FROM drop_catchments)".format(table))
+    cur.execute("DELETE FROM pois WHERE h3id IN (SELECT h3id FROM cityh3map WHERE cityid = %s)", (city_id, ))
+    for table in ['accessibility_stats', 'h3demographics', 'cityh3map', 'cities']:
+        cur.execute("DELETE FROM {} WHERE cityid = %s".format(table), (city_id, ))
+
+
+def city_cells(center, n):
+    """Returns the n cells closest to the center cell"""
+    cells = []
+    k = 0
+    while len(cells) < n:
+        cells.extend(sorted(h3.hex_ring(center, k)))
+        k += 1
+    return cells[:n]
+
+
+def catchment(origin, k, city):
+    """Catchment of an origin: its k-ring (clipped to the city) and the matching multipolygon"""
+    cells = h3.k_ring(origin, k) & city
+    polygons = h3.h3_set_to_multi_polygon(cells, geo_json=True)
+    return MultiPolygon([Polygon(p[0], p[1:]) for p in polygons]), cells
+
+
+def generate(db_params, name, cells=2000, pois=200, groups=5, catchment_k=8, lat=33.75, lon=-84.39, seed=0, batch_size=200):
+    """Creates the city and returns its id"""
+    rng = np.random.default_rng(seed)
+    random.seed(seed)
+    cells = city_cells(h3.geo_to_h3(lat, lon, 9), cells)
+    city = set(cells)
+
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            create_schema(cur)
+            drop_city(cur, name)
+
+            lats, lons = zip(*[h3.h3_to_geo(c) for c in cells])
+            cur.execute(
+                "INSERT INTO cities (cityname, boundingbox) VALUES (%s, %s) RETURNING cityid",
+                (name, [min(lons), min(lats), max(lons), max(lats)])
+            )
+            city_id = cur.fetchone()[0]
+            execute_values(cur, "INSERT INTO cityh3map (cityid, h3id) VALUES %s", [(city_id, h3ids.to_int(c)) for c in cells])
+
+            rows = []
+            for categorytype in CATEGORY_TYPES:
+                populations = rng.gamma(2, 50, size=(len(cells), groups))
+                for i, h3id in enumerate(cells):
+                    rows.extend((city_id, categorytype, 'Group {}'.format(g + 1), h3ids.to_int(h3id), float(populations[i, g])) for g in range(groups))
+            execute_values(cur, "INSERT INTO h3demographics (cityid, categorytype, groupname, h3id, population) VALUES %s", rows, page_size=10000)
+
+            origins = rng.choice(len(cells), size=pois)
+            rows = []
+            for i, c in enumerate(origins):
+                poi_lat, poi_lon = h3.h3_to_geo(cells[c])
+                rows.append(('POI {}'.format(i), h3ids.to_int(cells[c]), random.choice(POI_CATEGORIES), poi_lat, poi_lon))
+            execute_values(cur, "INSERT INTO pois (name, h3id, category, lat, long) VALUES %s", rows)
+
+    engine = create_engine('postgresql://{user}:{password}@{host}:{port}/{dbname}'.format(**db_params), future=True)
+    with engine.connect() as conn:
+        writer = cw.CatchmentWriter(conn)
+        todo = [(cells[c], t) for c in sorted(set(origins)) for t in TIMES]
+        for i in range(0, len(todo), batch_size):
+            batch = []
+            for origin, timeofday in todo[i:i + batch_size]:
+                isochrone, catchment_cells = catchment(origin, catchment_k, city)
+                batch.append((origin, timeofday, 30, isochrone, True, catchment_cells))
+            writer.write(batch)
+    engine.dispose()
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            metadata.write(cur)
+    return city_id
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a synthetic city for benchmarks")
+    parser.add_argument('--config', default="../../config/config.ini", help="path to config.ini (use a separate benchmark database!)")
+    parser.add_argument('--name', default='bench_small')
+    parser.add_argument('--cells', type=int, default=2000, help="number of H3 resolution 9 cells")
+    parser.add_argument('--pois', type=int, default=200)
+    parser.add_argument('--groups', type=int, default=5, help="demographic groups per category type")
+    parser.add_argument('--catchment-k', type=int, default=8, help="k-ring radius of catchments")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    city_id = generate(dict(config['DB']), args.name, args.cells, args.pois, args.groups, args.catchment_k, seed=args.seed)
+    print("Generated city {} ({})".format(args.name, city_id))
@@ -0,0 +1,234 @@
+import io
+import time
+
+import h3
+from psycopg2.extras import execute_values
+from shapely.geometry import mapping
+
+import accessibility_stats
+import data_version
+import h3ids
+import metrics
+
+CATCHMENT_STATS_SQL = """
+WITH all_h3_ids as (
+    SELECT 		
+        h3demographics.categorytype,
+        h3demographics.h3id, 
+        h3demographics.groupname, 
+        h3demographics.population 
+    FROM h3demographics
+),
+
+catchmenth3_ids AS (
+    SELECT 
+        catchments.catchmentid,
+        catchmenth3map.h3id
+    FROM catchments
+    JOIN catchmenth3map ON catchmenth3map.catchmentid = catchments.catchmentid WHERE catchments.catchmentid = ANY(%(catchment_ids)s)
+)
+
+INSERT INTO catchment_stats (catchmentid, categorytype, groupname, population)
+    SELECT c.catchmentid, h.categorytype, h.groupname, SUM(h.population)
+        FROM all_h3_ids as h
+        JOIN catchmenth3_ids as c ON c.h3id = h.h3id
+        GROUP BY c.catchmentid, h.categorytype, h.groupname;
+
+"""
+
+STEP1_STATS_SQL = """
+WITH step1 AS (
+        SELECT 
+                c3m.h3id,                
+                catchments.timeofday,
+                catchments.catchmentid,
+                catchment_stats.categorytype,		 
+                CASE 
+                    WHEN SUM(catchment_stats.population) = 0
+                    THEN 0 
+                    ELSE 10000 / SUM(catchment_stats.population) 
+                    END AS ratio
+        FROM catchments
+        JOIN catchment_stats
+            ON catchment_stats.catchmentid = catchments.catchmentid                
+        JOIN catchmenth3map c3m 
+            ON catchment_stats.catchmentid = c3m.catchmentid
+        WHERE c3m.catchmentid = ANY(%(catchment_ids)s) AND {stats_catchments}
+        GROUP BY 
+            c3m.h3id,                
+            catchments.timeofday,
+            catchments.catchmentid,
+            catchment_stats.categorytype
+    )
+
+    INSERT INTO step1_stats 
+    (h3id,		
+            timeofday,
+            categorytype,			
+            catchmentid,
+            ratio
+    )
+        SELECT 
+            h3id,		
+            timeofday,
+            categorytype,			
+            catchmentid,
+            ratio
+        FROM step1
+""".format(stats_catchments=accessibility_stats.STATS_CATCHMENTS)
+
+
+def update_stats(cur, catchment_ids):
+    """Computes catchment_stats and step1_stats rows for a list of new catchment ids (step1_stats only for the
+    accessibility_stats.STATS_MINUTES cutoff), applies their contribution to accessibility_stats and bumps the data version
+    """
+    params = {'catchment_ids': list(catchment_ids)}
+    cur.execute(CATCHMENT_STATS_SQL, params)
+    cur.execute(STEP1_STATS_SQL, params)
+    accessibility_stats.apply_catchments(cur, catchment_ids)
+    #let readers of derived data (e.g. the API cache) know that statistics changed
+    data_version.bump(cur)
+
+
+def recompute_stats(cur, catchment_ids):
+    """Replaces the catchment_stats and step1_stats rows of existing catchments, e.g. after new census data.
+    accessibility_stats is not touched - rebuild it for the cities the catchments cover afterwards.
+    """
+    params = {'catchment_ids': list(catchment_ids)}
+    cur.execute("DELETE FROM step1_stats WHERE catchmentid = ANY(%(catchment_ids)s)", params)
+    cur.execute("DELETE FROM catchment_stats WHERE catchmentid = ANY(%(catchment_ids)s)", params)
+    cur.execute(CATCHMENT_STATS_SQL, params)
+    cur.execute(STEP1_STATS_SQL, params)
+
+
+def lock_key(h3_id, time, minutes):
+    """Key of the Postgres advisory lock that serializes computation/insertion of one catchment across workers"""
+    return 'catchment|{}|{}|{}'.format(h3_id, time, minutes)
+
+
+def polyfill(isochrone, resolution=9):
+    """Returns the set of H3 cells (hex strings) covering the (multi)polygon"""
+    h3s = [h3.polyfill_geojson(mapping(polygon), res=resolution) for polygon in isochrone.geoms]
+    return set().union(*h3s)
+
+
+class CatchmentWriter():
+    """Bulk write path for new catchments.
+
+    Writes many catchments in a single transaction: one multi-row insert into catchments, the H3 cells streamed
+    into catchmenth3map with COPY and catchment/step1 statistics computed once for the whole set.
+    `pg_conn` is a SQLAlchemy connection (the same one IsochroneService uses). After every write,
+    `last_report` holds the number of catchments and catchmenth3map rows written and the time it took.
+
+    Catchments are locked with transaction-level advisory locks and re-checked before inserting, so a catchment
+    another worker inserted in the meantime is not duplicated - its existing id is returned instead.
+    """
+
+    #SRID of catchments.geometry, looked up once per process
+    _srid = None
+
+    def __init__(self, pg_conn, h3_resolution=9):
+        self.pg_conn = pg_conn
+        self.h3_resolution = h3_resolution
+        self.last_report = None
+        self.totals = {'catchments': 0, 'skipped': 0, 'cells': 0, 'seconds': 0.0}
+
+    def srid(self, cur):
+        if CatchmentWriter._srid is None:
+            cur.execute("SELECT Find_SRID('public', 'catchments', 'geometry')")
+            CatchmentWriter._srid = cur.fetchone()[0]
+        return CatchmentWriter._srid
+
+    def write(self, isochrones, commit=True):
+        """Writes a list of (h3_id, time, minutes, isochrone, real) tuples and returns the catchment ids in the same order.
+        An isochrone may also be given as (h3_id, time, minutes, isochrone, real, cells) when its H3 cells are already known
+        (cells None means they still need to be polyfilled).
+        H3 ids may be given as integers or hex strings.
+        """
+        if not isochrones:
+            return []
+        isochrones = [(h3ids.to_int(item[0]), ) + tuple(item[1:]) for item in isochrones]
+
+        started = time.perf_counter()
+        #raw psycopg2 cursors are used below - make sure SQLAlchemy knows a transaction is in progress so commit() reaches the driver
+        if not self.pg_conn.in_transaction():
+            self.pg_conn.begin()
+
+        try:
+            with self.pg_conn.connection.cursor() as cur:
+                existing = self.lock_and_find_existing(cur, isochrones)
+                #skip catchments that already exist (or appear twice in the batch)
+                new = []
+                for item in isochrones:
+                    key = (item[0], item[1], item[2])
+                    if key not in existing:
+                        existing[key] = None
+                        new.append(item)
+
+                cells = 0
+                if new:
+                    new_ids = self.insert_catchments(cur, new)
+                    existing.update({(item[0], item[1], item[2]): i for item, i in zip(new, new_ids)})
+                    cells = self.copy_cells(cur, new_ids, new)
+                    update_stats(cur, new_ids)
+                catchment_ids = [existing[(item[0], item[1], item[2])] for item in isochrones]
+            if commit:
+                self.pg_conn.commit()
+        except Exception:
+            self.pg_conn.rollback()
+            raise
+
+        seconds = time.perf_counter() - started
+        metrics.CATCHMENT_WRITE_SECONDS.observe(seconds)
+        metrics.CATCHMENTS_WRITTEN.inc(len(new))
+        metrics.record('catchment_write', seconds)
+        self.last_report = {'catchments': len(new), 'skipped': len(isochrones) - len(new), 'cells': cells, 'seconds': seconds}
+        for key, value in self.last_report.items():
+            self.totals[key] += value
+        return catchment_ids
+
+    def lock_and_find_existing(self, cur, isochrones):
+        """Takes the advisory locks of all catchments (in a fixed order to avoid deadlocks)
+        and returns {(h3_id, time, minutes): catchment id} for the ones that already exist
+        """
+        keys = sorted({(item[0], item[1], item[2]) for item in isochrones})
+        for h3_id, time_of_day, minutes in keys:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (lock_key(h3_id, time_of_day, minutes), ))
+        cur.execute("""
+            SELECT c.originh3id, c.timeofday, c.timedistance, MIN(c.catchmentid) FROM catchments c
+            JOIN unnest(%s::bigint[], %s::text[], %s::int[]) AS k(h3id, timeofday, timedistance)
+                ON c.originh3id = k.h3id AND c.timeofday = k.timeofday AND c.timedistance = k.timedistance
+            GROUP BY c.originh3id, c.timeofday, c.timedistance
+        """, ([k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys]))
+        return {(r[0], r[1], r[2]): r[3] for r in cur.fetchall()}
+
+    def insert_catchments(self, cur, isochrones):
+        srid = self.srid(cur)
+        template = '(%s, %s, ST_SetSRID(ST_GeomFromWKB(%s), {}), %s, %s)'.format(int(srid or 0))
+        rows = execute_values(
+            cur,
+            """INSERT INTO catchments (timeofday, timedistance, geometry, originh3id, real) VALUES %s
+            RETURNING catchmentid, originh3id, timeofday, timedistance""",
+            [(item[1], item[2], item[3].wkb, item[0], item[4]) for item in isochrones],
+            template=template,
+            fetch=True,
+        )
+        ids = {(r[1], r[2], r[3]): r[0] for r in rows}
+        return [ids[(item[0], item[1], item[2])] for item in isochrones]
+
+    def copy_cells(self, cur, catchment_ids, isochrones):
+        """Streams the catchment cells into catchmenth3map with COPY and returns the number of rows written"""
+        buffer = io.StringIO()
+        count = 0
+        for catchment_id, item in zip(catchment_ids, isochrones):
+            if len(item) > 5 and item[5] is not None:
+                cells = item[5]
+            else:
+                with metrics.timed(metrics.POLYFILL_SECONDS, 'polyfill'):
+                    cells = polyfill(item[3], self.h3_resolution)
+            metrics.CATCHMENT_CELLS.observe(len(cells))
+            count += len(cells)
+            buffer.writelines('{}\t{}\n'.format(catchment_id, h3ids.to_int(h)) for h in cells)
+        buffer.seek(0)
+        cur.copy_expert("COPY catchmenth3map (catchmentid, h3id) FROM STDIN", buffer)
+        return count
@@ -0,0 +1,197 @@
+"""Per-city binary datasets of the 2SFCA engine, memory-mapped read-only by the API.
+
+The exporter writes the static tables the engine needs - cell ids, per-group populations, accessibility_stats per
+POI category and time of day, and the catchment CSR membership with its step 1 ratios - as fixed-width .npy arrays:
+
+    <dataset_dir>/<city id>/<version>/manifest.json + *.npy
+    <dataset_dir>/<city id>/CURRENT      name of the version in use
+
+Every API worker maps the arrays with np.load(mmap_mode='r'), so N uvicorn workers share one copy through the page cache.
+A new export goes into a new version directory and CURRENT is replaced atomically (os.replace); workers pick it up
+on their next refresh, and the old version stays readable by workers that still have it mapped.
+
+    python city_dataset.py --dir /srv/datasets --cities 1 2
+"""
+import argparse
+import configparser
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import psycopg2
+from scipy import sparse
+
+import accessibility as acc
+import data_version
+
+POINTER = 'CURRENT'
+MANIFEST = 'manifest.json'
+
+
+class _Writer():
+    """Saves arrays into a version directory and returns the file names to put in the manifest"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.count = 0
+
+    def __call__(self, prefix, array):
+        name = '{}-{}.npy'.format(prefix, self.count)
+        self.count += 1
+        np.save(os.path.join(self.directory, name), np.ascontiguousarray(array))
+        return name
+
+
+def city_path(dataset_dir, city_id):
+    return os.path.join(dataset_dir, str(int(city_id)))
+
+
+def current_version(dataset_dir, city_id):
+    """Name of the version CURRENT points to, None if the city has no dataset"""
+    try:
+        with open(os.path.join(city_path(dataset_dir, city_id), POINTER)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def export_city(cur, dataset_dir, city_id):
+    """Writes a new version of the city's dataset and points CURRENT to it. Returns the version name"""
+    city = acc.AccessibilityEngine(None).load_city(cur, city_id)
+    cur.execute("""
+        SELECT timeofday, categorytype, poi_category, h3id, accessibility FROM accessibility_stats WHERE cityid = %s
+    """, (city_id, ))
+    stats = {}
+    for timeofday, categorytype, poi_category, h3id, value in cur.fetchall():
+        index = city.cell_index.get(h3id)
+        if index is not None and value is not None:
+            stats.setdefault((timeofday, categorytype, poi_category), {})[index] = value
+
+    version = 'v{}-{}'.format(data_version.get(cur), time.strftime('%Y%m%d%H%M%S'))
+    root = city_path(dataset_dir, city_id)
+    tmp = os.path.join(root, '.' + version)
+    os.makedirs(tmp)
+    save = _Writer(tmp)
+
+    manifest = {
+        'city_id': city_id,
+        'version': version,
+        'cells': save('cells', city.cells.astype('<u8')),
+        'populations': {
+            categorytype: {'groups': groups, 'matrix': save('populations', matrix), 'present': save('present', present)}
+            for categorytype, (groups, matrix, present) in city.populations.items()
+        },
+        'accessibility': [],
+        'catchments': {},
+    }
+    for (timeofday, categorytype, poi_category), values in sorted(stats.items()):
+        indices = np.fromiter(values.keys(), dtype=np.int64, count=len(values))
+        accessibility = np.zeros(len(city.cells))
+        accessibility[indices] = np.fromiter(values.values(), dtype=np.float64, count=len(values))
+        mask = np.zeros(len(city.cells), dtype=bool)
+        mask[indices] = True
+        manifest['accessibility'].append({
+            'timeofday': timeofday, 'categorytype': categorytype, 'poi_category': poi_category,
+            'values': save('accessibility', accessibility), 'mask': save('mask', mask),
+        })
+    for timeofday, catchments in city.catchments.items():
+        membership = catchments.membership
+        manifest['catchments'][timeofday] = {
+            'ids': save('ids', catchments.ids),
+            'origins': save('origins', catchments.origins.astype('<u8')),
+            'indptr': save('indptr', membership.indptr),
+            'indices': save('indices', membership.indices),
+            'data': save('data', membership.data),
+            'ratios': {ct: save('ratios', v) for ct, v in catchments.ratios.items()},
+            'has_stats': {ct: save('has_stats', v) for ct, v in catchments.has_stats.items()},
+            'poi_counts': {pc: save('poi_counts', v) for pc, v in catchments.poi_counts.items()},
+        }
+    with open(os.path.join(tmp, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+
+    os.rename(tmp, os.path.join(root, version))
+    pointer = os.path.join(root, POINTER)
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(version)
+    os.replace(pointer + '.tmp', pointer)
+    return version
+
+
+def load_city(dataset_dir, city_id, version=None):
+    """Maps the city's dataset (the CURRENT version by default) and returns a CityAccessibility backed by it"""
+    version = version or current_version(dataset_dir, city_id)
+    directory = os.path.join(city_path(dataset_dir, city_id), version)
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    def load(name):
+        return np.load(os.path.join(directory, name), mmap_mode='r')
+
+    cells = load(manifest['cells'])
+    populations = {
+        categorytype: (p['groups'], load(p['matrix']), load(p['present']))
+        for categorytype, p in manifest['populations'].items()
+    }
+    catchments = {}
+    for timeofday, c in manifest['catchments'].items():
+        ids = load(c['ids'])
+        membership = sparse.csr_matrix((load(c['data']), load(c['indices']), load(c['indptr'])), shape=(len(ids), len(cells)), copy=False)
+        catchments[timeofday] = acc.CatchmentSet(
+            ids,
+            load(c['origins']),
+            membership,
+            {ct: load(name) for ct, name in c['ratios'].items()},
+            {ct: load(name) for ct, name in c['has_stats'].items()},
+            {pc: load(name) for pc, name in c['poi_counts'].items()},
+        )
+    city = acc.CityAccessibility(int(city_id), cells, populations, catchments)
+    #accessibility_stats as exported - used until the engine loads more catchments
+    for a in manifest['accessibility']:
+        city._base[(a['timeofday'], a['categorytype'], a['poi_category'])] = (load(a['values']), load(a['mask']))
+    city.dataset_version = version
+    return city
+
+
+def prune(dataset_dir, city_id, keep=2):
+    """Deletes all but the `keep` newest versions of a city (never the current one).
+    Workers that still map a deleted version keep reading it until they let go of it.
+    """
+    root = city_path(dataset_dir, city_id)
+    current = current_version(dataset_dir, city_id)
+    versions = sorted((v for v in os.listdir(root) if v.startswith('v')), key=lambda v: os.path.getmtime(os.path.join(root, v)))
+    for version in versions[:-keep] if keep else versions:
+        if version != current:
+            shutil.rmtree(os.path.join(root, version))
+
+
+def export(db_params, dataset_dir, city_ids=None, keep=2):
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            if city_ids is None:
+                cur.execute("SELECT cityid FROM cities ORDER BY cityid")
+                city_ids = [r[0] for r in cur.fetchall()]
+            for city_id in city_ids:
+                started = time.perf_counter()
+                version = export_city(cur, dataset_dir, city_id)
+                prune(dataset_dir, city_id, keep)
+                print("  city {:<5} {} {:8.1f}s".format(city_id, version, time.perf_counter() - started))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Export the engine data of cities to memory-mappable files")
+    parser.add_argument('--config', default="../config/config.ini", help="path to config.ini")
+    parser.add_argument('--dir', default=None, help="dataset directory (defaults to [ENGINE] dataset_dir)")
+    parser.add_argument('--cities', nargs='+', type=int, default=None, help="city ids to export (all cities by default)")
+    parser.add_argument('--keep', type=int, default=2, help="versions kept per city")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    dataset_dir = args.dir or config.get('ENGINE', 'dataset_dir', fallback=None)
+    assert dataset_dir, "No dataset directory - use --dir or set [ENGINE] dataset_dir"
+    export(dict(config['DB']), dataset_dir, args.cities, args.keep)
@@ -1,6 +1,70 @@
+"""Census block groups: shapefile -> censush3map -> h3demographics.
+
+Block group shapes are streamed from the shapefile in chunks, keeping only those whose bounding box overlaps one of
+the cities being ingested, and polyfilled to resolution 9 cells in a process pool. The cells are COPYed into
+censush3map as each chunk comes back, so memory use does not depend on the size of the shapefile.
+Then the population of every block group (demographics table) is split equally among its cells inside the city,
+as in sql/01. pois_h3_demographics, and each city's h3demographics rows are replaced in their own transaction -
+adding a city leaves the others as they are.
+
+Everything derived from the populations is recomputed afterwards: catchment_stats and step1_stats of the catchments
+covering the cities' cells, then accessibility_stats, the demographics pyramid and - with [ENGINE] dataset_dir -
+the engine datasets of every city those catchments reach. API workers that load cities from the database
+(no dataset) pick up the new populations when they restart.
+
+    python census.py --shapefile ../../data/tl_2019_13_bg.zip --cities 3
+"""
+import argparse
+import configparser
+import io
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+
+import psycopg2
 from shapefile import Reader
 from pandas import DataFrame
 
+import sys
+sys.path.append("../")
+
+import accessibility_stats
+import catchment_writer as cw
+import city_dataset
+import data_version
+import demographics_lod as lod
+import metadata
+
+H3_RESOLUTION = 9
+
+CREATE_SQL = """
+CREATE TABLE IF NOT EXISTS public.censush3map
+(
+    censusblockgroupid text NOT NULL,
+    h3id bigint NOT NULL
+);
+CREATE INDEX IF NOT EXISTS censush3map_h3id ON public.censush3map (h3id);
+CREATE INDEX IF NOT EXISTS censush3map_censusblockgroupid ON public.censush3map (censusblockgroupid);
+"""
+
+#the population of a block group is split equally among its cells in the city
+SPLIT_SQL = """
+INSERT INTO h3demographics (cityid, categorytype, groupname, h3id, population)
+WITH cells AS (
+    SELECT censush3map.censusblockgroupid, cityh3map.h3id
+    FROM cityh3map
+    JOIN censush3map ON censush3map.h3id = cityh3map.h3id
+    WHERE cityh3map.cityid = %(city_id)s
+),
+counts AS (
+    SELECT censusblockgroupid, count(*) AS hexagon_count FROM cells GROUP BY censusblockgroupid
+)
+SELECT %(city_id)s, demographics.categorytype, demographics.groupname, cells.h3id,
+    demographics.total::float / counts.hexagon_count::float
+FROM cells
+JOIN counts ON counts.censusblockgroupid = cells.censusblockgroupid
+JOIN demographics ON demographics.censusblockgroupid = cells.censusblockgroupid
+"""
+
 
 def read_shapefile(path):
     """
@@ -18,3 +82,179 @@ def read_shapefile(path):
     df = df.assign(coords=shps)
 
     return df
+
+
+def _overlaps(a, b):
+    if a is None or b is None:
+        return False
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def iter_block_groups(path, bboxes=None, id_field='GEOID', chunk_size=500):
+    """Yields lists of (block group id, GeoJSON geometry) read from the shapefile one record at a time.
+    Only shapes overlapping one of `bboxes` ([min_lon, min_lat, max_lon, max_lat]) are kept if given.
+    """
+    with Reader(path) as sf:
+        chunk = []
+        for record in sf.iterShapeRecords():
+            shape = record.shape
+            if not shape.points or (bboxes is not None and not any(_overlaps(shape.bbox, b) for b in bboxes)):
+                continue
+            #same ids as the demographics table (written from integers, so without leading zeros)
+            chunk.append((str(int(record.record[id_field])), shape.__geo_interface__))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def polyfill_chunk(block_groups, resolution=H3_RESOLUTION):
+    """Returns (block group id, [integer H3 ids]) of every block group - run in the worker processes"""
+    from h3.api import basic_int as h3
+
+    results = []
+    for block_group_id, geometry in block_groups:
+        polygons = geometry['coordinates'] if geometry['type'] == 'MultiPolygon' else [geometry['coordinates']]
+        cells = set()
+        for polygon in polygons:
+            cells.update(h3.polyfill_geojson({'type': 'Polygon', 'coordinates': polygon}, resolution))
+        results.append((block_group_id, sorted(cells)))
+    return results
+
+
+def write_cells(cur, results):
+    """Replaces the censush3map rows of the block groups with COPY. Returns the number of rows written"""
+    cur.execute("DELETE FROM censush3map WHERE censusblockgroupid = ANY(%s)", ([r[0] for r in results], ))
+    buffer = io.StringIO()
+    count = 0
+    for block_group_id, cells in results:
+        buffer.writelines('{}\t{}\n'.format(block_group_id, h) for h in cells)
+        count += len(cells)
+    buffer.seek(0)
+    cur.copy_expert("COPY censush3map (censusblockgroupid, h3id) FROM STDIN", buffer)
+    return count
+
+
+def load_census_cells(cur, path, bboxes, workers=4, chunk_size=500, id_field='GEOID', resolution=H3_RESOLUTION):
+    """Polyfills the block groups of the shapefile in a process pool and writes them to censush3map as chunks complete.
+    At most 2 chunks per worker are in flight. Returns (block groups, cells) written.
+    """
+    cur.execute(CREATE_SQL)
+    block_groups, cells = 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        chunks = iter_block_groups(path, bboxes, id_field, chunk_size)
+        while True:
+            for chunk in chunks:
+                pending.add(executor.submit(polyfill_chunk, chunk, resolution))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results = future.result()
+                block_groups += len(results)
+                cells += write_cells(cur, results)
+    return block_groups, cells
+
+
+def split_city(db_params, city_id):
+    """Replaces the h3demographics rows of one city in a single transaction. Returns (city_id, rows written, seconds)"""
+    started = time.perf_counter()
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM h3demographics WHERE cityid = %s", (city_id, ))
+            cur.execute(SPLIT_SQL, {'city_id': city_id})
+            rows = cur.rowcount
+            data_version.bump(cur)
+    return city_id, rows, time.perf_counter() - started
+
+
+def recompute_catchments(db_params, city_ids, chunk_size=1000):
+    """Recomputes catchment_stats and step1_stats of the catchments covering cells of the cities, `chunk_size`
+    catchments per transaction. Returns the ids of all cities those catchments cover.
+    """
+    started = time.perf_counter()
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT DISTINCT c3m.catchmentid FROM catchmenth3map c3m
+                JOIN cityh3map ON cityh3map.h3id = c3m.h3id
+                WHERE cityh3map.cityid = ANY(%s)""", (list(city_ids), ))
+            catchment_ids = sorted(r[0] for r in cur.fetchall())
+        for i in range(0, len(catchment_ids), chunk_size):
+            with conn.cursor() as cur:
+                cw.recompute_stats(cur, catchment_ids[i:i + chunk_size])
+            conn.commit()
+        with conn.cursor() as cur:
+            #a catchment reaching into another city changes that city's accessibility too
+            cur.execute("""
+                SELECT DISTINCT cityh3map.cityid FROM catchmenth3map c3m
+                JOIN cityh3map ON cityh3map.h3id = c3m.h3id
+                WHERE c3m.catchmentid = ANY(%s)""", (catchment_ids, ))
+            affected = sorted(set(city_ids) | {r[0] for r in cur.fetchall()})
+    print("catchments {:10} recomputed {:8.1f}s".format(len(catchment_ids), time.perf_counter() - started))
+    return affected
+
+
+def ingest(db_params, path, city_ids=None, workers=4, chunk_size=500, id_field='GEOID', dataset_dir=None):
+    started = time.perf_counter()
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            if city_ids is None:
+                cur.execute("SELECT cityid, boundingbox FROM cities ORDER BY cityid")
+            else:
+                cur.execute("SELECT cityid, boundingbox FROM cities WHERE cityid = ANY(%s) ORDER BY cityid", (list(city_ids), ))
+            cities = cur.fetchall()
+            #without a bounding box, the block groups of a city cannot be told from the rest of the shapefile
+            for city_id, bbox in cities:
+                if bbox is None:
+                    print("  city {:<5} has no bounding box - skipped".format(city_id))
+            cities = [r for r in cities if r[1] is not None]
+            if not cities:
+                print("No cities to ingest")
+                return
+            city_ids = [r[0] for r in cities]
+            block_groups, cells = load_census_cells(cur, path, [r[1] for r in cities], workers, chunk_size, id_field)
+    print("censush3map {:10} block groups {:10} cells {:8.1f}s".format(block_groups, cells, time.perf_counter() - started))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(split_city, db_params, city_id) for city_id in city_ids]
+        for future in as_completed(futures):
+            city_id, rows, seconds = future.result()
+            print("  city {:<5} {:10} rows {:8.1f}s".format(city_id, rows, seconds))
+
+    affected = recompute_catchments(db_params, city_ids)
+    accessibility_stats.rebuild(db_params, affected, workers)
+    lod.build(db_params, affected, workers)
+    if dataset_dir:
+        #only cities the API serves from a dataset - the others are loaded from the database
+        exported = [city_id for city_id in affected if city_dataset.current_version(dataset_dir, city_id) is not None]
+        if exported:
+            city_dataset.export(db_params, dataset_dir, exported)
+
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            metadata.write(cur)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load census block groups into censush3map and h3demographics")
+    parser.add_argument('--config', default="../../config/config.ini", help="path to config.ini")
+    parser.add_argument('--shapefile', required=True, help="block group shapefile (.shp or zipped)")
+    parser.add_argument('--cities', nargs='+', type=int, default=None, help="city ids to ingest (all cities by default)")
+    parser.add_argument('--id-field', default='GEOID', help="shapefile field holding the block group id")
+    parser.add_argument('--workers', type=int, default=4, help="polyfill processes (and cities split in parallel)")
+    parser.add_argument('--chunk-size', type=int, default=500, help="block groups per polyfill task")
+    parser.add_argument('--dataset-dir', default=None, help="engine dataset directory (defaults to [ENGINE] dataset_dir)")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    dataset_dir = args.dataset_dir or config.get('ENGINE', 'dataset_dir', fallback=None)
+    ingest(dict(config['DB']), args.shapefile, args.cities, args.workers, args.chunk_size, args.id_field, dataset_dir)
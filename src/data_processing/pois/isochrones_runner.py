@@ -1,46 +1,207 @@
+"""Bulk precompute of POI catchment areas.
+
+Fans OTP requests out over a bounded pool of concurrent requests - one per origin, covering all --minutes cutoffs
+that are still missing for it - and writes the results
+(catchments, catchmenth3map rows and catchment/step1 statistics) in batched transactions.
+Progress is written to a JSON file after every batch - catchments already in the database are
+never recomputed, and origins that failed are skipped on resume unless --retry-failed is given.
+
+Example:
+    python isochrones_runner.py --cities Atlanta Dallas --times morning evening --concurrency 16 --batch-size 200
+"""
 from sqlalchemy import create_engine
-from sqlalchemy import Table, Column, Integer, String, MetaData, Index
-from geoalchemy2 import Geometry
 import itertools as itt
+import argparse
+import asyncio
+import json
+import os
+import time as tm
+import h3
 from tqdm import tqdm
 
 import sys
 sys.path.append("../../")
 
+import h3ids
 import isochrones as isc
+import metadata
 import configparser
 
-config = configparser.ConfigParser()
-config.read("../../../config/config.ini")    
-db_params = config['DB']
-opt_params = config['OTP']
-
-conn_string = 'postgresql://{user}:{password}@{host}:{port}/{dbname}'.format(**db_params)
-engine = create_engine(conn_string, echo=False, future=True)
-
-
-types = ['morning', 'afternoon', 'evening']
-timedistances = [30]
-cities = ['Atlanta', 'Dallas', 'Los Angeles', 'New York', 'Chicago']
-
-with engine.connect() as conn:
-    service = isc.IsochroneService(otp_port=opt_params['port'], pg_conn=conn, reference_date = opt_params['ref_date'], otp_host=opt_params['host'])
-
-    for timedist, timeofday, city in tqdm(list(itt.product(timedistances, types, cities))):
-        with conn.connection.cursor() as cur:
-            cur.execute("""
-                SELECT DISTINCT pois.h3id, cities.cityid FROM cities 
-                    JOIN cityh3map ON cityh3map.cityid = cities.cityid 
-                    JOIN pois ON pois.h3id = cityh3map.h3id
-                    LEFT JOIN catchments ON catchments.originh3id = pois.h3id AND catchments.timedistance = %s AND catchments.timeofday = %s
-                    WHERE 
-                        catchments.geometry IS NULL AND
-                        cities.cityname = %s
-                """,
-                (timedist, timeofday, city)
+
+TYPES = ['morning', 'afternoon', 'evening']
+TIMEDISTANCES = [30]
+CITIES = ['Atlanta', 'Dallas', 'Los Angeles', 'New York', 'Chicago']
+
+
+class Progress():
+    """Keeps track of completed/failed origins in a JSON file so that the job can be resumed after a crash"""
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {'completed': {}, 'failed': {}}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    @staticmethod
+    def key(timedist, timeofday, h3_id):
+        return '{}|{}|{}'.format(timedist, timeofday, h3ids.to_hex(h3_id))
+
+    def is_failed(self, timedist, timeofday, h3_id):
+        return self.key(timedist, timeofday, h3_id) in self.state['failed']
+
+    def record(self, combination, completed, failed):
+        combination = '|'.join(str(c) for c in combination)
+        self.state['completed'][combination] = self.state['completed'].get(combination, 0) + completed
+        for timedist, timeofday, h3_id, error in failed:
+            self.state['failed'][self.key(timedist, timeofday, h3_id)] = error
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        #write to a temporary file first so that a crash never leaves a truncated progress file behind
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.path)
+
+
+def find_missing(conn, timedists, timeofday, city):
+    """Returns {h3id: [missing time distances]} of the POI origins of the city"""
+    with conn.connection.cursor() as cur:
+        cur.execute("""
+            SELECT DISTINCT pois.h3id, cutoffs.timedistance FROM cities
+                JOIN cityh3map ON cityh3map.cityid = cities.cityid
+                JOIN pois ON pois.h3id = cityh3map.h3id
+                CROSS JOIN unnest(%s::integer[]) AS cutoffs(timedistance)
+                LEFT JOIN catchments ON catchments.originh3id = pois.h3id AND catchments.timedistance = cutoffs.timedistance AND catchments.timeofday = %s
+                WHERE
+                    catchments.geometry IS NULL AND
+                    cities.cityname = %s
+                ORDER BY 1, 2
+            """,
+            (list(timedists), timeofday, city)
+        )
+        missing = {}
+        for h3_id, timedist in cur.fetchall():
+            missing.setdefault(h3_id, []).append(timedist)
+        return missing
+
+
+async def compute(service, h3_id, city, timeofday, timedists):
+    """Computes the catchments of all the given cutoffs with one request"""
+    lat, lon = h3.h3_to_geo(h3ids.to_hex(h3_id))
+    cityname = city.lower().replace(" ", "_")
+    try:
+        catchments = await service.compute_catchment_set_async(lat, lon, cityname, timeofday, timedists)
+        return h3_id, timedists, catchments, None
+    except Exception as e:
+        return h3_id, timedists, None, repr(e)
+
+
+async def run(conn, service, args, progress):
+    loop = asyncio.get_running_loop()
+    started = tm.perf_counter()
+    total = 0
+
+    for timeofday, city in itt.product(args.times, args.cities):
+        missing = await loop.run_in_executor(None, find_missing, conn, args.minutes, timeofday, city)
+        todo = {}
+        for pid, timedists in missing.items():
+            timedists = [t for t in timedists if args.retry_failed or not progress.is_failed(t, timeofday, pid)]
+            if timedists:
+                todo[pid] = timedists
+        if not todo:
+            continue
+
+        #tasks are bounded by the OTP client semaphore, so only max_concurrency requests are in flight at once
+        tasks = [asyncio.ensure_future(compute(service, pid, city, timeofday, timedists)) for pid, timedists in todo.items()]
+        batch, failed = [], []
+        bar = tqdm(total=sum(len(t) for t in todo.values()), desc='{} / {} / {}min'.format(city, timeofday, ','.join(map(str, args.minutes))))
+
+        async def flush():
+            nonlocal batch, failed, total
+            #all cutoffs of an origin are in the same batch, so their cells and statistics are written in one transaction
+            if batch:
+                await loop.run_in_executor(None, service.save_isochrones, batch)
+            progress.record((timeofday, city), len(batch), failed)
+            total += len(batch)
+            bar.update(len(batch) + len(failed))
+            bar.set_postfix(
+                isochrones_per_sec='{:.2f}'.format(total / (tm.perf_counter() - started)),
+                cells_written=service.writer.totals['cells'],
             )
-            res = cur.fetchall()
+            batch, failed = [], []
+
+        for task in asyncio.as_completed(tasks):
+            h3_id, timedists, catchments, error = await task
+            if error is None:
+                batch.extend((h3_id, timeofday, t, isochrone, real, cells) for t, (isochrone, real, cells) in zip(timedists, catchments))
+            else:
+                failed.extend((t, timeofday, h3_id, error) for t in timedists)
+
+            #OTP requests keep running in the background while a batch is written
+            if len(batch) + len(failed) >= args.batch_size:
+                await flush()
+        await flush()
+        bar.close()
+
+    elapsed = tm.perf_counter() - started
+    print("Computed {} isochrones in {:.1f}s ({:.2f} isochrones/s)".format(total, elapsed, total / elapsed if elapsed else 0))
+    writes = service.writer.totals
+    print("Wrote {} catchments and {} catchmenth3map rows in {:.1f}s of database time ({} already created by another worker)".format(
+        writes['catchments'], writes['cells'], writes['seconds'], writes['skipped']
+    ))
+
+
+async def main(args):
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    db_params = config['DB']
+    opt_params = config['OTP']
+    backend_params = dict(config['ISOCHRONES']) if config.has_section('ISOCHRONES') else None
+
+    conn_string = 'postgresql://{user}:{password}@{host}:{port}/{dbname}'.format(**db_params)
+    engine = create_engine(conn_string, echo=False, future=True)
+
+    otp_client = isc.OTPClient(
+        max_concurrency=args.concurrency or opt_params.get('max_concurrency', 8),
+        timeout=opt_params.get('timeout', 60),
+        retries=opt_params.get('retries', 3)
+    )
+    await otp_client.open()
+    progress = Progress(args.progress_file)
+
+    try:
+        with engine.connect() as conn:
+            service = isc.IsochroneService(
+                otp_port=opt_params['port'], pg_conn=conn, reference_date = opt_params['ref_date'], otp_host=opt_params['host'], otp_client=otp_client,
+                isochrone_backend=isc.make_isochrone_backend(backend_params, opt_params['ref_date'])
+            )
+            await run(conn, service, args, progress)
+            #new times of day and catchment counts for /configuration
+            if not conn.in_transaction():
+                conn.begin()
+            with conn.connection.cursor() as cur:
+                print("Metadata snapshot version {}".format(metadata.write(cur)))
+            conn.commit()
+    finally:
+        await otp_client.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Precompute catchment areas for all POIs")
+    parser.add_argument('--config', default="../../../config/config.ini", help="path to config.ini")
+    parser.add_argument('--cities', nargs='+', default=CITIES)
+    parser.add_argument('--times', nargs='+', default=TYPES, choices=TYPES)
+    parser.add_argument('--minutes', nargs='+', type=int, default=TIMEDISTANCES, help="cutoffs, all requested from OTP at once")
+    parser.add_argument('--concurrency', type=int, default=None, help="OTP requests in flight (defaults to [OTP] max_concurrency)")
+    parser.add_argument('--batch-size', type=int, default=100, help="isochrones written per transaction")
+    parser.add_argument('--progress-file', default='isochrones_progress.json', help="where to record progress (empty to disable)")
+    parser.add_argument('--retry-failed', action='store_true', help="retry origins that failed in previous runs")
+    return parser.parse_args()
+
 
-            for pid, cityid in tqdm(res):                
-                service.get_isochrone(city_id = cityid, h3_id= pid, time = timeofday, minutes=timedist)                
-                
\ No newline at end of file
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -0,0 +1,19 @@
+"""A single global counter that is bumped whenever derived data (catchments, statistics) changes.
+
+Readers (e.g. the API response cache) compare it against the version their cached data was computed with.
+All functions take a psycopg2 cursor, so the bump happens in the caller's transaction.
+"""
+
+#the table and its single row are created by sql/schema.sql - reads and bumps are plain statements, so the API
+#never runs DDL on its read path
+
+
+def bump(cur):
+    """Increments the data version and returns the new value"""
+    cur.execute("UPDATE data_version SET version = version + 1 WHERE id = 1 RETURNING version")
+    return cur.fetchone()[0]
+
+
+def get(cur):
+    cur.execute("SELECT version FROM data_version WHERE id = 1")
+    return cur.fetchone()[0]
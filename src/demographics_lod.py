@@ -0,0 +1,215 @@
+"""Level-of-detail pyramid of city demographics for zoomed-out maps.
+
+For every city, the resolution 9 demographics are aggregated to parent H3 cells of coarser resolutions:
+populations are summed and accessibility is weighted by the population of the category type (all groups).
+The aggregates are stored in two tables - demographics_lod (per group, independent of POIs) and accessibility_lod
+(per POI category and time of day) - so a zoomed-out /demographics request reads a small fraction of the rows.
+
+accessibility_stats changes as catchments are added: apply_catchments() and accessibility_stats rebuilds mark the
+accessibility of the cities they touch as stale in lod_builds, and the API aggregates accessibility on the fly until
+the pyramid is rebuilt (as for cities without a pyramid). Rebuild after bulk catchment runs:
+
+    python demographics_lod.py --workers 4
+"""
+import argparse
+import configparser
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import psycopg2
+from h3.api import basic_int as h3
+
+import data_version
+
+H3_RESOLUTION = 9
+RESOLUTIONS = (5, 6, 7, 8)
+
+#coarsest resolution whose cells are still larger than a few pixels at a web map zoom level
+ZOOM_RESOLUTIONS = {9: 5, 10: 6, 11: 7, 12: 8}
+
+CREATE_SQL = """
+CREATE TABLE IF NOT EXISTS public.demographics_lod
+(
+    cityid integer NOT NULL,
+    resolution smallint NOT NULL,
+    h3id bigint NOT NULL,
+    categorytype text NOT NULL,
+    groupname text NOT NULL,
+    population double precision NOT NULL
+);
+--h3id last for viewport range scans (see viewport.py)
+CREATE INDEX IF NOT EXISTS demographics_lod_index ON public.demographics_lod (cityid, resolution, categorytype, h3id);
+
+CREATE TABLE IF NOT EXISTS public.accessibility_lod
+(
+    cityid integer NOT NULL,
+    resolution smallint NOT NULL,
+    h3id bigint NOT NULL,
+    categorytype text NOT NULL,
+    poi_category text NOT NULL,
+    timeofday text NOT NULL,
+    accessibility double precision
+);
+CREATE INDEX IF NOT EXISTS accessibility_lod_index ON public.accessibility_lod (cityid, resolution, categorytype, poi_category, timeofday);
+"""
+
+
+def mark_stale(cur, city_ids):
+    """Marks the accessibility of the pyramids of the given cities as out of date, in the caller's transaction.
+    lod_builds is created by sql/schema.sql, so this is a plain UPDATE.
+    """
+    cur.execute(
+        "UPDATE lod_builds SET accessibility_stale = true WHERE cityid = ANY(%s) AND NOT accessibility_stale", (list(city_ids), )
+    )
+
+
+def resolution_for_zoom(zoom):
+    """H3 resolution to serve at a web map zoom level (None for full detail)"""
+    if zoom >= max(ZOOM_RESOLUTIONS) + 1:
+        return None
+    return ZOOM_RESOLUTIONS.get(zoom, min(ZOOM_RESOLUTIONS.values()))
+
+
+class Parents():
+    """Memoized h3_to_parent of integer H3 ids - cells are looked up once per resolution"""
+
+    def __init__(self, resolution):
+        self.resolution = resolution
+        self.cache = {}
+
+    def __call__(self, h3_id):
+        parent = self.cache.get(h3_id)
+        if parent is None:
+            parent = self.cache[h3_id] = h3.h3_to_parent(h3_id, self.resolution)
+        return parent
+
+
+def parent_populations(rows, parent):
+    """Sums (h3id, groupname, population) rows into {(parent h3id, groupname): population}"""
+    result = {}
+    for h3_id, groupname, population in rows:
+        key = (parent(h3_id), groupname)
+        result[key] = result.get(key, 0) + (population or 0)
+    return result
+
+
+def parent_accessibility(accessibility, weights, parent):
+    """Population-weighted mean of {h3id: accessibility} per parent cell, given {h3id: population}.
+    Parents without population get the plain mean of their cells.
+    """
+    sums = {}
+    for h3_id, value in accessibility.items():
+        if value is None:
+            continue
+        weight = weights.get(h3_id, 0)
+        p = parent(h3_id)
+        weighted, total, plain, count = sums.get(p, (0, 0, 0, 0))
+        sums[p] = (weighted + value * weight, total + weight, plain + value, count + 1)
+    return {p: weighted / total if total > 0 else plain / count for p, (weighted, total, plain, count) in sums.items()}
+
+
+def aggregate_rows(rows, resolution, detailed):
+    """Aggregates /demographics rows (h3id, groupname, population, accessibility) to parent cells, in the same format"""
+    parent = Parents(resolution)
+    populations = parent_populations(((r[0], r[1], r[2]) for r in rows), parent)
+    if not detailed:
+        return [(h3_id, groupname, population, None) for (h3_id, groupname), population in populations.items()]
+
+    weights, accessibility = {}, {}
+    for h3_id, _, population, value in rows:
+        weights[h3_id] = weights.get(h3_id, 0) + (population or 0)
+        accessibility[h3_id] = value
+    parent_values = parent_accessibility(accessibility, weights, parent)
+    return [(h3_id, groupname, population, parent_values.get(h3_id)) for (h3_id, groupname), population in populations.items()]
+
+
+def copy_rows(cur, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join('\\N' if v is None else str(v) for v in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cur.copy_expert("COPY {} ({}) FROM STDIN".format(table, ', '.join(columns)), buffer)
+
+
+def build_city(db_params, city_id, resolutions=RESOLUTIONS):
+    """Replaces the pyramid of one city in a single transaction. Returns (city_id, rows written, seconds)"""
+    started = time.perf_counter()
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_SQL)
+            #the row is locked until commit, so catchments applied while the pyramid is built mark it stale afterwards
+            cur.execute("""
+                INSERT INTO lod_builds (cityid, accessibility_stale) VALUES (%s, false)
+                ON CONFLICT (cityid) DO UPDATE SET accessibility_stale = false""", (city_id, ))
+            cur.execute("SELECT h3id, categorytype, groupname, population FROM h3demographics WHERE cityid = %s", (city_id, ))
+            demographics = cur.fetchall()
+            cur.execute(
+                "SELECT h3id, categorytype, poi_category, timeofday, accessibility FROM accessibility_stats WHERE cityid = %s",
+                (city_id, )
+            )
+            accessibility = {}
+            for h3_id, categorytype, poi_category, timeofday, value in cur.fetchall():
+                accessibility.setdefault((categorytype, poi_category, timeofday), {})[h3_id] = value
+
+            by_type, weights = {}, {}
+            for h3_id, categorytype, groupname, population in demographics:
+                by_type.setdefault(categorytype, []).append((h3_id, groupname, population))
+                type_weights = weights.setdefault(categorytype, {})
+                type_weights[h3_id] = type_weights.get(h3_id, 0) + (population or 0)
+
+            cur.execute("DELETE FROM demographics_lod WHERE cityid = %s", (city_id, ))
+            cur.execute("DELETE FROM accessibility_lod WHERE cityid = %s", (city_id, ))
+            rows = 0
+            for resolution in resolutions:
+                parent = Parents(resolution)
+                population_rows = [
+                    (city_id, resolution, h3_id, categorytype, groupname, population)
+                    for categorytype, type_rows in by_type.items()
+                    for (h3_id, groupname), population in parent_populations(type_rows, parent).items()
+                ]
+                accessibility_rows = [
+                    (city_id, resolution, h3_id, categorytype, poi_category, timeofday, value)
+                    for (categorytype, poi_category, timeofday), values in accessibility.items()
+                    for h3_id, value in parent_accessibility(values, weights.get(categorytype, {}), parent).items()
+                ]
+                copy_rows(cur, 'demographics_lod', ['cityid', 'resolution', 'h3id', 'categorytype', 'groupname', 'population'], population_rows)
+                copy_rows(
+                    cur, 'accessibility_lod',
+                    ['cityid', 'resolution', 'h3id', 'categorytype', 'poi_category', 'timeofday', 'accessibility'], accessibility_rows
+                )
+                rows += len(population_rows) + len(accessibility_rows)
+            data_version.bump(cur)
+    return city_id, rows, time.perf_counter() - started
+
+
+def build(db_params, city_ids=None, workers=4, resolutions=RESOLUTIONS):
+    """Builds the pyramid of the given cities (all cities if None), each on its own connection"""
+    if city_ids is None:
+        with psycopg2.connect(**db_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT cityid FROM cities ORDER BY cityid")
+                city_ids = [r[0] for r in cur.fetchall()]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(build_city, db_params, city_id, resolutions) for city_id in city_ids]
+        for future in as_completed(futures):
+            city_id, rows, seconds = future.result()
+            print("  city {:<5} {:10} rows {:8.1f}s".format(city_id, rows, seconds))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the level-of-detail pyramid of city demographics")
+    parser.add_argument('--config', default="../config/config.ini", help="path to config.ini")
+    parser.add_argument('--cities', nargs='+', type=int, default=None, help="city ids to build (all cities by default)")
+    parser.add_argument('--resolutions', nargs='+', type=int, default=list(RESOLUTIONS))
+    parser.add_argument('--workers', type=int, default=4, help="cities built in parallel")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    build(dict(config['DB']), args.cities, args.workers, args.resolutions)
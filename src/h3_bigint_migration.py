@@ -0,0 +1,106 @@
+"""Converts the H3 id columns of an existing database from hex strings (char(15)/varchar) to bigint.
+
+Everything runs in a single transaction: the range indexes that compared the hex strings byte-wise are dropped,
+the columns are converted in place (their other indexes are rebuilt by ALTER TABLE), the api_* functions are
+recreated with bigint ids from sql/schema.sql, and the data version is bumped so cached responses are dropped.
+Columns that are already bigint are skipped, so the script can be run again safely - it then only applies
+sql/schema.sql, which creates the tables added since (e.g. the data_version and metadata_snapshot counters
+and lod_builds).
+The API has to be upgraded at the same time - it expects bigint ids.
+
+    python h3_bigint_migration.py --config ../config/config.ini
+"""
+import argparse
+import configparser
+import os
+import time
+
+import psycopg2
+
+import data_version
+
+#(table, column) of every H3 id in the schema
+COLUMNS = [
+    ('cityh3map', 'h3id'),
+    ('pois', 'h3id'),
+    ('h3demographics', 'h3id'),
+    ('censush3map', 'h3id'),
+    ('catchments', 'originh3id'),
+    ('catchmenth3map', 'h3id'),
+    ('step1_stats', 'h3id'),
+    ('accessibility_stats', 'h3id'),
+    ('demographics_lod', 'h3id'),
+    ('accessibility_lod', 'h3id'),
+]
+
+#indexes on h3id COLLATE "C" - recreated without the collation by schema.sql (and demographics_lod.py)
+DROP_INDEXES_SQL = """
+DROP INDEX IF EXISTS poi_h3_range;
+DROP INDEX IF EXISTS h3demographics_h3_range;
+DROP INDEX IF EXISTS demographics_lod_index;
+"""
+
+#their return or argument types change, which CREATE OR REPLACE cannot do
+DROP_FUNCTIONS_SQL = """
+DROP FUNCTION IF EXISTS api_get_city_stats(integer, varchar, varchar, text, character[], character[]);
+DROP FUNCTION IF EXISTS api_add_remove_catchments(character[], character[], varchar, text, varchar);
+DROP FUNCTION IF EXISTS api_get_pois_for_city(integer, character);
+DROP FUNCTION IF EXISTS api_get_demographics_for_city(integer, character);
+"""
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sql', 'schema.sql')
+
+
+def text_columns(cur):
+    """(table, column) pairs of COLUMNS that still hold hex strings"""
+    cur.execute("""
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_schema = 'public' AND lower(table_name) = ANY(%s) AND lower(column_name) = ANY(%s) AND data_type <> 'bigint'
+    """, ([t for t, _ in COLUMNS], list({c for _, c in COLUMNS})))
+    found = {(t.lower(), c.lower()) for t, c in cur.fetchall()}
+    return [(t, c) for t, c in COLUMNS if (t, c) in found]
+
+
+def migrate(db_params):
+    with psycopg2.connect(**db_params) as conn:
+        with conn.cursor() as cur:
+            columns = text_columns(cur)
+            if not columns:
+                #still creates what newer versions of the schema added
+                with open(SCHEMA_PATH) as f:
+                    cur.execute(f.read())
+                print("H3 ids are already bigint - schema.sql applied")
+                return
+            cur.execute(DROP_INDEXES_SQL)
+            for table, column in columns:
+                started = time.perf_counter()
+                #hex string -> bit(64) -> bigint; the top bit of an H3 index is 0, so the values stay positive
+                cur.execute(
+                    "ALTER TABLE public.{0} ALTER COLUMN {1} TYPE bigint USING ('x' || lpad(trim({1}), 16, '0'))::bit(64)::bigint"
+                    .format(table, column)
+                )
+                print("  {}.{} converted in {:.1f}s".format(table, column, time.perf_counter() - started))
+            cur.execute(DROP_FUNCTIONS_SQL)
+            with open(SCHEMA_PATH) as f:
+                cur.execute(f.read())
+            if ('demographics_lod', 'h3id') in columns:
+                cur.execute("CREATE INDEX demographics_lod_index ON public.demographics_lod (cityid, resolution, categorytype, h3id)")
+            data_version.bump(cur)
+        conn.commit()
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            for table in sorted({t for t, _ in columns}):
+                cur.execute("ANALYZE public.{}".format(table))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert H3 id columns from hex strings to bigint")
+    parser.add_argument('--config', default="../config/config.ini", help="path to config.ini")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    migrate(dict(config['DB']))
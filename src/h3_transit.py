@@ -0,0 +1,318 @@
+"""In-process walk + transit reachability on the H3 grid - an alternative to OTP isochrones.
+
+A GTFS feed is reduced to the connections (one vehicle moving between two consecutive stops) of the services running
+on the reference date, with stops mapped to H3 cells. A catchment is then computed with the connection scan algorithm:
+
+    1. walk from the origin cell (Dijkstra over the walking graph, limited to max_walk_distance)
+    2. scan the connections departing within the time budget in order of departure, boarding trips at stops reached
+       in time (with min_transfer_time between vehicles and short walks between nearby stops)
+    3. walk again from the origin and every stop reached, within what is left of the time budget
+
+The result is the set of reachable cells - the writer stores those as they are instead of polyfilling a polygon,
+which is only derived from the cells for catchments.geometry.
+The walking graph connects neighbouring cells at walking speed, unless a precomputed adjacency (e.g. from a street
+network) is loaded with WalkGraph.load().
+
+frequencies.txt is not supported - feeds need explicit stop times.
+"""
+import csv
+import datetime
+import heapq
+import io
+import os
+import threading
+import zipfile
+from bisect import bisect_left
+
+import h3
+import numpy as np
+from shapely.geometry import MultiPolygon, Polygon
+
+#OTP's default walking speed in m/s
+WALK_SPEED = 1.33
+
+
+def gtfs_seconds(value):
+    """Seconds after midnight of a GTFS time (HH:MM:SS, hours may go past 24)"""
+    hours, minutes, seconds = value.strip().split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def clock_seconds(value):
+    """Seconds after midnight of an OTP time like '08:00am'"""
+    parsed = datetime.datetime.strptime(value.strip().lower(), '%I:%M%p')
+    return parsed.hour * 3600 + parsed.minute * 60
+
+
+def cells_to_multipolygon(cells):
+    polygons = h3.h3_set_to_multi_polygon(set(cells), geo_json=True)
+    return MultiPolygon([Polygon(p[0], p[1:]) for p in polygons])
+
+
+class GTFSFeed():
+    """Connections of all trips running on `date` (a datetime.date), sorted by departure time.
+
+    `path` is a directory with the GTFS .txt files or a .zip archive of them.
+    """
+
+    def __init__(self, path, date, resolution=9):
+        self.path = path
+        self.date = date
+        self.resolution = resolution
+
+        self.stop_cells = []
+        stop_index = {}
+        for row in self.read('stops.txt'):
+            if not row.get('stop_lat') or not row.get('stop_lon'):
+                continue
+            stop_index[row['stop_id']] = len(self.stop_cells)
+            self.stop_cells.append(h3.geo_to_h3(float(row['stop_lat']), float(row['stop_lon']), resolution))
+        self.cell_stops = {}
+        for stop, cell in enumerate(self.stop_cells):
+            self.cell_stops.setdefault(cell, []).append(stop)
+
+        services = self.active_services()
+        trip_index = {}
+        for row in self.read('trips.txt'):
+            if row['service_id'] in services:
+                trip_index[row['trip_id']] = len(trip_index)
+
+        stop_times = {}
+        for row in self.read('stop_times.txt'):
+            trip = trip_index.get(row['trip_id'])
+            stop = stop_index.get(row['stop_id'])
+            #stops without times (to be interpolated) are skipped, the vehicle then runs straight between timed stops
+            if trip is None or stop is None or not row.get('departure_time') or not row.get('arrival_time'):
+                continue
+            stop_times.setdefault(trip, []).append(
+                (int(row['stop_sequence']), stop, gtfs_seconds(row['arrival_time']), gtfs_seconds(row['departure_time']))
+            )
+
+        connections = []
+        for trip, times in stop_times.items():
+            times.sort()
+            for (_, from_stop, _, departure), (_, to_stop, arrival, _) in zip(times, times[1:]):
+                connections.append((departure, arrival, from_stop, to_stop, trip))
+        connections.sort()
+
+        #plain lists - the scan reads them element by element, which is much faster than indexing numpy arrays
+        self.departures = [c[0] for c in connections]
+        self.arrivals = [c[1] for c in connections]
+        self.from_stops = [c[2] for c in connections]
+        self.to_stops = [c[3] for c in connections]
+        self.trips = [c[4] for c in connections]
+
+    def read(self, name):
+        """Yields the rows of one GTFS file as dicts (no rows if the file is missing)"""
+        if zipfile.is_zipfile(self.path):
+            with zipfile.ZipFile(self.path) as archive:
+                if name not in archive.namelist():
+                    return
+                with archive.open(name) as f:
+                    yield from csv.DictReader(io.TextIOWrapper(f, encoding='utf-8-sig'))
+        else:
+            file_path = os.path.join(self.path, name)
+            if not os.path.exists(file_path):
+                return
+            with open(file_path, encoding='utf-8-sig', newline='') as f:
+                yield from csv.DictReader(f)
+
+    def active_services(self):
+        day = self.date.strftime('%Y%m%d')
+        weekday = self.date.strftime('%A').lower()
+        services = set()
+        for row in self.read('calendar.txt'):
+            if row['start_date'] <= day <= row['end_date'] and row.get(weekday) == '1':
+                services.add(row['service_id'])
+        for row in self.read('calendar_dates.txt'):
+            if row['date'] == day:
+                if row['exception_type'] == '1':
+                    services.add(row['service_id'])
+                else:
+                    services.discard(row['service_id'])
+        return services
+
+
+class WalkGraph():
+    """Walking times in seconds between neighbouring H3 cells.
+
+    Without an adjacency, every cell is connected to its six neighbours at walking speed (straight line distance).
+    """
+
+    def __init__(self, walk_speed=WALK_SPEED, adjacency=None):
+        self.walk_speed = walk_speed
+        #cell -> [(neighbour, seconds)], precomputed
+        self.adjacency = adjacency
+        self._cache = {}
+
+    def neighbours(self, cell):
+        if self.adjacency is not None:
+            return self.adjacency.get(cell, ())
+        result = self._cache.get(cell)
+        if result is None:
+            origin = h3.h3_to_geo(cell)
+            result = [
+                (n, h3.point_dist(origin, h3.h3_to_geo(n), unit='m') / self.walk_speed)
+                for n in h3.k_ring(cell, 1) if n != cell
+            ]
+            self._cache[cell] = result
+        return result
+
+    @classmethod
+    def load(cls, path):
+        """Loads an adjacency saved with save() - an .npz file with cells, CSR indptr/indices and seconds"""
+        data = np.load(path, allow_pickle=False)
+        cells = data['cells'].astype(str).tolist()
+        indptr, indices, seconds = data['indptr'], data['indices'].tolist(), data['seconds'].tolist()
+        adjacency = {
+            cell: [(cells[j], seconds[k]) for k, j in enumerate(indices[indptr[i]:indptr[i + 1]], start=indptr[i])]
+            for i, cell in enumerate(cells)
+        }
+        return cls(adjacency=adjacency)
+
+    def save(self, path, cells):
+        """Saves the walking times between the given cells (e.g. all cells of a city)"""
+        cells = sorted(cells)
+        index = {c: i for i, c in enumerate(cells)}
+        indptr, indices, seconds = [0], [], []
+        for cell in cells:
+            for neighbour, s in self.neighbours(cell):
+                if neighbour in index:
+                    indices.append(index[neighbour])
+                    seconds.append(s)
+            indptr.append(len(indices))
+        np.savez(
+            path, cells=np.array(cells, dtype='S15'), indptr=np.array(indptr, dtype=np.int64),
+            indices=np.array(indices, dtype=np.int64), seconds=np.array(seconds, dtype=np.float32)
+        )
+
+
+class H3TransitEngine():
+    """Walk + transit catchments of one city"""
+
+    def __init__(self, feed, walk=None, max_walk_distance=1500, min_transfer_time=120, transfer_distance=400):
+        self.feed = feed
+        self.walk_graph = walk or WalkGraph()
+        self.max_walk_seconds = max_walk_distance / self.walk_graph.walk_speed
+        self.min_transfer_time = min_transfer_time
+        self.transfer_seconds = transfer_distance / self.walk_graph.walk_speed
+        self._transfers = {}
+
+    def walk(self, sources, deadline, max_seconds):
+        """Multi-source Dijkstra - `sources` are (time, cell) pairs; returns {cell: earliest arrival}.
+        Every walk is limited to max_seconds from the source it started at.
+        """
+        best = {}
+        heap = [(t, 0.0, cell) for t, cell in sources if t <= deadline]
+        heapq.heapify(heap)
+        while heap:
+            t, walked, cell = heapq.heappop(heap)
+            if cell in best:
+                continue
+            best[cell] = t
+            for neighbour, seconds in self.walk_graph.neighbours(cell):
+                if neighbour not in best and t + seconds <= deadline and walked + seconds <= max_seconds:
+                    heapq.heappush(heap, (t + seconds, walked + seconds, neighbour))
+        return best
+
+    def transfers(self, stop):
+        """Stops within transfer_distance of a stop, with the walking time to them"""
+        result = self._transfers.get(stop)
+        if result is None:
+            reached = self.walk([(0.0, self.feed.stop_cells[stop])], self.transfer_seconds, self.transfer_seconds)
+            result = [
+                (other, seconds)
+                for cell, seconds in reached.items() for other in self.feed.cell_stops.get(cell, ()) if other != stop
+            ]
+            self._transfers[stop] = result
+        return result
+
+    def reachable(self, origin, departure, minutes):
+        """Returns {cell: seconds after departure} of all cells reachable from the origin cell within `minutes`"""
+        feed = self.feed
+        deadline = departure + minutes * 60
+        access = self.walk([(departure, origin)], deadline, self.max_walk_seconds)
+
+        #earliest time a trip can be boarded at a stop, and the earliest arrival at a stop
+        ready = {}
+        arrival = {}
+        for cell, t in access.items():
+            for stop in feed.cell_stops.get(cell, ()):
+                ready[stop] = min(ready.get(stop, t), t)
+                arrival[stop] = min(arrival.get(stop, t), t)
+
+        boarded = set()
+        departures, arrivals, from_stops, to_stops, trips = feed.departures, feed.arrivals, feed.from_stops, feed.to_stops, feed.trips
+        for i in range(bisect_left(departures, departure), len(departures)):
+            if departures[i] > deadline:
+                break
+            trip = trips[i]
+            if trip not in boarded:
+                if ready.get(from_stops[i], deadline + 1) > departures[i]:
+                    continue
+                boarded.add(trip)
+            t = arrivals[i]
+            stop = to_stops[i]
+            if t > deadline or t >= arrival.get(stop, deadline + 1):
+                continue
+            arrival[stop] = t
+            ready[stop] = min(ready.get(stop, deadline + 1), t + self.min_transfer_time)
+            for other, seconds in self.transfers(stop):
+                transfer = t + max(seconds, self.min_transfer_time)
+                if transfer < ready.get(other, deadline + 1):
+                    ready[other] = transfer
+
+        sources = [(departure, origin)] + [(t, feed.stop_cells[stop]) for stop, t in arrival.items()]
+        reached = self.walk(sources, deadline, self.max_walk_seconds)
+        return {cell: t - departure for cell, t in reached.items()}
+
+
+class H3IsochroneBackend():
+    """Isochrone backend for IsochroneService built on H3TransitEngine.
+
+    GTFS feeds are read from <gtfs_dir>/<city> (a directory or <city>.zip), where city is the OTP router name
+    (e.g. 'los_angeles'). Precomputed walking adjacencies are read from <walk_dir>/<city>.npz if present.
+    Engines are built on first use and kept for the lifetime of the backend.
+    """
+
+    def __init__(self, gtfs_dir, reference_date, walk_dir=None, max_walk_distance=1500, min_transfer_time=120, resolution=9):
+        self.gtfs_dir = gtfs_dir
+        self.date = datetime.datetime.strptime(reference_date, '%m-%d-%Y').date()
+        self.walk_dir = walk_dir
+        self.max_walk_distance = float(max_walk_distance)
+        self.min_transfer_time = float(min_transfer_time)
+        self.resolution = resolution
+        self.engines = {}
+        #catchments are computed in executor threads - build each city once
+        self._lock = threading.Lock()
+
+    def engine(self, city):
+        with self._lock:
+            return self.engines.get(city) or self._load(city)
+
+    def _load(self, city):
+        path = os.path.join(self.gtfs_dir, city)
+        if not os.path.exists(path):
+            path += '.zip'
+        walk = None
+        if self.walk_dir and os.path.exists(os.path.join(self.walk_dir, city + '.npz')):
+            walk = WalkGraph.load(os.path.join(self.walk_dir, city + '.npz'))
+        engine = H3TransitEngine(
+            GTFSFeed(path, self.date, self.resolution), walk, self.max_walk_distance, self.min_transfer_time
+        )
+        self.engines[city] = engine
+        return engine
+
+    def catchment(self, lat, lon, city, time_spec, minutes):
+        """Returns (isochrone, cells) - time_spec is the departure time, e.g. '08:00am'"""
+        return self.catchments(lat, lon, city, time_spec, [minutes])[0]
+
+    def catchments(self, lat, lon, city, time_spec, minutes):
+        """Returns (isochrone, cells) for each cutoff in `minutes` from a single search up to the largest one"""
+        origin = h3.geo_to_h3(lat, lon, self.resolution)
+        reached = self.engine(city).reachable(origin, clock_seconds(time_spec), max(minutes))
+        result = []
+        for m in minutes:
+            cells = {cell for cell, seconds in reached.items() if seconds <= m * 60}
+            result.append((cells_to_multipolygon(cells), cells))
+        return result
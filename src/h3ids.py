@@ -0,0 +1,40 @@
+"""H3 ids as 64-bit integers.
+
+The database stores H3 ids as bigint - the top bit of an H3 index is always 0, so it fits a signed 64-bit integer -
+and the Python layers keep them as ints (numpy uint64 for arrays). They are turned into the usual 15 character hex
+strings only at the JSON boundary, and request parameters are parsed back with to_int(), which accepts either form.
+
+Importing this module registers psycopg2 adapters, so numpy integers can be passed as query parameters.
+"""
+import numpy as np
+from psycopg2.extensions import AsIs, register_adapter
+
+register_adapter(np.uint64, AsIs)
+register_adapter(np.int64, AsIs)
+
+
+def to_int(h3_id):
+    """Integer form of an H3 id given as a hex string or an integer"""
+    if isinstance(h3_id, str):
+        return int(h3_id, 16)
+    return int(h3_id)
+
+
+def to_hex(h3_id):
+    """Hex string form of an H3 id given as an integer or a hex string"""
+    if isinstance(h3_id, str):
+        return h3_id.lower()
+    return '%x' % h3_id
+
+
+def to_ints(h3_ids):
+    return [to_int(h) for h in h3_ids or ()]
+
+
+def to_hexes(h3_ids):
+    return [to_hex(h) for h in h3_ids or ()]
+
+
+def array(h3_ids):
+    """numpy uint64 array of H3 ids given in either form"""
+    return np.array(to_ints(h3_ids), dtype=np.uint64)
@@ -1,11 +1,92 @@
-from sqlalchemy import Table, MetaData
-from geoalchemy2.shape import from_shape, to_shape
-from geoalchemy2.elements import WKBElement
-import requests
-import geopandas as gpd
+import asyncio
+import logging
+import time as tm
+import httpx
+import orjson
 import h3
-from shapely.geometry import Polygon, MultiPolygon, mapping
-from sqlalchemy import text
+from shapely import wkb
+from shapely.geometry import Polygon, MultiPolygon, shape
+
+import catchment_writer as cw
+import h3ids
+import metrics
+
+logger = logging.getLogger(__name__)
+
+def to_shape(geometry):
+    """Shapely geometry of a PostGIS geometry column value - psycopg2 returns hex-encoded EWKB (or bytes for ST_AsBinary)"""
+    if isinstance(geometry, str):
+        return wkb.loads(geometry, hex=True)
+    return wkb.loads(bytes(geometry))
+
+
+NO_ROUTE = 'org.opentripplanner.routing.error.VertexNotFoundException: vertices not found: [from] vertices not found: [from]'
+RETRY_STATUSES = (502, 503, 504)
+
+
+class OTPClient():
+    """Async client for the OTP API. Keeps a pool of keep-alive connections, bounds the number of requests in flight
+    and retries transient errors (gateway 5xx responses, timeouts and connection errors) with exponential backoff.
+    Needs to be opened (and closed) inside a running event loop.
+    """
+
+    def __init__(self, max_concurrency = 8, timeout = 60, retries = 3, backoff = 0.5):
+        self.max_concurrency = int(max_concurrency)
+        self.timeout = float(timeout)
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.client = None
+        self.semaphore = None
+
+    async def open(self):
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        self.client = httpx.AsyncClient(limits=limits, timeout=self.timeout)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def get(self, url, params):
+        """Issues a GET request and returns (status code, body text)"""
+        assert self.client is not None, "OTP client is not open"
+        async with self.semaphore:
+            for attempt in range(self.retries + 1):
+                last_attempt = attempt == self.retries
+                try:
+                    response = await self.client.get(url, params=params)
+                except (httpx.TimeoutException, httpx.NetworkError):
+                    if last_attempt:
+                        raise
+                else:
+                    if response.status_code not in RETRY_STATUSES or last_attempt:
+                        return response.status_code, response.text
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+
+def cutoffs(minutes):
+    """A single cutoff or a list of them, as a list without duplicates"""
+    return list(dict.fromkeys(minutes)) if isinstance(minutes, (list, tuple)) else [minutes]
+
+
+def make_isochrone_backend(params, reference_date):
+    """Builds the isochrone backend selected in the [ISOCHRONES] config section - None means OTP"""
+    params = params or {}
+    backend = params.get('backend', 'otp')
+    if backend == 'otp':
+        return None
+    if backend == 'h3':
+        import h3_transit
+        return h3_transit.H3IsochroneBackend(
+            params['gtfs_dir'],
+            reference_date,
+            walk_dir=params.get('walk_dir') or None,
+            max_walk_distance=params.get('max_walk_distance', 1500),
+            min_transfer_time=params.get('min_transfer_time', 120),
+        )
+    raise ValueError("Unknown isochrone backend {}".format(backend))
+
 
 class IsochroneService():
 
@@ -21,9 +102,13 @@ class IsochroneService():
         otp_port = 8801,
         pg_conn = None,
         otp_host= 'localhost',
+        otp_client = None,
+        otp_timeout = 60,
+        otp_retries = 3,
+        isochrone_backend = None,
     ):
         if pg_conn is None:
-            print("Postgress connection not provided, can only use compute_isochrone() function")
+            logger.info("Postgres connection not provided, can only use compute_isochrone() function")
         
         if times is None:
             times = {'morning': "08:00am", 'afternoon': "2:00pm", 'evening': "8:00pm"}
@@ -37,58 +122,159 @@ class IsochroneService():
         self.pg_conn = pg_conn
         self.h3_resolution = h3_resolution
         self.otp_host = otp_host
-    
+        self.otp_client = otp_client
+        self.otp_timeout = float(otp_timeout)
+        #computes catchments instead of OTP if set (e.g. h3_transit.H3IsochroneBackend)
+        self.isochrone_backend = isochrone_backend
+        self.writer = cw.CatchmentWriter(pg_conn, h3_resolution) if pg_conn is not None else None
+        self._db_lock = None
+        self.otp_retries = int(otp_retries)
+        self._session = None
 
-    def compute_isochrone(self, lat, lon, city='atlanta', time='morning', minutes=30):
+    @property
+    def session(self):
+        """Keep-alive session for the blocking client, retrying transient gateway errors.
+        Created on first use - the API only uses the async client, so it never loads requests.
+        """
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=self.otp_retries, backoff_factor=0.5, status_forcelist=RETRY_STATUSES, allowed_methods=['GET'], raise_on_status=False)
+            self._session = requests.Session()
+            self._session.mount('http://', HTTPAdapter(max_retries=retry))
+            self._session.mount('https://', HTTPAdapter(max_retries=retry))
+        return self._session
+
+
+    def isochrone_request(self, lat, lon, city='atlanta', time='morning', minutes=30):
         #documentation @ http://dev.opentripplanner.org/apidoc/1.5.0/resource_LIsochrone.html
+        #minutes can be a list - OTP then returns one isochrone per cutoff from a single search
         
         assert time in self.times, "Invalid time category. Provided {}, should be one of {}".format(time, ", ".join(self.times))
         time_spec = self.times[time]
 
         api_endpoint = 'http://{}:{}/otp/routers/{}/isochrone'.format(self.otp_host, self.otp_port, city)    
+        params = {
+            'fromPlace': '{},{}'.format(lat, lon), #lat long pair of starting point
+            'mode': self.mode,
+            'date': self.ref_date,
+            'time': time_spec,
+            'maxWalkDistance': self.max_walk_distance,
+            'walkReluctance': self.walk_reluctance,
+            'minTransferTime': self.min_transfer_time,
+            'cutoffSec': [m * 60 for m in cutoffs(minutes)]
+        }
+        return api_endpoint, params
 
-        response = requests.get(
-            api_endpoint,
-            params= {
-                'fromPlace': '{},{}'.format(lat, lon), #lat long pair of starting point
-                'mode': self.mode,
-                'date': self.ref_date,
-                'time': time_spec,
-                'maxWalkDistance': self.max_walk_distance,
-                'walkReluctance': self.walk_reluctance,
-                'minTransferTime': self.min_transfer_time,
-                'cutoffSec': minutes * 60
-            },
-        )
-
-        no_route = 'org.opentripplanner.routing.error.VertexNotFoundException: vertices not found: [from] vertices not found: [from]'
-
-        if response.status_code == 200:
-            df = gpd.read_file(response.text)
-            isochrone = df.loc[0, 'geometry']
-            real = True
+    def parse_isochrones(self, status_code, body, lat, lon, minutes):
+        """Returns an (isochrone, real) pair for each cutoff in `minutes`"""
+        minutes = cutoffs(minutes)
+        if status_code == 200:
+            #OTP returns a feature collection with one feature per cutoff, its cutoff in seconds in properties.time
+            features = orjson.loads(body)['features']
+            if len(minutes) == 1:
+                by_cutoff = {minutes[0] * 60: features[0]}
+            else:
+                by_cutoff = {int(feature['properties']['time']): feature for feature in features}
+            isochrones = []
+            for m in minutes:
+                if m * 60 not in by_cutoff:
+                    raise RuntimeError("OTP returned no isochrone for a cutoff of {} minutes".format(m))
+                geometry = shape(by_cutoff[m * 60]['geometry'])
+                isochrones.append((geometry if isinstance(geometry, MultiPolygon) else MultiPolygon([geometry]), True))
+            return isochrones
             
-        elif response.status_code == 500 and response.text == no_route:
+        elif status_code == 500 and body == NO_ROUTE:
             #return the shape of the h3 cell and its' neighbours
             h3_origin = h3.geo_to_h3(lat, lon, resolution=9)
             neighbours = h3.k_ring(h3_origin, 1)
             polygon = h3.h3_set_to_multi_polygon(neighbours, geo_json=True)
             isochrone =  MultiPolygon([Polygon(polygon[0][0])])
-            real = False
+            #the same fallback for every cutoff
+            return [(isochrone, False)] * len(minutes)
 
         else:
-            raise RuntimeError(response.text)
-        
-        return isochrone, real
+            raise RuntimeError(body)
 
+    def parse_isochrone(self, status_code, body, lat, lon):
+        return self.parse_isochrones(status_code, body, lat, lon, [30])[0]
 
-    def get_isochrone(self, city_id, h3_id, time='morning', minutes=30):
-        
+    def compute_isochrone(self, lat, lon, city='atlanta', time='morning', minutes=30):
+        return self.compute_isochrone_set(lat, lon, city, time, [minutes])[0]
+
+    def compute_isochrone_set(self, lat, lon, city='atlanta', time='morning', minutes=(15, 30, 45)):
+        """Computes the nested isochrones of several cutoffs with a single OTP request - returns (isochrone, real) per cutoff"""
+        api_endpoint, params = self.isochrone_request(lat, lon, city, time, minutes)
+        started = tm.perf_counter()
+        try:
+            response = self.session.get(api_endpoint, params=params, timeout=self.otp_timeout)
+            isochrones = self.parse_isochrones(response.status_code, response.text, lat, lon, minutes)
+        except Exception:
+            metrics.otp('error', tm.perf_counter() - started)
+            raise
+        metrics.otp('real' if isochrones[0][1] else 'fallback', tm.perf_counter() - started)
+        return isochrones
+
+    async def compute_isochrone_async(self, lat, lon, city='atlanta', time='morning', minutes=30):
+        return (await self.compute_isochrone_set_async(lat, lon, city, time, [minutes]))[0]
+
+    async def compute_isochrone_set_async(self, lat, lon, city='atlanta', time='morning', minutes=(15, 30, 45)):
+        assert self.otp_client is not None, "No async OTP client available"
+        api_endpoint, params = self.isochrone_request(lat, lon, city, time, minutes)
+        started = tm.perf_counter()
+        try:
+            status_code, body = await self.otp_client.get(api_endpoint, params)
+            isochrones = self.parse_isochrones(status_code, body, lat, lon, minutes)
+        except Exception:
+            metrics.otp('error', tm.perf_counter() - started)
+            raise
+        #includes time spent waiting for a free slot in the OTP client
+        metrics.otp('real' if isochrones[0][1] else 'fallback', tm.perf_counter() - started)
+        return isochrones
+
+    async def compute_isochrones_async(self, locations):
+        """Computes isochrones for a list of (lat, lon, city, time, minutes) tuples.
+        The OTP client bounds how many of them are in flight at once.
+        """
+        return await asyncio.gather(*[self.compute_isochrone_async(*location) for location in locations])
+
+    def compute_catchment(self, lat, lon, city='atlanta', time='morning', minutes=30):
+        """Returns (isochrone, real, cells) from the isochrone backend, or from OTP if there is none.
+        cells is None if the isochrone still needs to be polyfilled.
+        """
+        return self.compute_catchment_set(lat, lon, city, time, [minutes])[0]
+
+    def compute_catchment_set(self, lat, lon, city='atlanta', time='morning', minutes=(15, 30, 45)):
+        """Same as compute_catchment() for several cutoffs, from a single search - returns (isochrone, real, cells) per cutoff"""
+        if self.isochrone_backend is None:
+            return [isochrone + (None, ) for isochrone in self.compute_isochrone_set(lat, lon, city, time, minutes)]
+        assert time in self.times, "Invalid time category. Provided {}, should be one of {}".format(time, ", ".join(self.times))
+        with metrics.timed(metrics.ISOCHRONE_SECONDS.labels(type(self.isochrone_backend).__name__), 'isochrone_backend'):
+            catchments = self.isochrone_backend.catchments(lat, lon, city, self.times[time], cutoffs(minutes))
+        return [(isochrone, True, cells) for isochrone, cells in catchments]
+
+    async def compute_catchment_async(self, lat, lon, city='atlanta', time='morning', minutes=30):
+        return (await self.compute_catchment_set_async(lat, lon, city, time, [minutes]))[0]
+
+    async def compute_catchment_set_async(self, lat, lon, city='atlanta', time='morning', minutes=(15, 30, 45)):
+        if self.isochrone_backend is None:
+            return [isochrone + (None, ) for isochrone in await self.compute_isochrone_set_async(lat, lon, city, time, minutes)]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.compute_catchment_set, lat, lon, city, time, minutes)
+
+    async def compute_catchments_async(self, locations):
+        """Same as compute_isochrones_async(), returning (isochrone, real, cells) tuples"""
+        return await asyncio.gather(*[self.compute_catchment_async(*location) for location in locations])
+
+
+    def find_catchment(self, city_id, h3_id, time='morning', minutes=30):
+        """Returns (cityname, originh3id, catchmentid, geometry) - the last three are None if the catchment does not exist yet"""
         assert time in self.times, "Invalid time category. Provided {}, should be one of {}".format(time, ", ".join(self.times))        
         assert self.pg_conn is not None, "No Postgres connection available"
 
         #retrieve H3 index and city name of the given POI
-        with self.pg_conn.connection.cursor() as cur:
+        with metrics.sql('find_catchment'), self.pg_conn.connection.cursor() as cur:
             cur.execute("""
                 SELECT cityName, catchments.originh3id, catchments.catchmentid, catchments.geometry FROM cities 
                     JOIN cityh3map ON cities.cityid = cityh3map.cityid                     
@@ -99,120 +285,217 @@ class IsochroneService():
                 """, (city_id, h3_id, time, minutes)
             )
 
-            result = cur.fetchone()
-                                
-        #isochrone already in DB - return
-        if result[1] is not None:                
-            isochrone = to_shape(WKBElement(result[3]))
-            catchment_id = result[2]
-        
-        #compute the isochrone,save to DB and return
-        else:
-            cityname = result[0].lower().replace(" ", "_")                
-            lat, lon = h3.h3_to_geo(h3_id)                
-            isochrone, real = self.compute_isochrone(lat, lon, cityname, time, minutes)
-
-            #save the isochrone to database
-            metadata = MetaData(bind=self.pg_conn, schema='public')
-            metadata.reflect(only=['catchments', 'catchmenth3map'])
-            catchments = Table('catchments', metadata)
-            
-            vals = [ 
-                {"timeofday": time,
-                "timedistance" : minutes,
-                "geometry": from_shape(isochrone),
-                "originh3id":h3_id,
-                "real": real}
-            ]
-            res = self.pg_conn.execute(catchments.insert(), vals)
-            catchment_id = res.inserted_primary_key[0]
-
-            #find all h3 indices in the isochrone and save them to DB, too
-            h3s = [h3.polyfill_geojson(mapping(polygon), res=self.h3_resolution) for polygon in isochrone.geoms]
-            h3s = set().union(*h3s)
-            
+            return cur.fetchone()
+
+    def find_catchments(self, city_id, h3_ids, time='morning', minutes=30):
+        """Returns (cityname, {originh3id: (catchmentid, geometry)}) for the given origins that already have a catchment.
+        cityname is None (and nothing is found) for an unknown city.
+        """
+        assert time in self.times, "Invalid time category. Provided {}, should be one of {}".format(time, ", ".join(self.times))
+        assert self.pg_conn is not None, "No Postgres connection available"
 
-            catchment_map = Table('catchmenth3map', metadata)
-            self.pg_conn.execute(
-                catchment_map.insert(), 
-                [{"catchmentid": catchment_id, "h3id" : h} for h in h3s]
+        with metrics.sql('find_catchments'), self.pg_conn.connection.cursor() as cur:
+            cur.execute("SELECT cityName FROM cities WHERE cityid = %s", (city_id, ))
+            row = cur.fetchone()
+            if row is None:
+                return None, {}
+            cityname = row[0]
+            cur.execute("""
+                SELECT catchments.originh3id, MIN(catchments.catchmentid) FROM catchments
+                    JOIN cityh3map ON cityh3map.h3id = catchments.originh3id
+                    WHERE
+                        cityh3map.cityid = %s AND catchments.originh3id = ANY(%s) AND
+                        catchments.timeofday = %s AND catchments.timedistance = %s
+                    GROUP BY catchments.originh3id
+                """, (city_id, list(h3_ids), time, minutes)
             )
-            self.pg_conn.commit()
-            #calculate catchment statistics and add them to the catchment_stats table and step1_stats table, too
-            self.update_stats(catchment_id)                
+            ids = dict(cur.fetchall())
+            cur.execute("SELECT catchmentid, geometry FROM catchments WHERE catchmentid = ANY(%s)", (list(ids.values()), ))
+            geometries = dict(cur.fetchall())
+            return cityname, {h3_id: (catchment_id, geometries[catchment_id]) for h3_id, catchment_id in ids.items()}
+
+    def lock_catchment(self, h3_id, time, minutes):
+        """Takes a session-level advisory lock so that only one worker computes a given catchment at a time"""
+        with self.pg_conn.connection.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(hashtext(%s))", (cw.lock_key(h3_id, time, minutes), ))
+
+    def unlock_catchment(self, h3_id, time, minutes):
+        with self.pg_conn.connection.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (cw.lock_key(h3_id, time, minutes), ))
+
+    def lock_catchments(self, h3_ids, time, minutes):
+        """Takes the advisory locks of several catchments (one or several cutoffs per origin) - in the order of the lock ids,
+        so that batches never deadlock. Returns the lock ids for unlock_catchments().
+        """
+        keys = [cw.lock_key(h, time, m) for h in h3_ids for m in cutoffs(minutes)]
+        with self.pg_conn.connection.cursor() as cur:
+            cur.execute("SELECT DISTINCT hashtext(k) FROM unnest(%s::text[]) AS k", (keys, ))
+            lock_ids = sorted(r[0] for r in cur.fetchall())
+            for lock_id in lock_ids:
+                cur.execute("SELECT pg_advisory_lock(%s)", (lock_id, ))
+        return lock_ids
+
+    def unlock_catchments(self, lock_ids):
+        with self.pg_conn.connection.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(k) FROM unnest(%s::int[]) AS k", (list(lock_ids), ))
+
+    def get_isochrone(self, city_id, h3_id, time='morning', minutes=30):
+        #H3 ids are bigint in the database - the returned id is an integer too
+        h3_id = h3ids.to_int(h3_id)
+        #most catchments exist already - the lock (and a second lookup) is only needed on a miss
+        result = self.find_catchment(city_id, h3_id, time, minutes)
+        if result[1] is None:
+            #if another worker is computing the same catchment, wait for it and use its result
+            self.lock_catchment(h3_id, time, minutes)
+            try:
+                result = self.find_catchment(city_id, h3_id, time, minutes)
+
+                #compute the isochrone,save to DB and return
+                if result[1] is None:
+                    cityname = result[0].lower().replace(" ", "_")
+                    lat, lon = h3.h3_to_geo(h3ids.to_hex(h3_id))
+                    isochrone, real, cells = self.compute_catchment(lat, lon, cityname, time, minutes)
+                    catchment_id = self.save_isochrone(h3_id, time, minutes, isochrone, real, cells)
+                    return isochrone, h3_id, catchment_id
+            finally:
+                self.unlock_catchment(h3_id, time, minutes)
+
+        #isochrone already in DB - return
+        return to_shape(result[3]), h3_id, result[2]
+
+    async def get_isochrone_async(self, city_id, h3_id, time='morning', minutes=30):
+        """Same as get_isochrone(), but the OTP request does not block the event loop.
+        Database work runs in the default executor, one call at a time as the connection is shared.
+        """
+        loop = asyncio.get_running_loop()
+        if self._db_lock is None:
+            self._db_lock = asyncio.Lock()
+        h3_id = h3ids.to_int(h3_id)
+
+        async with self._db_lock:
+            result = await loop.run_in_executor(None, self.find_catchment, city_id, h3_id, time, minutes)
+        if result[1] is not None:
+            return to_shape(result[3]), h3_id, result[2]
+
+        #if another worker is computing the same catchment, wait for it and use its result
+        async with self._db_lock:
+            await loop.run_in_executor(None, self.lock_catchment, h3_id, time, minutes)
+        try:
+            async with self._db_lock:
+                result = await loop.run_in_executor(None, self.find_catchment, city_id, h3_id, time, minutes)
+
+            if result[1] is not None:
+                return to_shape(result[3]), h3_id, result[2]
+
+            cityname = result[0].lower().replace(" ", "_")
+            lat, lon = h3.h3_to_geo(h3ids.to_hex(h3_id))
+            isochrone, real, cells = await self.compute_catchment_async(lat, lon, cityname, time, minutes)
+            async with self._db_lock:
+                catchment_id = await loop.run_in_executor(None, self.save_isochrone, h3_id, time, minutes, isochrone, real, cells)
+        finally:
+            async with self._db_lock:
+                await loop.run_in_executor(None, self.unlock_catchment, h3_id, time, minutes)
 
         return isochrone, h3_id, catchment_id
-    
-    def update_stats(self, catchment_id):
-        
-        catchment_stats = """
-        WITH all_h3_ids as (
-            SELECT 		
-                h3demographics.categorytype,
-                h3demographics.h3id, 
-                h3demographics.groupname, 
-                h3demographics.population 
-            FROM h3demographics
-        ),
-
-        catchmenth3_ids AS (
-            SELECT 
-                catchments.catchmentid,
-                catchmenth3map.h3id
-            FROM catchments
-            JOIN catchmenth3map ON catchmenth3map.catchmentid = catchments.catchmentid WHERE catchments.catchmentid = :catchment_id
-        )
 
-        INSERT INTO catchment_stats (catchmentid, categorytype, groupname, population)
-            SELECT c.catchmentid, h.categorytype, h.groupname, SUM(h.population)
-                FROM all_h3_ids as h
-                JOIN catchmenth3_ids as c ON c.h3id = h.h3id
-                GROUP BY c.catchmentid, h.categorytype, h.groupname;
-        
+    async def get_isochrones_async(self, city_id, h3_ids, time='morning', minutes=30):
+        """Batch version of get_isochrone_async() - returns (isochrone, h3_id, catchment_id) for every distinct origin.
+        Existing catchments are read with a single query. For the missing ones, the advisory locks of all of them are
+        taken and existence is checked again (another worker may have created some in the meantime), then the rest
+        are computed with concurrent OTP requests and written in one transaction.
         """
+        loop = asyncio.get_running_loop()
+        if self._db_lock is None:
+            self._db_lock = asyncio.Lock()
+        h3_ids = list(dict.fromkeys(h3ids.to_ints(h3_ids)))
+        async with self._db_lock:
+            cityname, existing = await loop.run_in_executor(None, self.find_catchments, city_id, h3_ids, time, minutes)
+        if cityname is None:
+            raise ValueError("Unknown city {}".format(city_id))
 
-        step1_stats = """
-        WITH step1 AS (
-                SELECT 
-                        c3m.h3id,                
-                        catchments.timeofday,
-                        catchments.catchmentid,
-                        catchment_stats.categorytype,		 
-                        CASE 
-                            WHEN SUM(catchment_stats.population) = 0
-                            THEN 0 
-                            ELSE 10000 / SUM(catchment_stats.population) 
-                            END AS ratio
-                FROM catchments
-                JOIN catchment_stats
-                    ON catchment_stats.catchmentid = catchments.catchmentid                
-                JOIN catchmenth3map c3m 
-                    ON catchment_stats.catchmentid = c3m.catchmentid
-                WHERE c3m.catchmentid = :catchment_id
-                GROUP BY 
-                    c3m.h3id,                
-                    catchments.timeofday,
-                    catchments.catchmentid,
-                    catchment_stats.categorytype
-            )
-            
-            INSERT INTO step1_stats 
-            (h3id,		
-                    timeofday,
-                    categorytype,			
-                    catchmentid,
-                    ratio
-            )
-                SELECT 
-                    h3id,		
-                    timeofday,
-                    categorytype,			
-                    catchmentid,
-                    ratio
-                FROM step1
-        """        
+        missing = [h3_id for h3_id in h3_ids if h3_id not in existing]
+        isochrones, catchment_ids = [], []
+        if missing:
+            async with self._db_lock:
+                lock_ids = await loop.run_in_executor(None, self.lock_catchments, missing, time, minutes)
+            try:
+                async with self._db_lock:
+                    _, found = await loop.run_in_executor(None, self.find_catchments, city_id, missing, time, minutes)
+                existing.update(found)
+                missing = [h3_id for h3_id in missing if h3_id not in found]
+
+                city = cityname.lower().replace(" ", "_")
+                locations = [h3.h3_to_geo(h3ids.to_hex(h3_id)) + (city, time, minutes) for h3_id in missing]
+                computed = await self.compute_catchments_async(locations)
+                isochrones = [(h3_id, time, minutes, isochrone, real, cells) for h3_id, (isochrone, real, cells) in zip(missing, computed)]
+                if isochrones:
+                    async with self._db_lock:
+                        catchment_ids = await loop.run_in_executor(None, self.save_isochrones, isochrones)
+            finally:
+                async with self._db_lock:
+                    await loop.run_in_executor(None, self.unlock_catchments, lock_ids)
+
+        results = {h3_id: (to_shape(geometry), h3_id, catchment_id) for h3_id, (catchment_id, geometry) in existing.items()}
+        results.update({item[0]: (item[3], item[0], catchment_id) for item, catchment_id in zip(isochrones, catchment_ids)})
+        return [results[h3_id] for h3_id in h3_ids]
+
+    def find_catchment_set(self, city_id, h3_id, time, minutes):
+        """Returns (cityname, {cutoff: (isochrone, h3_id, catchment_id)}) of the cutoffs that already have a catchment"""
+        existing = {}
+        for m in minutes:
+            cityname, found = self.find_catchments(city_id, [h3_id], time, m)
+            if cityname is None:
+                raise ValueError("Unknown city {}".format(city_id))
+            if h3_id in found:
+                existing[m] = (to_shape(found[h3_id][1]), h3_id, found[h3_id][0])
+        return cityname, existing
+
+    def get_isochrone_set(self, city_id, h3_id, time='morning', minutes=(15, 30, 45)):
+        """Returns (isochrone, h3_id, catchment_id) for each cutoff in `minutes`.
+        As in get_isochrones_async(), the missing cutoffs are locked and looked up again, so concurrent callers wait for
+        each other instead of computing the same catchments. The rest are computed with a single OTP request and saved
+        together in one transaction.
+        """
+        minutes = cutoffs(minutes)
+        if not minutes:
+            raise ValueError("No cutoffs given")
+        h3_id = h3ids.to_int(h3_id)
+        cityname, existing = self.find_catchment_set(city_id, h3_id, time, minutes)
+
+        missing = [m for m in minutes if m not in existing]
+        if missing:
+            lock_ids = self.lock_catchments([h3_id], time, missing)
+            try:
+                _, found = self.find_catchment_set(city_id, h3_id, time, missing)
+                existing.update(found)
+                missing = [m for m in missing if m not in found]
+                if missing:
+                    lat, lon = h3.h3_to_geo(h3ids.to_hex(h3_id))
+                    computed = self.compute_catchment_set(lat, lon, cityname.lower().replace(" ", "_"), time, missing)
+                    isochrones = [(h3_id, time, m, isochrone, real, cells) for m, (isochrone, real, cells) in zip(missing, computed)]
+                    for item, catchment_id in zip(isochrones, self.save_isochrones(isochrones)):
+                        existing[item[2]] = (item[3], h3_id, catchment_id)
+            finally:
+                self.unlock_catchments(lock_ids)
+        return [existing[m] for m in minutes]
+
+    def save_isochrone(self, h3_id, time, minutes, isochrone, real, cells=None):
+        """Saves the isochrone and its H3 cells to the database, updates catchment statistics and returns the catchment id"""
+        return self.save_isochrones([(h3_id, time, minutes, isochrone, real, cells)])[0]
+
+    def save_isochrones(self, isochrones):
+        """Saves a batch of (h3_id, time, minutes, isochrone, real[, cells]) tuples in a single transaction.
+        Returns the new catchment ids in the same order.
+        """
+        return self.writer.write(isochrones)
     
-        self.pg_conn.execute(text(catchment_stats), [{'catchment_id': catchment_id}])
-        self.pg_conn.commit()        
-        self.pg_conn.execute(text(step1_stats), [{'catchment_id': catchment_id}])
-        self.pg_conn.commit()
\ No newline at end of file
+    def update_stats(self, catchment_ids, commit=True):
+        """Computes catchment_stats and step1_stats rows for one catchment id or a list of them"""
+        if not isinstance(catchment_ids, (list, tuple)):
+            catchment_ids = [catchment_ids]
+        if not self.pg_conn.in_transaction():
+            self.pg_conn.begin()
+        with self.pg_conn.connection.cursor() as cur:
+            cw.update_stats(cur, catchment_ids)
+        if commit:
+            self.pg_conn.commit()
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""Snapshot of the metadata the front-end needs on every page load, written by the ingestion and precompute jobs.
+
+A single row holds the distinct values behind /configuration (times of day, POI and demographic categories), the cities
+with their bounding boxes and centers, and row counts of the main tables. Building it scans the largest tables, so
+it is done once at the end of a job instead of on every request; the API keeps the snapshot in memory and reloads it
+when its version changes. All functions take a psycopg2 cursor, so the write happens in the caller's transaction.
+
+Run as a script to refresh the snapshot (e.g. after loading data by hand):
+
+    python metadata.py --config ../config/config.ini
+"""
+import argparse
+import configparser
+import datetime
+import json
+
+import psycopg2
+
+#the metadata_snapshot table and its single row are created by sql/schema.sql
+COUNTED_TABLES = ['cities', 'cityh3map', 'pois', 'h3demographics', 'catchments', 'catchmenth3map']
+
+
+def build(cur):
+    """Computes the snapshot from the tables"""
+    cur.execute("SELECT cityid, cityname, boundingbox FROM cities ORDER BY cityid")
+    cities = []
+    for city_id, name, bbox in cur.fetchall():
+        city = {'id': city_id, 'name': name, 'bbox': bbox}
+        if bbox:
+            city['long'] = (bbox[0] + bbox[2]) / 2
+            city['lat'] = (bbox[1] + bbox[3]) / 2
+        cities.append(city)
+
+    distinct = {}
+    for key, sql in [
+        ('times_of_day', "SELECT DISTINCT timeofday FROM catchments ORDER BY 1"),
+        ('poi_categories', "SELECT DISTINCT category FROM pois ORDER BY 1"),
+        ('demographic_categories', "SELECT DISTINCT categorytype FROM h3demographics ORDER BY 1"),
+    ]:
+        cur.execute(sql)
+        distinct[key] = [r[0] for r in cur.fetchall() if r[0] is not None]
+
+    counts = {}
+    for table in COUNTED_TABLES:
+        cur.execute("SELECT COUNT(*) FROM {}".format(table))
+        counts[table] = cur.fetchone()[0]
+
+    return {'cities': cities, **distinct, 'counts': counts}
+
+
+def write(cur):
+    """Rebuilds the snapshot and returns its new version"""
+    snapshot = build(cur)
+    cur.execute(
+        "UPDATE metadata_snapshot SET version = version + 1, snapshot = %s, created = %s WHERE id = 1 RETURNING version",
+        (json.dumps(snapshot), datetime.datetime.now(datetime.timezone.utc))
+    )
+    return cur.fetchone()[0]
+
+
+def get_version(cur):
+    cur.execute("SELECT version FROM metadata_snapshot WHERE id = 1")
+    return cur.fetchone()[0]
+
+
+def get(cur):
+    """Returns (version, snapshot) - the snapshot is None until a job has written one"""
+    cur.execute("SELECT version, snapshot FROM metadata_snapshot WHERE id = 1")
+    return cur.fetchone()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Refresh the metadata snapshot served by the API")
+    parser.add_argument('--config', default="../config/config.ini", help="path to config.ini")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    with psycopg2.connect(**dict(config['DB'])) as conn:
+        with conn.cursor() as cur:
+            print("Metadata snapshot version {}".format(write(cur)))
@@ -0,0 +1,113 @@
+"""Prometheus metrics of the API and the catchment pipeline.
+
+Everything is registered in the default prometheus_client registry and exposed by the API at /metrics.
+timed() also records each phase into the breakdown of the current request (if one is being tracked),
+which the slow-request log prints.
+"""
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+REQUEST_SECONDS = Histogram('api_request_seconds', 'Latency of API requests', ['method', 'route', 'status'])
+#the route of a request is only known once the router has matched it, so requests in flight are not labelled
+REQUESTS_IN_FLIGHT = Gauge('api_requests_in_flight', 'API requests currently being processed')
+SQL_SECONDS = Histogram('sql_seconds', 'Latency of named SQL calls', ['query'])
+ENGINE_SECONDS = Histogram('engine_seconds', 'Latency of in-memory 2SFCA engine calls', ['call'])
+CACHE_REQUESTS = Counter('cache_requests_total', 'Response cache lookups by result (hit, miss, not_modified)', ['result'])
+
+#outcome is 'real' (an OTP isochrone), 'fallback' (no route, k-ring of the origin) or 'error'
+OTP_SECONDS = Histogram('otp_request_seconds', 'Latency of OTP isochrone requests', ['outcome'])
+OTP_REQUESTS = Counter('otp_requests_total', 'OTP isochrone requests', ['outcome'])
+
+ISOCHRONE_SECONDS = Histogram('isochrone_backend_seconds', 'Time to compute a catchment with an in-process isochrone backend', ['backend'])
+
+POLYFILL_SECONDS = Histogram('catchment_polyfill_seconds', 'Time to polyfill one catchment with H3 cells')
+CATCHMENT_CELLS = Histogram(
+    'catchment_cells', 'H3 cells per catchment', buckets=(10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+)
+CATCHMENT_WRITE_SECONDS = Histogram('catchment_write_seconds', 'Time to write a batch of catchments and their statistics')
+CATCHMENTS_WRITTEN = Counter('catchments_written_total', 'Catchments inserted into the database')
+
+logger = logging.getLogger(__name__)
+
+_breakdown = contextvars.ContextVar('breakdown', default=None)
+
+
+def start_breakdown():
+    """Starts collecting (phase, seconds) pairs for the current request and returns the list they go into"""
+    breakdown = []
+    _breakdown.set(breakdown)
+    return breakdown
+
+
+def record(phase, seconds):
+    breakdown = _breakdown.get()
+    if breakdown is not None:
+        breakdown.append((phase, seconds))
+
+
+@contextmanager
+def timed(metric, phase):
+    """Observes the duration of the block in `metric` (a histogram, with labels already applied)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        metric.observe(seconds)
+        record(phase, seconds)
+
+
+def sql(name):
+    return timed(SQL_SECONDS.labels(name), 'sql:' + name)
+
+
+def engine(name):
+    return timed(ENGINE_SECONDS.labels(name), 'engine:' + name)
+
+
+def otp(outcome, seconds):
+    OTP_SECONDS.labels(outcome).observe(seconds)
+    OTP_REQUESTS.labels(outcome).inc()
+    record('otp:' + outcome, seconds)
+
+
+class RequestMetrics():
+    """ASGI middleware observing the latency of every HTTP request by route template (e.g. /pois/{city_id}/{poi_category},
+    to keep the number of series bounded) and logging the timing breakdown of requests slower than `slow_request_ms`.
+    Response messages are passed through as they come, so streamed responses keep their backpressure.
+    """
+
+    def __init__(self, app, slow_request_ms=0):
+        self.app = app
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        breakdown = start_breakdown()
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            seconds = time.perf_counter() - started
+            #the router stores the matched route in the scope
+            route = scope.get('route')
+            REQUEST_SECONDS.labels(scope['method'], getattr(route, 'path', 'unmatched'), status_code).observe(seconds)
+            if self.slow_request_ms and seconds * 1000 >= self.slow_request_ms:
+                logger.warning("Slow request %s %s (%d): %.1fms %s", scope['method'], scope['path'], status_code, seconds * 1000,
+                    ", ".join("{}={:.1f}ms".format(phase, s * 1000) for phase, s in breakdown))
@@ -0,0 +1,43 @@
+import asyncio
+
+
+class SingleFlight():
+    """Coalesces concurrent calls with the same key: the first caller runs the computation,
+    everyone else arriving while it is in flight awaits the same result (or exception).
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def in_flight(self, key):
+        return key in self._calls
+
+    async def do(self, key, func):
+        """Runs `func` (a coroutine function without arguments) unless a call with the same key is already in flight"""
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        #shield so that one caller being cancelled does not cancel the computation for the others
+        return await asyncio.shield(task)
+
+    async def do_many(self, keys, func):
+        """Batch version of do(): keys already in flight await their call, the others are computed together by
+        `func(missing_keys)` (a coroutine function returning {key: result}). Returns {key: result} for all keys.
+        """
+        keys = list(dict.fromkeys(keys))
+        missing = [key for key in keys if key not in self._calls]
+        if missing:
+            batch = asyncio.ensure_future(func(missing))
+            for key in missing:
+                task = asyncio.ensure_future(self._pick(batch, key))
+                self._calls[key] = task
+                task.add_done_callback(lambda _, key=key: self._calls.pop(key, None))
+        tasks = [self._calls[key] for key in keys]
+        results = await asyncio.gather(*[asyncio.shield(task) for task in tasks])
+        return dict(zip(keys, results))
+
+    @staticmethod
+    async def _pick(batch, key):
+        return (await batch)[key]
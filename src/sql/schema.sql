@@ -0,0 +1,327 @@
+-- Schema of the application database, collected from the notebooks in src/sql and src/data_processing
+-- (which it supersedes). Applied by h3_bigint_migration.py and used by the benchmarks (benchmarks/synthetic_city.py).
+-- Only creates what does not exist yet, so it is safe to run against an existing database.
+-- H3 ids are stored as bigint (see h3ids.py) - databases with char(15) ids are converted by src/h3_bigint_migration.py.
+
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+CREATE TABLE IF NOT EXISTS public.cities
+(
+    CityID serial NOT NULL,
+    CityName varchar(50) NOT NULL,
+    BoundingBox real[],
+    PRIMARY KEY (CityID)
+);
+
+CREATE TABLE IF NOT EXISTS public.cityh3map
+(
+    id serial NOT NULL,
+    CityID integer NOT NULL,
+    H3ID bigint NOT NULL,
+    PRIMARY KEY ("id")
+);
+CREATE INDEX IF NOT EXISTS city_id_index ON public.cityh3map USING HASH (CityID);
+CREATE INDEX IF NOT EXISTS city_h3_index ON public.cityh3map USING HASH (H3ID);
+
+CREATE TABLE IF NOT EXISTS public.pois
+(
+    POIID serial NOT NULL,
+    Name varchar(150) NOT NULL,
+    H3ID bigint NOT NULL,
+    Category varchar(50) NOT NULL,
+    Lat real NOT NULL,
+    Long real NOT NULL,
+    PRIMARY KEY (POIID)
+);
+CREATE INDEX IF NOT EXISTS poi_h3_index ON public.pois USING HASH (H3ID);
+CREATE INDEX IF NOT EXISTS poi_category_index ON public.pois USING HASH (Category);
+CREATE INDEX IF NOT EXISTS poi_h3_range ON public.pois (h3id);
+
+CREATE TABLE IF NOT EXISTS public.h3demographics
+(
+    cityid bigint,
+    categorytype text,
+    groupname text,
+    h3id bigint,
+    population double precision,
+    id bigserial,
+    CONSTRAINT h3demographics_id PRIMARY KEY (id),
+    CONSTRAINT unique_key UNIQUE (cityid, categorytype, groupname, h3id)
+);
+CREATE INDEX IF NOT EXISTS h3id_cityid ON public.h3demographics (cityid, h3id);
+CREATE INDEX IF NOT EXISTS h3demographics_h3index ON public.h3demographics (h3id);
+CREATE INDEX IF NOT EXISTS h3demographics_h3_range ON public.h3demographics (cityid, categorytype, h3id);
+
+CREATE TABLE IF NOT EXISTS public.catchments
+(
+    catchmentid serial NOT NULL,
+    originh3id bigint,
+    timeofday varchar,
+    timedistance integer,
+    geometry geometry(MULTIPOLYGON),
+    real boolean,
+    PRIMARY KEY (catchmentid)
+);
+CREATE INDEX IF NOT EXISTS "OriginH3ID" ON public.catchments (originh3id);
+CREATE INDEX IF NOT EXISTS origin_timeofday ON public.catchments (originh3id, timeofday, timedistance);
+
+CREATE TABLE IF NOT EXISTS public.catchmenth3map
+(
+    id serial NOT NULL,
+    catchmentid integer,
+    h3id bigint,
+    PRIMARY KEY (id)
+);
+CREATE INDEX IF NOT EXISTS h3id ON public.catchmenth3map (h3id);
+CREATE INDEX IF NOT EXISTS catchmentid ON public.catchmenth3map (catchmentid);
+
+CREATE TABLE IF NOT EXISTS public.catchment_stats
+(
+    catchmentid bigint,
+    categorytype text,
+    groupname text,
+    population double precision,
+    id bigserial,
+    CONSTRAINT catchment_stats_id PRIMARY KEY (id),
+    CONSTRAINT catchment_stats_unique_key UNIQUE (catchmentid, categorytype, groupname)
+);
+CREATE INDEX IF NOT EXISTS catchment_stats_index ON public.catchment_stats (catchmentid, categorytype);
+
+CREATE TABLE IF NOT EXISTS step1_stats (
+    timeofday varchar(50),
+    categorytype text,
+    catchmentid bigint,
+    h3id bigint,
+    ratio float
+);
+CREATE INDEX IF NOT EXISTS step1_stats_agg_index ON public.step1_stats (catchmentid, categorytype, timeofday);
+CREATE INDEX IF NOT EXISTS step1_stats_cid ON public.step1_stats (catchmentid);
+CREATE INDEX IF NOT EXISTS step1_stats_h3id ON public.step1_stats (h3id);
+
+CREATE TABLE IF NOT EXISTS public.accessibility_stats
+(
+    id bigserial,
+    cityid bigint,
+    categorytype text,
+    poi_category varchar(50),
+    timeofday varchar(50),
+    h3id bigint,
+    accessibility float,
+    CONSTRAINT acc_stats_id PRIMARY KEY (id)
+);
+CREATE INDEX IF NOT EXISTS acc_stats_agg_index ON public.accessibility_stats (cityid, categorytype, poi_category, timeofday);
+CREATE INDEX IF NOT EXISTS acc_stats_h3index ON public.accessibility_stats (h3id);
+
+-- single-row version counters read by the API on every version check (data_version.py, metadata.py)
+CREATE TABLE IF NOT EXISTS public.data_version
+(
+    id int DEFAULT 1,
+    version bigint NOT NULL DEFAULT 0,
+    CONSTRAINT data_version_id PRIMARY KEY (id),
+    CONSTRAINT data_version_single_row CHECK (id = 1)
+);
+INSERT INTO data_version (id, version) VALUES (1, 0) ON CONFLICT DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS public.metadata_snapshot
+(
+    id int DEFAULT 1,
+    version bigint NOT NULL DEFAULT 0,
+    snapshot jsonb,
+    created timestamp with time zone,
+    CONSTRAINT metadata_snapshot_id PRIMARY KEY (id),
+    CONSTRAINT metadata_snapshot_single_row CHECK (id = 1)
+);
+INSERT INTO metadata_snapshot (id, version) VALUES (1, 0) ON CONFLICT DO NOTHING;
+
+-- one row per city with a demographics_lod pyramid - accessibility_stale is set when accessibility_stats changed
+-- after the build (demographics_lod.py)
+CREATE TABLE IF NOT EXISTS public.lod_builds
+(
+    cityid integer NOT NULL,
+    accessibility_stale boolean NOT NULL DEFAULT false,
+    CONSTRAINT lod_builds_cityid PRIMARY KEY (cityid)
+);
+
+
+CREATE OR REPLACE FUNCTION api_get_pois_for_city(
+    city_id int, poi_category character)
+    RETURNS TABLE
+            (
+                id          int,
+                h3id    bigint,
+                name    varchar,
+                lat         real,
+                long        real,
+                category    varchar
+            )
+    LANGUAGE plpgsql
+AS
+$poiforcity$
+BEGIN
+    RETURN QUERY
+        SELECT pois.poiid, pois.h3id, pois.name, pois.lat, pois.long, pois.category
+            FROM pois
+            JOIN cityh3map ON cityh3map.h3id = pois.h3id
+            JOIN cities ON cities.cityid = cityh3map.cityid
+            WHERE cities.cityID = city_id AND pois.category = poi_category;
+END;
+$poiforcity$;
+
+
+CREATE OR REPLACE FUNCTION api_get_demographics_for_city(
+    in_cityid integer, in_categorytype character)
+    RETURNS TABLE
+            (
+                h3id    bigint,
+                groupname   text,
+                population   float
+            )
+    LANGUAGE plpgsql
+AS
+$demographicsforcity$
+BEGIN
+    RETURN QUERY
+        SELECT h3demographics.h3id, h3demographics.groupname, h3demographics.population from h3demographics
+        WHERE cityid = in_cityid and categorytype = in_categorytype;
+END;
+$demographicsforcity$;
+
+
+CREATE OR REPLACE FUNCTION api_get_demographics_for_catchment(
+    in_categorytype character,
+    in_catchment_id integer
+)
+    RETURNS TABLE
+            (
+                groupname   text,
+                population   float
+            )
+    LANGUAGE plpgsql
+AS
+$demographicsforarea$
+BEGIN
+    RETURN QUERY
+        SELECT catchment_stats.groupname, catchment_stats.population
+            FROM catchment_stats
+            WHERE categorytype = in_categorytype AND catchmentid = in_catchment_id;
+END;
+$demographicsforarea$;
+
+
+CREATE OR REPLACE FUNCTION api_add_remove_catchments(
+    in_remove_hex_ids bigint[],
+    in_add_hex_ids bigint[],
+    in_timeofday varchar,
+    in_categorytype text,
+    in_poi_category varchar
+)
+    RETURNS TABLE
+            (
+                h3id         bigint,
+                adjustment        float
+            )
+    LANGUAGE plpgsql
+AS
+$addremovecatchments$
+BEGIN
+    RETURN QUERY
+        WITH
+            to_remove AS (
+                select DISTINCT id FROM unnest(in_remove_hex_ids) m(id)
+            ),
+        remove_catchment_ids AS (
+                SELECT catchmentid,
+                -COUNT(*) as sign
+                FROM catchments
+                JOIN pois
+                ON pois.h3id = catchments.originh3id
+                JOIN to_remove ON catchments.originh3id = to_remove.id
+                WHERE pois.category = in_poi_category
+                    -- only 30 minute catchments make up the statistics (accessibility_stats.STATS_MINUTES)
+                    AND (catchments.timedistance = 30 OR catchments.timedistance IS NULL)
+                GROUP BY catchmentid
+            ),
+        add_catchment_ids AS (
+            SELECT catchmentid,
+                COUNT(*) as sign
+                FROM catchments
+                JOIN unnest(in_add_hex_ids) m(id) ON catchments.originh3id = m.id
+                WHERE catchments.timedistance = 30 OR catchments.timedistance IS NULL
+                GROUP BY catchmentid
+            ),
+        all_catchment_ids AS (
+            SELECT catchmentid, SUM(sign) as sign FROM
+            (SELECT * FROM add_catchment_ids UNION SELECT * FROM remove_catchment_ids) as t
+            GROUP BY catchmentid
+        )
+        SELECT
+            step1.h3id,
+            sum(ratio * sign) as ratio
+            FROM step1_stats as step1
+            JOIN all_catchment_ids ON step1.catchmentid = all_catchment_ids.catchmentid
+            WHERE
+                categorytype = in_categorytype
+                AND
+                timeofday = in_timeofday
+            GROUP BY step1.h3id;
+END;
+$addremovecatchments$;
+
+
+CREATE OR REPLACE FUNCTION api_get_city_stats(
+    in_cityid integer,
+    in_poi_category varchar,
+    in_timeofday varchar,
+    in_categorytype text,
+    in_remove_hex_ids bigint[] default array[]::bigint[],
+    in_add_hex_ids bigint[] default array[]::bigint[]
+)
+    RETURNS TABLE
+            (
+                groupn      text,
+                metric        float,
+                population      float
+            )
+    LANGUAGE plpgsql
+AS
+$getcitystats$
+BEGIN
+    RETURN QUERY
+    WITH stats as (
+        SELECT
+        a.h3id,
+        a.accessibility
+        FROM accessibility_stats a
+        WHERE
+            a.cityid = in_cityid
+            AND a.categorytype = in_categorytype
+            AND a.poi_category = in_poi_category
+            AND a.timeofday = in_timeofday
+    ),
+    adjustments as (
+        SELECT adj.h3id, adj.adjustment as accessibility
+        FROM api_add_remove_catchments(
+            in_remove_hex_ids,
+            in_add_hex_ids,
+            in_timeofday,
+            in_categorytype,
+            in_poi_category
+        ) as adj
+    ),
+    total as (
+        SELECT s.h3id, s.accessibility + COALESCE(a.accessibility, 0) as accessibility
+        FROM stats s
+        LEFT JOIN adjustments a ON s.h3id = a.h3id
+    )
+    SELECT
+        h.groupname,
+        SUM(COALESCE(t.accessibility,0) * h.population) / SUM(h.population) as metric,
+        SUM(h.population) as population
+    FROM h3demographics as h
+    LEFT JOIN total as t
+    ON  h.h3id = t.h3id
+    WHERE h.categorytype = in_categorytype AND h.cityid = in_cityid
+    GROUP BY h.groupname
+    ORDER BY metric DESC;
+END;
+$getcitystats$;
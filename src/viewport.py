@@ -0,0 +1,151 @@
+"""Viewport filters for the map routes - a set of H3 cells (tiles) of any resolution up to 9.
+
+The children of an H3 cell at a finer resolution form one contiguous range of H3 ids: they share the cell's mode,
+base cell and leading digits, and only differ in the digits below the cell's resolution (0-6).
+With H3 ids stored as bigint, a tile becomes a single range scan over a btree index on h3id:
+
+    SELECT ... FROM unnest(los, his) AS t(lo, hi) JOIN pois ON pois.h3id BETWEEN t.lo AND t.hi
+
+A bounding box is turned into the tiles of TILE_RESOLUTION covering it, so when the map is panned the client
+only needs to request the tiles it does not have yet (they are returned in the X-H3-Tiles header).
+
+Run as a script to create the indexes:
+
+    python viewport.py --config ../config/config.ini
+"""
+import argparse
+import configparser
+import math
+
+import h3
+import psycopg2
+
+import h3ids
+
+H3_RESOLUTION = 9
+#resolution 6 cells are ~36 km2 - a city-wide view is a few dozen tiles
+TILE_RESOLUTION = 6
+MAX_TILES = 2000
+EARTH_RADIUS_KM = 6371.0088
+
+CREATE_INDEXES_SQL = """
+CREATE INDEX IF NOT EXISTS poi_h3_range ON public.pois (h3id);
+CREATE INDEX IF NOT EXISTS h3demographics_h3_range ON public.h3demographics (cityid, categorytype, h3id);
+"""
+
+_RES_SHIFT = 52
+_RES_MASK = 0xF << _RES_SHIFT
+
+
+def _digit_shift(resolution):
+    return (15 - resolution) * 3
+
+
+def cell_range(cell, resolution=H3_RESOLUTION):
+    """Returns the (first, last) integer H3 ids of the descendants of `cell` at `resolution` (the cell's ancestor if coarser)"""
+    cell_resolution = h3.h3_get_resolution(cell)
+    if resolution <= cell_resolution:
+        parent = h3ids.to_int(h3.h3_to_parent(cell, resolution))
+        return parent, parent
+    index = (h3.string_to_h3(cell) & ~_RES_MASK) | (resolution << _RES_SHIFT)
+    lo, hi = index, index
+    for r in range(cell_resolution + 1, resolution + 1):
+        shift = _digit_shift(r)
+        lo &= ~(7 << shift)
+        hi = (hi & ~(7 << shift)) | (6 << shift)
+    return lo, hi
+
+
+class Viewport():
+    """A set of tiles - cells nested in another tile of the set are dropped, so no row is returned twice"""
+
+    def __init__(self, tiles):
+        tiles = set(t.strip().lower() for t in tiles if t.strip())
+        if len(tiles) > MAX_TILES:
+            raise ValueError("Too many tiles ({}, at most {})".format(len(tiles), MAX_TILES))
+        for tile in tiles:
+            if not h3.h3_is_valid(tile) or h3.h3_get_resolution(tile) > H3_RESOLUTION:
+                raise ValueError("Invalid tile {}".format(tile))
+        self.tiles = sorted(
+            t for t in tiles
+            if not any(h3.h3_to_parent(t, r) in tiles for r in range(h3.h3_get_resolution(t)))
+        )
+
+    @staticmethod
+    def estimate_tiles(min_lon, min_lat, max_lon, max_lat, resolution=TILE_RESOLUTION):
+        """Approximate number of cells of `resolution` in the bounding box, from its area on the sphere"""
+        area = (
+            EARTH_RADIUS_KM ** 2 * math.radians(max_lon - min_lon)
+            * abs(math.sin(math.radians(max_lat)) - math.sin(math.radians(min_lat)))
+        )
+        return area / h3.hex_area(resolution, unit='km^2')
+
+    @classmethod
+    def from_bbox(cls, min_lon, min_lat, max_lon, max_lat, resolution=TILE_RESOLUTION):
+        """Tiles covering the bounding box - those with their center inside, the ones at its corners and their neighbours"""
+        ring = [(min_lat, min_lon), (min_lat, max_lon), (max_lat, max_lon), (max_lat, min_lon), (min_lat, min_lon)]
+        cells = h3.polyfill({'type': 'Polygon', 'coordinates': [ring]}, resolution)
+        cells.update(h3.geo_to_h3(lat, lon, resolution) for lat, lon in ring)
+        tiles = set()
+        for cell in cells:
+            tiles.update(h3.k_ring(cell, 1))
+        return cls(tiles)
+
+    @classmethod
+    def parse(cls, bbox=None, tiles=None):
+        """Viewport of the bbox ('min_lon,min_lat,max_lon,max_lat') or tiles (comma-separated H3 ids) query parameter.
+        Returns None if neither is given. Raises ValueError on invalid input.
+        """
+        if tiles:
+            return cls(tiles.split(','))
+        if bbox:
+            values = [float(v) for v in bbox.split(',')]
+            if (
+                len(values) != 4 or not all(math.isfinite(v) for v in values) or values[0] > values[2] or values[1] > values[3]
+                or values[0] < -180 or values[2] > 180 or values[1] < -90 or values[3] > 90
+            ):
+                raise ValueError("bbox should be min_lon,min_lat,max_lon,max_lat")
+            #rejected before polyfilling, which takes seconds for a large area
+            estimate = cls.estimate_tiles(*values)
+            if estimate > MAX_TILES:
+                raise ValueError("bbox too large (about {:.0f} tiles, at most {})".format(estimate, MAX_TILES))
+            return cls.from_bbox(*values)
+        return None
+
+    def coarsen(self, resolution):
+        """The viewport made of the ancestors at `resolution` of tiles finer than that"""
+        return Viewport(h3.h3_to_parent(t, resolution) if h3.h3_get_resolution(t) > resolution else t for t in self.tiles)
+
+    def ranges(self, resolution=H3_RESOLUTION):
+        """Returns ([first ids], [last ids]) of the cells of `resolution` in the viewport"""
+        ranges = sorted(set(cell_range(t, resolution) for t in self.tiles))
+        return [r[0] for r in ranges], [r[1] for r in ranges]
+
+    def contains(self, h3_id):
+        h3_id = h3ids.to_hex(h3_id)
+        resolution = h3.h3_get_resolution(h3_id)
+        tiles = set(self.tiles)
+        return any(h3.h3_to_parent(h3_id, r) in tiles for r in range(resolution + 1))
+
+    def key(self):
+        return tuple(self.tiles)
+
+
+def join_sql(column):
+    """JOIN clause restricting `column` to a viewport - takes the two lists of ranges() as parameters"""
+    return 'JOIN unnest(%s::bigint[], %s::bigint[]) AS viewport(lo, hi) ON {} BETWEEN viewport.lo AND viewport.hi'.format(column)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Create the indexes used by viewport queries")
+    parser.add_argument('--config', default="../config/config.ini", help="path to config.ini")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    with psycopg2.connect(**dict(config['DB'])) as conn:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_INDEXES_SQL)